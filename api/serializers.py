@@ -2,12 +2,14 @@ from rest_framework import serializers
 
 from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
 from phonenumber_field.phonenumber import PhoneNumber
 from phonenumber_field.serializerfields import PhoneNumberField
 
 from fleet.models import Vehicle, VehicleMarketing, VehiclePicture
 from users.models import Customer
 from sales.models import BaseReservation, Card
+from consignment.models import ConsignmentReservation
 from marketing.models import NewsItem
 
 
@@ -19,7 +21,18 @@ class NationalizedPhoneNumberField(PhoneNumberField):
         return value
 
 
-class VehicleSerializer(serializers.ModelSerializer):
+# Reads each vehicle's multi-day prices from a FleetPriceMatrix passed in the serializer context as 'price_matrix'
+class MultiDayPricesMixin(serializers.Serializer):
+    multi_day_prices = serializers.SerializerMethodField()
+
+    def get_multi_day_prices(self, obj):
+        price_matrix = self.context.get('price_matrix')
+        if price_matrix is None or obj.id not in price_matrix:
+            return None
+        return price_matrix.row(obj.id).as_dict()
+
+
+class VehicleSerializer(MultiDayPricesMixin, serializers.ModelSerializer):
     # TODO for migration: deprecate below listed specified fields
     vehicleid = serializers.IntegerField(source='id')
     type = serializers.IntegerField(source='vehicle_type')
@@ -34,13 +47,13 @@ class VehicleSerializer(serializers.ModelSerializer):
         model = VehicleMarketing
         fields = (
             'id', 'make', 'model', 'vehicle_type', 'price_per_day',
-            'discount_2_day', 'discount_3_day', 'discount_7_day', 'miles_included', 'specs',
+            'discount_2_day', 'discount_3_day', 'discount_7_day', 'miles_included', 'specs', 'multi_day_prices',
             # TODO: deprecate and remove below fields once mobile app is migrated to native field names
             'vehicleid', 'type', 'price', 'disc2day', 'disc3day', 'disc7day', 'milesinc',
         )
 
 
-class VehicleDetailSerializer(serializers.ModelSerializer):
+class VehicleDetailSerializer(MultiDayPricesMixin, serializers.ModelSerializer):
     extramiles = serializers.JSONField(source='extra_miles_choices')  # TODO: Should be extra_miles
     blurb = serializers.CharField(source='blurb_parsed')
     # TODO for migration: deprecate below listed specified fields
@@ -64,7 +77,7 @@ class VehicleDetailSerializer(serializers.ModelSerializer):
             'id', 'make', 'model', 'vehicle_type', 'price_per_day',
             'discount_2_day', 'discount_3_day', 'discount_7_day', 'miles_included', 'security_deposit', 'blurb', 'specs',
             'horsepower', 'torque', 'top_speed', 'transmission_type', 'gears', 'location', 'tight_fit', 'origin_country',
-            'extramiles',
+            'extramiles', 'multi_day_prices',
             # TODO: deprecate and remove below fields once mobile app is migrated to native field names
             'vehicleid', 'type', 'price', 'disc2day', 'disc3day', 'disc7day', 'milesinc', 'hp', 'tq', 'deposit',
             'origin', 'topspeed', 'type',
@@ -137,11 +150,103 @@ class ScheduleConflictSerializer(serializers.ModelSerializer):
         )
 
 
+# A consigner's block on their vehicle, in the same shape as ScheduleConflictSerializer
+class ConsignmentConflictSerializer(serializers.ModelSerializer):
+
+    is_reservation = serializers.SerializerMethodField()
+    is_rental = serializers.SerializerMethodField()
+    first_name = serializers.CharField(source='consigner.first_name')
+    last_name = serializers.CharField(source='consigner.last_name')
+    reservation_type = serializers.SerializerMethodField()
+    url = serializers.SerializerMethodField()
+    out_date = serializers.DateField(format=settings.DATE_FORMAT_INPUT)
+    back_date = serializers.DateField(format=settings.DATE_FORMAT_INPUT)
+    num_days = serializers.SerializerMethodField()
+
+    def get_is_reservation(self, obj):
+        return False
+
+    def get_is_rental(self, obj):
+        return False
+
+    def get_reservation_type(self, obj):
+        return 'Consigner Reservation'
+
+    def get_url(self, obj):
+        if obj.consigner_id:
+            return reverse('backoffice:consigner-detail', kwargs={'pk': obj.consigner_id})
+
+    def get_num_days(self, obj):
+        return (obj.back_date - obj.out_date).days
+
+    class Meta:
+        model = ConsignmentReservation
+        fields = (
+            'id', 'is_reservation', 'is_rental', 'first_name', 'last_name', 'reservation_type',
+            'out_date', 'back_date', 'reserved_at', 'num_days', 'url',
+        )
+
+
 class TaxRateFetchSerializer(serializers.Serializer):
     zip = serializers.CharField()
     force_refresh = serializers.BooleanField()
 
 
+PAST_RENTAL_DATE_ERROR = "You've specified a rental date in the past."
+
+
+# Rental dates which must end after they start. A rental may not start in the past either, as in
+# ReservationRentalDetailsForm; a batch reports that per quote (see BatchRentalQuoteView), so only
+# AvailableVehiclesRequestSerializer refuses it here
+class RentalDatesMixin(serializers.Serializer):
+    out_at = serializers.DateTimeField()
+    back_at = serializers.DateTimeField()
+
+    def validate(self, data):
+        if data['back_at'] <= data['out_at']:
+            raise serializers.ValidationError('Return date must be later than the rental date.')
+        return data
+
+
+class RentalQuoteRequestSerializer(RentalDatesMixin, serializers.Serializer):
+    vehicle_marketing = serializers.IntegerField()
+    extra_miles = serializers.ChoiceField(choices=list(settings.EXTRA_MILES_PRICES.keys()), default=0)
+    coupon_code = serializers.CharField(max_length=30, required=False, allow_blank=True, default='')
+
+
+class AvailableVehiclesRequestSerializer(RentalDatesMixin, serializers.Serializer):
+    extra_miles = serializers.ChoiceField(choices=list(settings.EXTRA_MILES_PRICES.keys()), default=0)
+    coupon_code = serializers.CharField(max_length=30, required=False, allow_blank=True, default='')
+    email = serializers.EmailField(required=False, allow_blank=True, default='')
+    delivery_zip = serializers.CharField(max_length=10, required=False, allow_blank=True, default='')
+    is_military = serializers.BooleanField(default=False)
+
+    def validate_out_at(self, value):
+        if value < timezone.now():
+            raise serializers.ValidationError(PAST_RENTAL_DATE_ERROR)
+        return value
+
+
+# A vehicle free for the requested dates, with its quote for them from the 'quotes' dict in the serializer context
+class AvailableVehicleSerializer(VehicleSerializer):
+    price_data = serializers.SerializerMethodField()
+
+    def get_price_data(self, obj):
+        return self.context['quotes'].get(obj.id)
+
+    class Meta(VehicleSerializer.Meta):
+        fields = VehicleSerializer.Meta.fields + ('price_data',)
+
+
+class BatchRentalQuoteSerializer(serializers.Serializer):
+    quotes = serializers.ListField(
+        child=RentalQuoteRequestSerializer(), allow_empty=False, max_length=settings.BATCH_QUOTE_MAX_ITEMS,
+    )
+    email = serializers.EmailField(required=False, allow_blank=True, default='')
+    delivery_zip = serializers.CharField(max_length=10, required=False, allow_blank=True, default='')
+    is_military = serializers.BooleanField(default=False)
+
+
 class CardSerializer(serializers.ModelSerializer):
 
     class Meta:
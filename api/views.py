@@ -1,11 +1,9 @@
-import os
 import datetime
 import logging
 import pytz
 import requests
 import stripe
 from stripe.error import CardError
-import pdfkit
 
 from rest_framework import viewsets, mixins, status
 from rest_framework.views import APIView
@@ -36,14 +34,22 @@ from marketing.models import NewsletterSubscription, NewsItem
 from customer_portal.forms import ReservationCustomerInfoForm
 from sales.models import BaseReservation, Reservation, Rental, TaxRate, AdHocPayment, GiftCertificate, generate_code
 from sales.tasks import send_email
-from sales.calculators import PriceCalculator
+from pri.pdf import html_to_pdf
+from sales.calculators import PricingContext, RentalPriceCalculator, get_cached_price_data
 from sales.enums import CC2_ERROR_PARAM_MAP, ServiceType
+from sales.tax_rates import get_tax_rate, refresh_tax_rate
+from sales.availability import availability_index, get_free_vehicle_ids, Booking, CONSIGNMENT, RESERVATION, RENTAL
 from sales.models import Card
 from users.models import User, Customer, Employee, generate_password
 from fleet.models import Vehicle, VehicleMarketing, VehiclePicture
+from fleet.pricing import FleetPriceMatrix
+from fleet.schedule import FleetSchedule
+from consignment.models import ConsignmentReservation
 from api.serializers import (
     VehicleSerializer, VehicleDetailSerializer, VehiclePicsSerializer, CustomerSearchSerializer,
-    ScheduleConflictSerializer, TaxRateFetchSerializer, CardSerializer, NewsItemSerializer
+    ScheduleConflictSerializer, ConsignmentConflictSerializer, AvailableVehiclesRequestSerializer,
+    AvailableVehicleSerializer, TaxRateFetchSerializer, CardSerializer, NewsItemSerializer, BatchRentalQuoteSerializer,
+    PAST_RENTAL_DATE_ERROR,
 )
 from sales.views import ReservationMixin
 
@@ -62,8 +68,8 @@ class HasReservationsAccess(BasePermission):
 class GetVehiclesView(APIView):
 
     def get(self, request):
-        vehicles = VehicleMarketing.objects.all()
-        serializer = VehicleSerializer(vehicles, many=True)
+        price_matrix = FleetPriceMatrix(VehicleMarketing.objects.all())
+        serializer = VehicleSerializer(price_matrix.vehicles, many=True, context={'price_matrix': price_matrix})
         return Response(serializer.data)
 
 
@@ -74,7 +80,8 @@ class GetVehicleView(APIView):
             vehicle = VehicleMarketing.objects.get(pk=vehicle_id)
         except VehicleMarketing.DoesNotExist:
             raise Http404
-        serializer = VehicleDetailSerializer(vehicle)
+        price_matrix = FleetPriceMatrix([vehicle])
+        serializer = VehicleDetailSerializer(vehicle, context={'price_matrix': price_matrix})
         return Response({'vehicle': serializer.data})
 
 
@@ -119,33 +126,34 @@ class ValidateRentalDetailsView(APIView):
     def post_legacy(self, request, payload):
         form = ReservationRentalDetailsForm(payload)
         if form.is_valid():
-            vehicle_marketing = form.cleaned_data.get('vehicle_marketing') if form.is_valid() else None
+            vehicle_marketing = form.cleaned_data.get('vehicle_marketing')
+            price_data = form.price_data
             response = {
-                'success': form.is_valid(),
+                'success': True,
                 'error': form.get_error(),
-                'price_data': form.price_data,
-                "tax_amt": form.price_data.get('tax_amount'),
-                "total_w_tax": form.price_data.get('total_with_tax'),
-                "reservation_deposit": form.price_data.get('reservation_deposit'),
-                "multi_day_discount_pct": form.price_data.get('multi_day_discount_pct'),
-                "extra_miles": form.price_data.get('extra_miles'),
+                'price_data': price_data,
+                "tax_amt": price_data.get('tax_amount'),
+                "total_w_tax": price_data.get('total_with_tax'),
+                "reservation_deposit": price_data.get('reservation_deposit'),
+                "multi_day_discount_pct": price_data.get('multi_day_discount_pct'),
+                "extra_miles": price_data.get('extra_miles'),
                 "fieldErrors": form.errors,
                 "deposit": vehicle_marketing.security_deposit if vehicle_marketing else None,
                 "rental_duration": form.instance.rental_duration_hours,
-                "tcostRaw": form.price_data.get('base_price'),
+                "tcostRaw": price_data.get('base_price'),
                 "numdrivers": int(form.cleaned_data['drivers']),
-                "customer_discount": form.price_data.get('specific_discount'),
+                "customer_discount": price_data.get('specific_discount'),
                 "customer_discount_pct": 0,
-                "tcost": form.price_data.get('post_multi_day_discount_subtotal'),
+                "tcost": price_data.get('post_multi_day_discount_subtotal'),
                 "delivery": int(form.cleaned_data['delivery_required']),
                 "customerid": form.customer.id if form.customer else None,
                 "numdays": form.instance.num_days,
-                "subtotal": form.price_data.get('subtotal'),
+                "subtotal": price_data.get('subtotal'),
                 "dateout_check": form.cleaned_data['out_at'],  # "June, 01 2023 09:30:00",
-                "extra_miles_cost": form.price_data.get('extra_miles_cost'),
-                "tax_rate": form.price_data.get('tax_rate', 0) * 100,
-                "car_discount": form.price_data.get('coupon_discount'),
-                "multi_day_discount": form.price_data.get('multi_day_discount'),
+                "extra_miles_cost": price_data.get('extra_miles_cost'),
+                "tax_rate": price_data.get('tax_rate', 0) * 100,
+                "car_discount": price_data.get('coupon_discount'),
+                "multi_day_discount": price_data.get('multi_day_discount'),
             }
         else:
             response = {
@@ -155,6 +163,117 @@ class ValidateRentalDetailsView(APIView):
         return Response(response)
 
 
+# Quotes many (vehicle, out_at, back_at, extra_miles, coupon) combinations in one request, e.g. to price a calendar
+# month or the whole fleet. Vehicles are loaded in one query and all quotes share one PricingContext, so promotion,
+# coupon, customer and tax lookups happen once per batch rather than once per quote.
+class BatchRentalQuoteView(APIView):
+
+    def post(self, request):
+        serializer = BatchRentalQuoteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'success': False, 'errors': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        quote_requests = serializer.validated_data['quotes']
+        vehicle_marketing_ids = {quote_request['vehicle_marketing'] for quote_request in quote_requests}
+        vehicles = VehicleMarketing.objects.ready().in_bulk(vehicle_marketing_ids)
+        tax_zip = serializer.validated_data['delivery_zip'] or settings.DEFAULT_TAX_ZIP
+
+        # Unsaved instances so num_days and out_date follow the same rules as a real reservation
+        reservations = [
+            Reservation(out_at=quote_request['out_at'], back_at=quote_request['back_at'])
+            for quote_request in quote_requests
+        ]
+        pricing_context = PricingContext()
+        now = timezone.now()
+
+        quotes = []
+        for quote_request, reservation in zip(quote_requests, reservations):
+            quote = {
+                'vehicle_marketing': quote_request['vehicle_marketing'],
+                'out_at': quote_request['out_at'],
+                'back_at': quote_request['back_at'],
+                'extra_miles': quote_request['extra_miles'],
+                'coupon_code': quote_request['coupon_code'],
+            }
+            if quote_request['out_at'] < now:
+                quote.update(success=False, error=PAST_RENTAL_DATE_ERROR)
+                quotes.append(quote)
+                continue
+            vehicle_marketing = vehicles.get(quote_request['vehicle_marketing'])
+            if not vehicle_marketing:
+                quote.update(success=False, error='Invalid vehicle specified.')
+                quotes.append(quote)
+                continue
+
+            price_data = get_cached_price_data(
+                RentalPriceCalculator,
+                vehicle_marketing=vehicle_marketing,
+                num_days=reservation.num_days,
+                extra_miles=quote_request['extra_miles'],
+                coupon_code=quote_request['coupon_code'],
+                email=serializer.validated_data['email'],
+                tax_zip=tax_zip,
+                effective_date=reservation.out_date,
+                is_military=serializer.validated_data['is_military'],
+                pricing_context=pricing_context,
+            )
+            quote.update(success=True, price_data=price_data)
+            quotes.append(quote)
+
+        return Response({
+            'success': True,
+            'quotes': quotes,
+        })
+
+
+# Every ready vehicle which can be rented for the given dates, with its quote. Availability comes from the in-memory
+# availability index, and each VehicleMarketing's Vehicles are matched up in one query, so the whole search takes a
+# fixed number of queries however large the fleet.
+class AvailableVehiclesView(APIView):
+
+    def get(self, request):
+        serializer = AvailableVehiclesRequestSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response({'success': False, 'errors': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        params = serializer.validated_data
+        vehicles = list(VehicleMarketing.objects.ready().order_by('vehicle_type', 'id'))
+        free_vehicle_ids = get_free_vehicle_ids(
+            [vehicle.id for vehicle in vehicles], params['out_at'], params['back_at'],
+        )
+        vehicles = [vehicle for vehicle in vehicles if vehicle.id in free_vehicle_ids]
+
+        # Unsaved instance so num_days and out_date follow the same rules as a real reservation
+        reservation = Reservation(out_at=params['out_at'], back_at=params['back_at'])
+        pricing_context = PricingContext()
+        quotes = {
+            vehicle.id: get_cached_price_data(
+                RentalPriceCalculator,
+                vehicle_marketing=vehicle,
+                num_days=reservation.num_days,
+                extra_miles=params['extra_miles'],
+                coupon_code=params['coupon_code'],
+                email=params['email'],
+                tax_zip=params['delivery_zip'] or settings.DEFAULT_TAX_ZIP,
+                effective_date=reservation.out_date,
+                is_military=params['is_military'],
+                pricing_context=pricing_context,
+            ) for vehicle in vehicles
+        }
+
+        price_matrix = FleetPriceMatrix(vehicles)
+        vehicles_serializer = AvailableVehicleSerializer(
+            price_matrix.vehicles, many=True, context={'price_matrix': price_matrix, 'quotes': quotes},
+        )
+        return Response({
+            'success': True,
+            'out_at': params['out_at'],
+            'back_at': params['back_at'],
+            'num_days': reservation.num_days,
+            'vehicles': vehicles_serializer.data,
+        })
+
+
 # 2nd phase form; handles either new customers (with CC details) or returning (with login creds)
 
 class ValidateRentalPaymentView(ReservationMixin, APIView):
@@ -745,15 +864,15 @@ class TaxRateByZipView(APIView):
         force_refresh = serializer.data['force_refresh']
 
         if force_refresh:
-            for tax_rate in TaxRate.objects.filter(postal_code=tax_zip):
-                tax_rate.update()
+            refresh_tax_rate(tax_zip, force=True)
 
-        price_calculator = PriceCalculator(coupon_code=None, email=None, tax_zip=tax_zip, effective_date=None)
-        tax_rate = price_calculator.tax_rate
+        tax_rate = get_tax_rate(tax_zip)
+        # The in-memory rate table doesn't hold the breakdown by jurisdiction; that is only on the stored row, if any
+        detail = TaxRate.objects.filter(postal_code=tax_zip).values_list('detail', flat=True).first()
         return Response({
             'success': True,
             'tax_rate': float(tax_rate.total_rate_as_percent),
-            'detail': tax_rate.detail,
+            'detail': detail,
         })
 
 
@@ -776,21 +895,53 @@ class CheckScheduleConflictView(APIView):
 
         vehicle = Vehicle.objects.get(pk=request.POST.get('vehicle_id'))
 
-        conflicts = BaseReservation.objects.filter(vehicle=vehicle, back_at__gte=out_at, out_at__lte=back_at)
+        exclude = ()
         exclude_id = request.POST.get('reservation_id') or request.POST.get('rental_id')
         if exclude_id:
-            conflicts = conflicts.exclude(pk=exclude_id)
-
-        serializer = ScheduleConflictSerializer(conflicts, many=True)
+            exclude = (Booking(RESERVATION, int(exclude_id)), Booking(RENTAL, int(exclude_id)))
+
+        # The index finds the conflicts; only those rows are then fetched for display
+        conflicts = availability_index.get_conflicts(vehicle.id, out_at, back_at, exclude=exclude)
+        reservation_ids = [conflict.booking.id for conflict in conflicts if conflict.booking.kind != CONSIGNMENT]
+        consignment_ids = [conflict.booking.id for conflict in conflicts if conflict.booking.kind == CONSIGNMENT]
+        serialized = {}
+        if reservation_ids:
+            reservations = BaseReservation.objects.filter(pk__in=reservation_ids).select_related(
+                'customer', 'reservation', 'rental',
+            )
+            for reservation in ScheduleConflictSerializer(reservations, many=True).data:
+                kind = RENTAL if reservation['is_rental'] else RESERVATION
+                serialized[Booking(kind, reservation['id'])] = reservation
+        if consignment_ids:
+            consignment_reservations = ConsignmentReservation.objects.filter(pk__in=consignment_ids).select_related(
+                'consigner',
+            )
+            for consignment_reservation in ConsignmentConflictSerializer(consignment_reservations, many=True).data:
+                serialized[Booking(CONSIGNMENT, consignment_reservation['id'])] = consignment_reservation
 
         return Response({
             'success': True,
             'make': vehicle.make,
             'model': vehicle.model,
-            'conflicts': serializer.data
+            'conflicts': [serialized[conflict.booking] for conflict in conflicts if conflict.booking in serialized],
         })
 
 
+# Every vehicle's bookings from start_date (YYYY-MM-DD, default today) for the given number of days (default 30, at
+# most FleetSchedule.MAX_DAYS), laid out in lanes for the backoffice schedule board
+class FleetScheduleView(APIView):
+
+    authentication_classes = (SessionAuthentication,)
+    permission_classes = (HasReservationsAccess,)
+
+    def get(self, request):
+        try:
+            schedule = FleetSchedule.from_params(request.GET.get('start_date'), request.GET.get('days'))
+        except ValueError as e:
+            return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, **schedule.as_dict()})
+
+
 class SendInsuranceAuthView(APIView):
     template_name = 'pdf/info_auth.html'
     authentication_classes = (SessionAuthentication,)
@@ -835,12 +986,7 @@ class SendInsuranceAuthView(APIView):
             "enable-local-file-access": "",
         }
 
-        kwargs = {}
-        wkhtmltopdf_bin = os.environ.get('WKHTMLTOPDF_BIN')
-        if wkhtmltopdf_bin:
-            kwargs['configuration'] = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_bin)
-
-        pdf = pdfkit.from_string(html, False, options, **kwargs)
+        pdf = html_to_pdf(html, options)
 
         attachments = []
         attachments.append({'filename': 'PRI-infoauth.pdf', 'content': pdf, 'mimetype': 'application/pdf'})
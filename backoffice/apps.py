@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BackofficeConfig(AppConfig):
     name = 'backoffice'
+
+    def ready(self):
+        # Register signal receivers
+        from backoffice import signals  # noqa: F401
@@ -0,0 +1,137 @@
+# Counts behind the backoffice menu badges, materialized in MenuCounter rows so a page render reads them with a single
+# query. Most counts are of rows matching a fixed filter (e.g. unpaid gift certificates); backoffice.signals adjusts
+# these by +1/-1 as rows move in and out of the filter. The unconfirmed reservations count also depends on the time,
+# and the to-do item count on each open rental's customer, so those are recounted (with one aggregate query) when a
+# relevant field changes. Counters found missing or past their valid_until are recounted on read;
+# refresh_menu_counters rebuilds them all (e.g. after bulk updates, which skip signals).
+
+from typing import NamedTuple
+
+from django.db.models import Count, F, Min, Q
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from backoffice.models import MenuCounter
+from sales.models import Reservation, Rental, PerformanceExperience, JoyRide, GiftCertificate, AdHocPayment
+from service.models import ScheduledService, Damage
+
+RESERVATIONS = 'reservations'
+TODO_ITEMS = 'todo_items'
+
+OPEN_RENTAL_STATUSES = (Rental.Status.INCOMPLETE, Rental.Status.CONFIRMED, Rental.Status.IN_PROGRESS)
+
+# Rentals with at least one to-do item (see Rental.todo_item_count)
+TODO_RENTALS_FILTER = (
+    Q(status__in=OPEN_RENTAL_STATUSES)
+    | Q(status=Rental.Status.COMPLETE, deposit_refunded_at__isnull=True)
+)
+
+# Customer.license_history is encrypted as a 16-byte nonce and 16-byte tag followed by ciphertext as long as the text,
+# so an empty history is stored as 32 bytes
+EMPTY_ENCRYPTED_LENGTH = 32
+
+
+class FilterCounter(NamedTuple):
+    name: str
+    model: type
+    filters: dict
+
+    def get_queryset(self):
+        return self.model.objects.filter(**self.filters)
+
+    def matches(self, instance) -> bool:
+        # Whether instance passes filters, which are exact or __in lookups on concrete fields
+        for lookup, value in self.filters.items():
+            field, _, operator = lookup.partition('__')
+            if operator == 'in':
+                if getattr(instance, field) not in value:
+                    return False
+            elif getattr(instance, field) != value:
+                return False
+        return True
+
+    @property
+    def fields(self) -> set:
+        return {lookup.partition('__')[0] for lookup in self.filters}
+
+
+FILTER_COUNTERS = (
+    FilterCounter('rentals', Rental, {'status__in': OPEN_RENTAL_STATUSES}),
+    FilterCounter('performance_experiences', PerformanceExperience, {'status': PerformanceExperience.Status.PENDING}),
+    FilterCounter('joy_rides', JoyRide, {'status': JoyRide.Status.PENDING}),
+    FilterCounter('maintenances', ScheduledService, {'is_due': True}),
+    FilterCounter('damages', Damage, {'is_repaired': False}),
+    FilterCounter('gift_certificates', GiftCertificate, {'is_paid': False}),
+    FilterCounter('adhoc_payments', AdHocPayment, {'is_paid': False, 'is_submitted': True}),
+)
+
+COUNTER_NAMES = (RESERVATIONS, TODO_ITEMS) + tuple(counter.name for counter in FILTER_COUNTERS)
+
+
+def get_todo_list_rentals():
+    return Rental.objects.filter(TODO_RENTALS_FILTER).select_related('customer')
+
+
+def count_todo_items() -> int:
+    # The sum of Rental.todo_item_count over the to-do list, in SQL
+    needs_customer_check = Q(status__in=OPEN_RENTAL_STATUSES, customer__isnull=False)
+    todo_items = Rental.objects.filter(TODO_RENTALS_FILTER).alias(
+        license_history_length=Length('customer__license_history'),
+    ).aggregate(
+        deposit_charged=Count('id', filter=Q(status=Rental.Status.CONFIRMED, deposit_charged_at__isnull=True)),
+        deposit_refunded=Count('id', filter=Q(status=Rental.Status.COMPLETE, deposit_refunded_at__isnull=True)),
+        insurance_verified=Count('id', filter=needs_customer_check & Q(customer__coverage_verified=False)),
+        background_check=Count(
+            'id', filter=needs_customer_check & Q(license_history_length__lte=EMPTY_ENCRYPTED_LENGTH),
+        ),
+    )
+    return sum(todo_items.values())
+
+
+def count(name: str) -> tuple:
+    # Counts from scratch, returning (count, valid_until)
+    if name == RESERVATIONS:
+        now = timezone.now()
+        reservations = Reservation.objects.filter(status=Reservation.Status.UNCONFIRMED, out_at__gt=now).aggregate(
+            count=Count('id'), valid_until=Min('out_at'),
+        )
+        return reservations['count'], reservations['valid_until']
+    if name == TODO_ITEMS:
+        return count_todo_items(), None
+    counter = next(counter for counter in FILTER_COUNTERS if counter.name == name)
+    return counter.get_queryset().count(), None
+
+
+def refresh(name: str) -> int:
+    value, valid_until = count(name)
+    MenuCounter.objects.update_or_create(name=name, defaults={'count': value, 'valid_until': valid_until})
+    return value
+
+
+def recount(name: str) -> None:
+    # Like adjust(), leaves a counter without a row yet for get_menu_counts() to count
+    if MenuCounter.objects.filter(name=name).exists():
+        value, valid_until = count(name)
+        MenuCounter.objects.filter(name=name).update(count=value, valid_until=valid_until)
+
+
+def refresh_all() -> dict:
+    return {name: refresh(name) for name in COUNTER_NAMES}
+
+
+def adjust(name: str, delta: int) -> None:
+    # A counter without a row yet is left for get_menu_counts() to count
+    if delta:
+        MenuCounter.objects.filter(name=name).update(count=F('count') + delta)
+
+
+def get_menu_counts() -> dict:
+    now = timezone.now()
+    counts = {}
+    for name, value, valid_until in MenuCounter.objects.values_list('name', 'count', 'valid_until'):
+        if valid_until is None or valid_until > now:
+            counts[name] = value
+    for name in COUNTER_NAMES:
+        if name not in counts:
+            counts[name] = refresh(name)
+    return counts
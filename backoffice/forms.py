@@ -17,6 +17,7 @@ from sales.models import (
     Reservation, Rental, GuidedDrive, JoyRide, PerformanceExperience, Coupon, TaxRate, GiftCertificate, AdHocPayment,
     Charge, Card, RedFlag, IPBan
 )
+from sales.availability import availability_index, Booking, BLOCKING_KINDS, RESERVATION, RENTAL
 from sales.enums import (
     TRUE_FALSE_CHOICES, DELIVERY_REQUIRED_CHOICES, birth_years, operational_years, get_service_hours,
     current_year, get_exp_year_choices, get_exp_month_choices, get_vehicle_choices, get_extra_miles_choices
@@ -240,6 +241,31 @@ class ReservationDateTimeMixin(forms.ModelForm):
             back_at_time,
         ).astimezone(pytz.timezone(settings.TIME_ZONE))
 
+    def clean_availability(self):
+        # A new vehicle or new dates must not overlap a rental or consigner reservation of the vehicle; bookings which
+        # already overlap are left to be sorted out by whoever is editing them
+        vehicle = self.cleaned_data.get('vehicle')
+        out_at = self.cleaned_data.get('out_at')
+        back_at = self.cleaned_data.get('back_at')
+        if not (vehicle and out_at and back_at):
+            return
+        if isinstance(self.instance, Rental) and self.cleaned_data.get('status') == Rental.Status.CANCELLED:
+            return
+        instance = self.instance
+        exclude = ()
+        if instance.pk:
+            if (vehicle.id, out_at, back_at) == (instance.vehicle_id, instance.out_at, instance.back_at):
+                return
+            exclude = (Booking(RESERVATION, instance.pk), Booking(RENTAL, instance.pk))
+        conflicts = availability_index.get_conflicts(
+            vehicle.id, out_at, back_at, kinds=BLOCKING_KINDS, exclude=exclude, confirm=True,
+        )
+        if conflicts:
+            raise forms.ValidationError(
+                f'The vehicle is not available for these dates; they overlap '
+                f'{", ".join(conflict.booking.label for conflict in conflicts)}.'
+            )
+
 
 class ReservationForm(ReservationDateTimeMixin, CSSClassMixin, CustomerSearchMixin, forms.ModelForm):
     short_fields = ('drivers', 'delivery_zip', 'tax_percent', 'miles_included', 'coupon_code',)
@@ -287,6 +313,7 @@ class ReservationForm(ReservationDateTimeMixin, CSSClassMixin, CustomerSearchMix
 
         if self.cleaned_data['back_at'] < self.cleaned_data['out_at']:
             raise forms.ValidationError('Return date/time is earlier than out date/time.')
+        self.clean_availability()
 
     class Meta:
         model = Reservation
@@ -363,6 +390,7 @@ class RentalForm(ReservationDateTimeMixin, CSSClassMixin, forms.ModelForm):
         super().clean()
         self.cleaned_data['deposit_charged_at'] = self.cleaned_data['deposit_charged_on']
         self.cleaned_data['deposit_refunded_at'] = self.cleaned_data['deposit_refunded_on']
+        self.clean_availability()
 
     class Meta:
         model = Rental
@@ -0,0 +1,61 @@
+import logging
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from sales.models import BaseReservation, JoyRide, PerformanceExperience
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Copies the revenue amounts in final_price_data to the revenue columns (final_subtotal etc.) for rows priced before
+    those columns existed, or changed with bulk updates which skipped save(). Only the columns are written; nothing is
+    repriced (use the reprice command for that). Rows whose columns already match are left alone, so it's safe to rerun.
+    """
+
+    help = 'Fill in the revenue columns from final_price_data.'
+
+    CHUNK_SIZE = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+        parser.add_argument('--chunk_size', dest='chunk_size', default=self.CHUNK_SIZE, type=int,)
+
+    def handle(self, *args, **options):
+        self.dry_run = options.get('dry_run')
+        self.chunk_size = options.get('chunk_size')
+
+        for model_class in (BaseReservation, JoyRide, PerformanceExperience):
+            self.backfill(model_class)
+
+        if self.dry_run:
+            self.stdout.write('Dry run; no changes were saved.')
+
+    def backfill(self, model_class):
+        revenue_fields = list(model_class.revenue_fields)
+        scanned = changed = 0
+        rows = model_class.objects.only('id', 'final_price_data', *revenue_fields).order_by('pk').iterator(
+            chunk_size=self.chunk_size,
+        )
+        while chunk := list(islice(rows, self.chunk_size)):
+            changed_instances = []
+            for instance in chunk:
+                scanned += 1
+                loaded_values = [getattr(instance, field) for field in revenue_fields]
+                instance.set_revenue_fields()
+                if [getattr(instance, field) for field in revenue_fields] != loaded_values:
+                    changed_instances.append(instance)
+            changed += len(changed_instances)
+            if changed_instances and not self.dry_run:
+                # bulk_update() skips auto_now, so updated_at is set here for the revenue rollups to pick up
+                updated_at = timezone.now()
+                for instance in changed_instances:
+                    instance.updated_at = updated_at
+                with transaction.atomic():
+                    model_class.objects.bulk_update(changed_instances, [*revenue_fields, 'updated_at'])
+
+        self.stdout.write(f'{model_class._meta.verbose_name_plural}: {scanned} scanned, {changed} changed')
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+
+class Command(BaseCommand):
+    """
+    Times requests for a page through the MIDDLEWARE stack using the test client, first with no middleware and then
+    adding one layer at a time, so the difference between successive runs is what each layer costs. Each stack is
+    timed as the best of --runs rounds of --requests requests. Run against a development database; the page should be
+    one which doesn't write (the consignment login page by default).
+    """
+
+    help = 'Report the per-request cost of each layer of the middleware stack.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', dest='requests', type=int, default=200,)
+        parser.add_argument('--runs', dest='runs', type=int, default=5,)
+        parser.add_argument('--path', dest='path', default=None,)
+
+    def time_stack(self, middleware, path, num_requests, runs):
+        # Microseconds per request through the given middleware, best of runs
+        with override_settings(MIDDLEWARE=middleware, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            client = Client()
+            client.get(path)
+            timings = []
+            for run in range(runs):
+                started_at = time.perf_counter()
+                for request in range(num_requests):
+                    client.get(path)
+                timings.append((time.perf_counter() - started_at) / num_requests * 1000000)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        path = options.get('path') or reverse('consignment:login')
+        num_requests, runs = options.get('requests'), options.get('runs')
+        middleware = list(settings.MIDDLEWARE)
+
+        baseline = previous = self.time_stack([], path, num_requests, runs)
+        self.stdout.write(f'{"(none)":<60} {baseline:>10.1f} us')
+        for index, layer in enumerate(middleware, start=1):
+            total = self.time_stack(middleware[:index], path, num_requests, runs)
+            self.stdout.write(f'{layer:<60} {total:>10.1f} us {total - previous:>+10.1f} us')
+            previous = total
+        self.stdout.write(f'{len(middleware)} middleware add {previous - baseline:.1f} us per request to {path}.')
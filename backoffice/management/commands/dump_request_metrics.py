@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from pri.metrics import request_metrics, to_prometheus, get_summary, get_service_summary
+
+
+class Command(BaseCommand):
+    """
+    Prints the per-route request metrics published by the app processes (see pri.metrics), merged: by default a table
+    of per-request averages, the routes taking the most time in total first, followed by the calls made to each
+    third-party service, or with --prometheus the text served by the backoffice metrics endpoint. Metrics reach the
+    cache every REQUEST_METRICS_PUBLISH_SECS, so the latest requests may be missing.
+    """
+
+    help = 'Dump the per-route request metrics of the app processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prometheus', dest='prometheus', default=False, action='store_true',)
+        parser.add_argument('--limit', dest='limit', type=int, default=None,)
+
+    def handle(self, *args, **options):
+        snapshot = request_metrics.get_all()
+        if options.get('prometheus'):
+            self.stdout.write(to_prometheus(snapshot), ending='')
+            return
+
+        rows = get_summary(snapshot)[:options.get('limit')]
+        self.stdout.write(
+            f'{"Route":<50} {"Requests":>9} {"Total s":>9} {"Mean ms":>9} {"Queries":>8} {"SQL ms":>9} '
+            f'{"Tmpl ms":>9} {"Ext ms":>9} {"Cache hit":>9}'
+        )
+        for row in rows:
+            cache_hit = f'{row["cache_hit_pct"]:.0f}%' if row['cache_hit_pct'] is not None else '-'
+            self.stdout.write(
+                f'{row["route"]:<50} {row["requests"]:>9} {row["total_secs"]:>9.1f} {row["duration_ms"]:>9.1f} '
+                f'{row["queries"]:>8.1f} {row["query_ms"]:>9.1f} {row["template_ms"]:>9.1f} '
+                f'{row["outbound_ms"]:>9.1f} {cache_hit:>9}'
+            )
+        self.stdout.write(f'{len(rows)} routes.')
+
+        services = get_service_summary(snapshot)
+        if services:
+            self.stdout.write('')
+            self.stdout.write(f'{"Service":<50} {"Calls":>9} {"Total s":>9} {"Mean ms":>9} {"Errors":>8}')
+            for row in services:
+                self.stdout.write(
+                    f'{row["service"]:<50} {row["calls"]:>9} {row["total_secs"]:>9.1f} {row["duration_ms"]:>9.1f} '
+                    f'{row["errors"]:>8}'
+                )
@@ -0,0 +1,133 @@
+import csv
+import decimal
+import json
+import logging
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.timezone import now
+
+from sales.models import TaxRate
+from sales.tax_rates import bump_tax_rate_version, bump_tax_rate_values_version, tax_rate_table
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Loads a full ZIP-to-rate table in one transaction, creating and updating TaxRate rows in bulk. Imported rates are
+    stamped as current, so they are served as they are until they age past TaxRate.MAX_AGE_DAYS; reconcile them with
+    Avalara in a batch with the refresh_tax_rates command.
+
+    Accepts CSV with a header row, with the ZIP in a postal_code, zip, zip_code or zipcode column and the rate (as a
+    fraction, e.g. 0.06625) in a total_rate, rate or estimated_combined_rate column (Avalara's downloadable rate tables
+    use ZipCode and EstimatedCombinedRate); or JSON, either a list of {"postal_code": ..., "total_rate": ...} objects or
+    a single {zip: rate} object.
+    """
+
+    help = 'Bulk import ZIP tax rates from a CSV or JSON file.'
+
+    POSTAL_CODE_COLUMNS = ('postal_code', 'zip', 'zip_code', 'zipcode')
+    TOTAL_RATE_COLUMNS = ('total_rate', 'rate', 'estimated_combined_rate', 'estimatedcombinedrate')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',)
+        parser.add_argument('--format', dest='format', default=None, choices=('csv', 'json'),)
+        parser.add_argument('--country', dest='country', default='us',)
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        file_format = options.get('format') or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in ('csv', 'json'):
+            raise CommandError('Cannot tell the file format from its extension; use --format.')
+
+        rates = {}
+        with open(path, newline='') as f:
+            rows = self.read_csv(f) if file_format == 'csv' else self.read_json(f)
+            for line, (postal_code, total_rate) in enumerate(rows, start=1):
+                rates[self.clean_postal_code(postal_code, line)] = self.clean_total_rate(total_rate, line)
+
+        updated_at = now()
+        existing = TaxRate.objects.in_bulk(rates.keys(), field_name='postal_code')
+        to_create, to_update = [], []
+        unchanged = 0
+        for postal_code, total_rate in rates.items():
+            tax_rate = existing.get(postal_code)
+            if not tax_rate:
+                to_create.append(TaxRate(
+                    postal_code=postal_code,
+                    country=options.get('country'),
+                    total_rate=total_rate,
+                    date_updated=updated_at,
+                ))
+                continue
+            if tax_rate.total_rate == total_rate:
+                unchanged += 1
+            tax_rate.total_rate = total_rate
+            tax_rate.date_updated = updated_at
+            to_update.append(tax_rate)
+
+        self.stdout.write(
+            f'{len(rates)} ZIPs read: {len(to_create)} new, {len(to_update) - unchanged} changed, {unchanged} unchanged.'
+        )
+        if options.get('dry_run'):
+            self.stdout.write('Dry run; no changes were saved.')
+            return
+
+        # bulk_create() and bulk_update() skip TaxRate.save() and its signals, so the in-memory rate table and cached
+        # quotes are invalidated here instead
+        with transaction.atomic():
+            TaxRate.objects.bulk_create(to_create, batch_size=1000)
+            TaxRate.objects.bulk_update(to_update, ['total_rate', 'date_updated'], batch_size=1000)
+        tax_rate_table.invalidate()
+        bump_tax_rate_version()
+        bump_tax_rate_values_version()
+
+    def read_csv(self, f):
+        reader = csv.DictReader(f)
+        columns = {self.normalize_column(column): column for column in reader.fieldnames or []}
+        postal_code_column = next((columns[c] for c in self.POSTAL_CODE_COLUMNS if c in columns), None)
+        total_rate_column = next((columns[c] for c in self.TOTAL_RATE_COLUMNS if c in columns), None)
+        if not postal_code_column or not total_rate_column:
+            raise CommandError('CSV needs a ZIP column and a rate column; see the command help.')
+        for row in reader:
+            yield row[postal_code_column], row[total_rate_column]
+
+    @staticmethod
+    def read_json(f):
+        try:
+            data = json.load(f, parse_float=decimal.Decimal)
+        except json.JSONDecodeError as e:
+            raise CommandError(f'Invalid JSON: {e}')
+        if isinstance(data, dict):
+            return list(data.items())
+        try:
+            return [(row['postal_code'], row['total_rate']) for row in data]
+        except (KeyError, TypeError):
+            raise CommandError('JSON must be a {zip: rate} object or a list of {"postal_code", "total_rate"} objects.')
+
+    @staticmethod
+    def normalize_column(column):
+        return column.strip().lower().replace(' ', '_')
+
+    @staticmethod
+    def clean_postal_code(postal_code, line):
+        postal_code = str(postal_code).strip()
+        # Spreadsheets tend to drop the leading zeros of east coast ZIPs
+        if postal_code.isdigit() and len(postal_code) < 5:
+            postal_code = postal_code.zfill(5)
+        if not (len(postal_code) == 5 and postal_code.isdigit()):
+            raise CommandError(f'Row {line}: invalid ZIP {postal_code!r}.')
+        return postal_code
+
+    @staticmethod
+    def clean_total_rate(total_rate, line):
+        try:
+            total_rate = decimal.Decimal(str(total_rate).strip())
+        except decimal.InvalidOperation:
+            raise CommandError(f'Row {line}: invalid rate {total_rate!r}.')
+        if not 0 <= total_rate < 1:
+            raise CommandError(f'Row {line}: rate {total_rate} is not a fraction between 0 and 1.')
+        return total_rate.quantize(decimal.Decimal('0.00001'))
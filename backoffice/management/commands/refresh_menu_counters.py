@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from backoffice.counters import refresh_all
+
+
+class Command(BaseCommand):
+    """
+    Recounts every backoffice menu counter from scratch. Signals keep the counters current as rows are saved and
+    deleted, but queryset update() and bulk_update() skip them; run this after such bulk changes (or on deploy).
+    """
+
+    help = 'Recount the backoffice menu badge counts.'
+
+    def handle(self, *args, **options):
+        for name, value in refresh_all().items():
+            self.stdout.write(f'{name}: {value}')
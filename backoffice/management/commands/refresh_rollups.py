@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from backoffice.rollups import refresh_rollups
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the monthly revenue and utilization rollups for the months touched since the last run: those with a
+    booking created (reserved_at/created_at) or updated (updated_at) since the watermark, and those marked stale by a
+    booking being deleted or moved. The first run, or --full, rebuilds every month with bookings. Meant to run on a
+    schedule, e.g. hourly from cron.
+    """
+
+    help = 'Refresh the monthly revenue and utilization rollups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', dest='full', default=False, action='store_true',)
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+
+    def handle(self, *args, **options):
+        months = refresh_rollups(full=options.get('full'), dry_run=options.get('dry_run'))
+        if options.get('verbosity') >= 2:
+            for month in months:
+                self.stdout.write(month.strftime('%Y-%m'))
+        if options.get('dry_run'):
+            self.stdout.write(f'Dry run; {len(months)} months would be refreshed.')
+        else:
+            self.stdout.write(f'{len(months)} months refreshed.')
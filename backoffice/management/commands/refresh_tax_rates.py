@@ -0,0 +1,71 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from sales.models import TaxRate
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Fetches tax rates from Avalara for the given ZIPs, or for every stored ZIP whose rate is missing or stale (all of
+    them with --all). Requests are made concurrently from a thread pool, all sharing one AvataxClient.
+    """
+
+    help = 'Refresh tax rates from Avalara.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('zips', nargs='*',)
+        parser.add_argument('--all', dest='all', default=False, action='store_true',)
+        parser.add_argument('--workers', dest='workers', default=settings.TAX_RATE_REFRESH_WORKERS, type=int,)
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+
+    def handle(self, *args, **options):
+        tax_zips = options.get('zips')
+        if not tax_zips:
+            tax_rates = TaxRate.objects.exclude(postal_code='').order_by('postal_code')
+            if not options.get('all'):
+                tax_rates = [tax_rate for tax_rate in tax_rates if tax_rate.is_stale]
+            tax_zips = [tax_rate.postal_code for tax_rate in tax_rates]
+
+        if options.get('dry_run'):
+            for tax_zip in tax_zips:
+                self.stdout.write(tax_zip)
+            self.stdout.write(f'{len(tax_zips)} tax rates would be refreshed.')
+            return
+
+        client = TaxRate.get_avatax_client()
+        refreshed = failed = 0
+        with ThreadPoolExecutor(max_workers=options.get('workers')) as executor:
+            futures = {
+                executor.submit(self.refresh, tax_zip, client): tax_zip for tax_zip in tax_zips
+            }
+            for future in as_completed(futures):
+                tax_zip = futures[future]
+                try:
+                    tax_rate, is_successful = future.result()
+                except Exception:
+                    logger.exception(f'Failed to refresh tax rate for {tax_zip}')
+                    is_successful = False
+                if not is_successful:
+                    self.stderr.write(f'{tax_zip}: Avalara lookup failed')
+                    failed += 1
+                    continue
+                refreshed += 1
+                if options.get('verbosity') >= 2:
+                    self.stdout.write(f'{tax_zip}: {tax_rate.total_rate}')
+
+        self.stdout.write(f'{refreshed} tax rates refreshed, {failed} failed.')
+
+    @staticmethod
+    def refresh(tax_zip, client):
+        # Runs in a pool thread, which has its own DB connection to close when done
+        try:
+            tax_rate = TaxRate.objects.filter(postal_code=tax_zip).first() or TaxRate(postal_code=tax_zip)
+            return tax_rate, tax_rate.update(client=client)
+        finally:
+            close_old_connections()
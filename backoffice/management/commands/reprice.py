@@ -0,0 +1,121 @@
+import datetime
+import logging
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from fleet.models import Vehicle, VehicleMarketing
+from sales.calculators import PricingContext
+from sales.models import Reservation, Rental, JoyRide, PerformanceExperience
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Recomputes final_price_data for reservations, rentals, joy rides and performance experiences, e.g. after a change
+    to the pricing rules. Every vehicle price is loaded into one PricingContext up front (promotions, coupons and tax
+    rates come from in-memory indexes), and rows are streamed and written back in chunks with bulk_update() (skipping
+    save() and its per-row lookups), so the job runs in a handful of queries per chunk however many rows there are.
+    """
+
+    help = 'Recompute final_price_data for reservations, rentals, joy rides and performance experiences.'
+
+    CHUNK_SIZE = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+        parser.add_argument('--start_date', dest='start_date', default=None, help='YYYY-MM-DD, inclusive',)
+        parser.add_argument('--end_date', dest='end_date', default=None, help='YYYY-MM-DD, inclusive',)
+        parser.add_argument('--chunk_size', dest='chunk_size', default=self.CHUNK_SIZE, type=int,)
+
+    def handle(self, *args, **options):
+        self.dry_run = options.get('dry_run')
+        self.verbosity = options.get('verbosity')
+        self.chunk_size = options.get('chunk_size')
+        self.start_date = self.parse_date(options.get('start_date'))
+        self.end_date = self.parse_date(options.get('end_date'))
+
+        self.pricing_context = PricingContext()
+        self.pricing_context.preload_vehicle_marketing(
+            Vehicle.objects.filter(vehicle_marketing_id__isnull=False).values_list('vehicle_marketing_id', flat=True)
+        )
+
+        for model_class, date_field in (
+            (Reservation, 'out_at__date'),
+            (Rental, 'out_at__date'),
+            (JoyRide, 'requested_date'),
+            (PerformanceExperience, 'requested_date'),
+        ):
+            self.reprice(model_class, date_field)
+
+        if self.dry_run:
+            self.stdout.write('Dry run; no changes were saved.')
+
+    @staticmethod
+    def parse_date(value):
+        if not value:
+            return None
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            raise CommandError(f'Invalid date {value}; use YYYY-MM-DD.')
+
+    def get_queryset(self, model_class, date_field):
+        queryset = model_class.objects.filter(customer__isnull=False).select_related('customer__user')
+        if date_field == 'out_at__date':
+            queryset = queryset.filter(vehicle__isnull=False).select_related('vehicle')
+        if self.start_date:
+            queryset = queryset.filter(**{f'{date_field}__gte': self.start_date})
+        if self.end_date:
+            queryset = queryset.filter(**{f'{date_field}__lte': self.end_date})
+        return queryset.order_by('pk')
+
+    def reprice(self, model_class, date_field):
+        scanned = changed = skipped = 0
+        total_delta = 0
+        rows = self.get_queryset(model_class, date_field).iterator(chunk_size=self.chunk_size)
+        while chunk := list(islice(rows, self.chunk_size)):
+            changed_instances = []
+            for instance in chunk:
+                scanned += 1
+                old_price_data = instance.final_price_data or {}
+                try:
+                    price_data = instance.reprice(pricing_context=self.pricing_context, commit=False)
+                except (VehicleMarketing.DoesNotExist, TypeError, ValueError) as e:
+                    # Incomplete rows (no vehicle marketing, no dates, etc.) are left alone, as save() would choke on them
+                    logger.warning(f'Skipping {model_class.__name__} {instance.id}: {e!r}')
+                    skipped += 1
+                    continue
+                changed_keys = sorted(
+                    key for key in set(old_price_data) | set(price_data)
+                    if old_price_data.get(key) != price_data.get(key)
+                )
+                if not changed_keys:
+                    continue
+                old_total = float(old_price_data.get('total_with_tax') or 0)
+                new_total = float(price_data['total_with_tax'])
+                total_delta += new_total - old_total
+                if self.verbosity >= 2:
+                    self.stdout.write(
+                        f'{model_class.__name__} {instance.id} ({instance.confirmation_code}): '
+                        f'total_with_tax {old_total:.2f} -> {new_total:.2f}; changed {", ".join(changed_keys)}'
+                    )
+                changed_instances.append(instance)
+            changed += len(changed_instances)
+            if changed_instances and not self.dry_run:
+                with transaction.atomic():
+                    # bulk_update() skips auto_now, so updated_at is set here for the revenue rollups to pick up
+                    updated_at = timezone.now()
+                    for instance in changed_instances:
+                        instance.updated_at = updated_at
+                    model_class.objects.bulk_update(
+                        changed_instances, ['final_price_data', *model_class.revenue_fields, 'updated_at'],
+                    )
+
+        self.stdout.write(
+            f'{model_class._meta.verbose_name_plural}: {scanned} scanned, {changed} changed, {skipped} skipped; '
+            f'total_with_tax delta {total_delta:+.2f}'
+        )
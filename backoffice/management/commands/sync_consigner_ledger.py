@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from consignment.ledger import sync_all
+
+
+class Command(BaseCommand):
+    """
+    Posts to the consigner ledger whatever completed rentals and consignment payments are owed but haven't had posted,
+    and corrections for any posted wrongly; existing rows are never changed. Run once to backfill the ledger (rows then
+    come out in date order), and after bulk updates to rentals or payments, which skip the signals keeping it current.
+    """
+
+    help = 'Bring the consigner ledger up to date with rentals and consignment payments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry_run', dest='dry_run', default=False, action='store_true',)
+
+    def handle(self, *args, **options):
+        postings = sync_all(dry_run=options.get('dry_run'))
+        if options.get('verbosity') >= 2:
+            for transacted_at, entry_type, link_id, consigner_id, amount in postings:
+                self.stdout.write(
+                    f'{transacted_at:%Y-%m-%d} consigner {consigner_id}: {entry_type.label} {link_id}, {amount}'
+                )
+        if options.get('dry_run'):
+            self.stdout.write(f'Dry run; {len(postings)} ledger entries would be posted.')
+        else:
+            self.stdout.write(f'{len(postings)} ledger entries posted.')
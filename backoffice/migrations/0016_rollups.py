@@ -0,0 +1,65 @@
+# Generated by Django 4.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleet', '0048_auto_20220109_2252'),
+        ('backoffice', '0015_menucounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('watermark', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StaleRollupMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceMonthlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_type', models.CharField(choices=[('rental', 'Rental'), ('perfexp', 'Performance Experience'), ('joyride', 'Joy Ride'), ('giftcert', 'Gift Certificate'), ('subpay', 'Ad-hoc Payment')], max_length=20)),
+                ('month', models.DateField()),
+                ('num_bookings', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+                ('discount_total', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+                ('rental_days', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('utilization_pct', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+            ],
+            options={
+                'ordering': ('month', 'service_type'),
+                'unique_together': {('service_type', 'month')},
+            },
+        ),
+        migrations.CreateModel(
+            name='VehicleMonthlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('num_rentals', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+                ('discount_total', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+                ('rental_days', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('utilization_pct', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='fleet.vehicle')),
+            ],
+            options={
+                'ordering': ('month', 'vehicle'),
+                'unique_together': {('vehicle', 'month')},
+            },
+        ),
+    ]
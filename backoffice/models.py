@@ -1,6 +1,8 @@
 from django.utils import timezone
 from django.db import models
 
+from sales.enums import ServiceType
+
 
 # class Employee(models.Model):
 #     pass
@@ -29,6 +31,66 @@ class BBSPost(models.Model):
         ordering = ('-reply_to__id', 'id',)
 
 
+# Materialized count behind one of the backoffice menu badges (see backoffice.counters), kept up to date by signals so
+# page renders read the counts instead of querying for them. valid_until is set for counts which go stale with time
+# alone, such as reservations dropping off once their out time passes.
+class MenuCounter(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    count = models.IntegerField(default=0)
+    valid_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name}: {self.count}'
+
+
+# Monthly revenue and utilization rollups for reports, maintained by the refresh_rollups command (see backoffice.rollups).
+# Months are identified by their first day. Revenue and discounts are credited to the month a booking starts in; rental
+# days are split between the months a rental spans.
+
+class VehicleMonthlyRollup(models.Model):
+    vehicle = models.ForeignKey('fleet.Vehicle', on_delete=models.CASCADE)
+    month = models.DateField()
+    num_rentals = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+    discount_total = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+    rental_days = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    utilization_pct = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('vehicle', 'month',)
+        ordering = ('month', 'vehicle',)
+
+
+class ServiceMonthlyRollup(models.Model):
+    service_type = models.CharField(max_length=20, choices=ServiceType.choices)
+    month = models.DateField()
+    num_bookings = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+    discount_total = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+    rental_days = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    utilization_pct = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('service_type', 'month',)
+        ordering = ('month', 'service_type',)
+
+
+# How far refresh_rollups has got: bookings created or updated since watermark are reprocessed on the next run, along
+# with any StaleRollupMonth (months which lost a booking through a delete or a change of dates)
+class RollupWatermark(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    watermark = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name}: {self.watermark}'
+
+
+class StaleRollupMonth(models.Model):
+    month = models.DateField(unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 # vehicles
 # class Vehicle(models.Model):
 #
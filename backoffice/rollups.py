@@ -0,0 +1,211 @@
+# Monthly revenue and utilization rollups (VehicleMonthlyRollup and ServiceMonthlyRollup), so reports read one row per
+# vehicle or service type per month rather than scanning bookings. A month is always rebuilt as a whole, from the
+# revenue columns on its bookings (see PricingInputsMixin.revenue_fields); refresh_rollups finds the months to rebuild
+# from bookings created or updated since the last run, plus months marked stale when a booking left them.
+
+import datetime
+import decimal
+from collections import defaultdict
+
+import pytz
+from dateutil.relativedelta import relativedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from backoffice.models import VehicleMonthlyRollup, ServiceMonthlyRollup, RollupWatermark, StaleRollupMonth
+from fleet.models import Vehicle
+from sales.enums import ServiceType
+from sales.models import Rental, JoyRide, PerformanceExperience
+
+ROLLUP_WATERMARK_NAME = 'revenue_rollups'
+
+# Rows saved in a transaction which commits after a run starts can carry an updated_at from before it; rescanning this
+# far back from the watermark picks them up at the cost of rebuilding a few months twice
+ROLLUP_WATERMARK_OVERLAP = datetime.timedelta(minutes=10)
+
+ZERO = decimal.Decimal('0')
+CENTS = decimal.Decimal('0.01')
+SECONDS_PER_DAY = 86400
+
+
+def get_timezone():
+    return pytz.timezone(settings.TIME_ZONE)
+
+
+def get_month(value) -> datetime.date:
+    # First day of the (local) month of a date or datetime
+    if isinstance(value, datetime.datetime):
+        value = value.astimezone(get_timezone()).date()
+    return value.replace(day=1)
+
+
+def get_months(start, end) -> list:
+    # Every month from that of start to that of end
+    months = []
+    month, last_month = get_month(start), get_month(end)
+    while month <= last_month:
+        months.append(month)
+        month += relativedelta(months=1)
+    return months
+
+
+def get_month_bounds(month: datetime.date) -> tuple:
+    tz = get_timezone()
+    start = tz.localize(datetime.datetime.combine(month, datetime.time.min))
+    end = tz.localize(datetime.datetime.combine(month + relativedelta(months=1), datetime.time.min))
+    return start, end
+
+
+def get_booking_months(instance) -> set:
+    # The months a rental spans, or a guided drive's month
+    if isinstance(instance, Rental):
+        if instance.out_at and instance.back_at:
+            return set(get_months(instance.out_at, instance.back_at))
+        return set()
+    return {get_month(instance.requested_date)} if instance.requested_date else set()
+
+
+def mark_stale(months) -> None:
+    if months:
+        StaleRollupMonth.objects.bulk_create(
+            [StaleRollupMonth(month=month) for month in months], ignore_conflicts=True,
+        )
+
+
+def get_rental_days(out_at, back_at, start, end) -> decimal.Decimal:
+    # Days of the rental falling between start and end
+    overlap = (min(back_at, end) - max(out_at, start)).total_seconds()
+    return decimal.Decimal(max(overlap, 0) / SECONDS_PER_DAY)
+
+
+def get_fleet_size(month: datetime.date) -> int:
+    # Vehicles in the fleet for at least part of the month
+    next_month = month + relativedelta(months=1)
+    return Vehicle.objects.filter(
+        Q(acquired_on__isnull=True) | Q(acquired_on__lt=next_month),
+        Q(relinquished_on__isnull=True) | Q(relinquished_on__gte=month),
+    ).count()
+
+
+def build_month(month: datetime.date) -> tuple:
+    """
+    Computes the rollups for month, returning unsaved (vehicle rollups, service rollups). Rentals other than cancelled
+    ones count, and guided drives other than cancelled ones.
+    """
+    start, end = get_month_bounds(month)
+    days_in_month = decimal.Decimal((end - start).total_seconds() / SECONDS_PER_DAY)
+
+    vehicle_rollups = {}
+    rentals = Rental.objects.filter(
+        vehicle__isnull=False, out_at__lt=end, back_at__gt=start,
+    ).exclude(status=Rental.Status.CANCELLED)
+    for vehicle_id, out_at, back_at, subtotal, discount in rentals.values_list(
+        'vehicle_id', 'out_at', 'back_at', 'final_subtotal', 'final_discount',
+    ):
+        rollup = vehicle_rollups.get(vehicle_id)
+        if not rollup:
+            rollup = vehicle_rollups[vehicle_id] = VehicleMonthlyRollup(
+                vehicle_id=vehicle_id, month=month, revenue=ZERO, discount_total=ZERO, rental_days=ZERO,
+            )
+        rollup.rental_days += get_rental_days(out_at, back_at, start, end)
+        if out_at >= start:
+            rollup.num_rentals += 1
+            rollup.revenue += subtotal or ZERO
+            rollup.discount_total += discount or ZERO
+
+    fleet_days = get_fleet_size(month) * days_in_month
+    rental_rollup = ServiceMonthlyRollup(
+        service_type=ServiceType.RENTAL, month=month, revenue=ZERO, discount_total=ZERO, rental_days=ZERO,
+    )
+    for rollup in vehicle_rollups.values():
+        rollup.utilization_pct = (rollup.rental_days / days_in_month * 100).quantize(CENTS)
+        rollup.rental_days = rollup.rental_days.quantize(CENTS)
+        rental_rollup.num_bookings += rollup.num_rentals
+        rental_rollup.revenue += rollup.revenue
+        rental_rollup.discount_total += rollup.discount_total
+        rental_rollup.rental_days += rollup.rental_days
+    if fleet_days:
+        rental_rollup.utilization_pct = (rental_rollup.rental_days / fleet_days * 100).quantize(CENTS)
+
+    service_rollups = [rental_rollup]
+    for service_type, model_class in (
+        (ServiceType.JOY_RIDE, JoyRide),
+        (ServiceType.PERFORMANCE_EXPERIENCE, PerformanceExperience),
+    ):
+        totals = model_class.objects.filter(
+            requested_date__gte=month, requested_date__lt=month + relativedelta(months=1),
+        ).exclude(status=model_class.Status.CANCELLED).aggregate(
+            num_bookings=Count('id'),
+            revenue=Coalesce(Sum('final_subtotal'), ZERO),
+            discount_total=Coalesce(Sum('final_discount'), ZERO),
+        )
+        service_rollups.append(ServiceMonthlyRollup(service_type=service_type, month=month, **totals))
+
+    return list(vehicle_rollups.values()), service_rollups
+
+
+def refresh_month(month: datetime.date) -> None:
+    vehicle_rollups, service_rollups = build_month(month)
+    with transaction.atomic():
+        VehicleMonthlyRollup.objects.filter(month=month).delete()
+        ServiceMonthlyRollup.objects.filter(month=month).delete()
+        VehicleMonthlyRollup.objects.bulk_create(vehicle_rollups)
+        ServiceMonthlyRollup.objects.bulk_create(service_rollups)
+
+
+def get_watermark():
+    return RollupWatermark.objects.filter(name=ROLLUP_WATERMARK_NAME).values_list('watermark', flat=True).first()
+
+
+def set_watermark(watermark: datetime.datetime) -> None:
+    RollupWatermark.objects.update_or_create(name=ROLLUP_WATERMARK_NAME, defaults={'watermark': watermark})
+
+
+def get_touched_months(since: datetime.datetime = None) -> set:
+    """
+    Months with a booking created or updated since the given time (all months with bookings, if None), plus those
+    marked stale.
+    """
+    months = set(StaleRollupMonth.objects.values_list('month', flat=True))
+    rentals = Rental.objects.filter(out_at__isnull=False, back_at__isnull=False)
+    if since:
+        rentals = rentals.filter(Q(reserved_at__gte=since) | Q(updated_at__gte=since))
+    for out_at, back_at in rentals.values_list('out_at', 'back_at').distinct():
+        months.update(get_months(out_at, back_at))
+    for model_class in (JoyRide, PerformanceExperience):
+        guided_drives = model_class.objects.filter(requested_date__isnull=False)
+        if since:
+            guided_drives = guided_drives.filter(Q(created_at__gte=since) | Q(updated_at__gte=since))
+        months.update(get_month(requested_date) for requested_date in guided_drives.dates('requested_date', 'month'))
+    return months
+
+
+def refresh_rollups(full: bool = False, dry_run: bool = False) -> list:
+    # Rebuilds the months touched since the last run (or every month, if full) and returns them
+    started_at = timezone.now()
+    watermark = None if full else get_watermark()
+    months = sorted(get_touched_months(watermark - ROLLUP_WATERMARK_OVERLAP if watermark else None))
+    if dry_run:
+        return months
+    for month in months:
+        refresh_month(month)
+    StaleRollupMonth.objects.filter(month__in=months, created_at__lt=started_at).delete()
+    set_watermark(started_at)
+    return months
+
+
+def get_service_series(months: int = 12, end_month: datetime.date = None) -> dict:
+    # ServiceMonthlyRollup rows for the months months up to end_month (this month by default), by service type
+    end_month = get_month(end_month or timezone.localdate())
+    start_month = end_month - relativedelta(months=months - 1)
+    series = defaultdict(dict)
+    for rollup in ServiceMonthlyRollup.objects.filter(month__gte=start_month, month__lte=end_month):
+        series[rollup.service_type][rollup.month] = rollup
+    return {
+        'months': [start_month + relativedelta(months=offset) for offset in range(months)],
+        'series': dict(series),
+    }
@@ -0,0 +1,104 @@
+from django.db.models.signals import post_init, post_save, post_delete
+
+from backoffice import counters, rollups
+from sales.models import Reservation, Rental, JoyRide, PerformanceExperience
+from users.models import Customer
+
+
+# Models whose counters are recounted (rather than adjusted) when one of the given fields changes
+
+RECOUNTED_FIELDS = {
+    Reservation: ((counters.RESERVATIONS,), ('status', 'out_at')),
+    Rental: ((counters.TODO_ITEMS,), ('status', 'deposit_charged_at', 'deposit_refunded_at', 'customer_id')),
+    Customer: ((counters.TODO_ITEMS,), ('coverage_verified', 'license_history')),
+}
+
+
+def get_filter_counters(model):
+    return [counter for counter in counters.FILTER_COUNTERS if counter.model is model]
+
+
+def get_loaded_values(instance, fields):
+    # None if any of the fields was deferred, rather than loading it
+    if instance.get_deferred_fields() & set(fields):
+        return None
+    return tuple(getattr(instance, field) for field in fields)
+
+
+# Remember what each instance looked like when loaded, so on save only the counters it moved in or out of are touched
+
+def remember_menu_counter_state(sender, instance, **kwargs):
+    instance._menu_counted = {
+        counter.name: counter.matches(instance) if get_loaded_values(instance, counter.fields) is not None else None
+        for counter in get_filter_counters(sender)
+    }
+    if sender in RECOUNTED_FIELDS:
+        instance._menu_counter_fields = get_loaded_values(instance, RECOUNTED_FIELDS[sender][1])
+
+
+def menu_counter_instance_saved(sender, instance, created, **kwargs):
+    for counter in get_filter_counters(sender):
+        was_counted = False if created else instance._menu_counted.get(counter.name)
+        if was_counted is None:
+            counters.recount(counter.name)
+        else:
+            counters.adjust(counter.name, int(counter.matches(instance)) - int(was_counted))
+    if sender in RECOUNTED_FIELDS:
+        names, fields = RECOUNTED_FIELDS[sender]
+        loaded_values = instance._menu_counter_fields
+        if created or loaded_values is None or get_loaded_values(instance, fields) != loaded_values:
+            for name in names:
+                counters.recount(name)
+    remember_menu_counter_state(sender, instance)
+
+
+def menu_counter_instance_deleted(sender, instance, **kwargs):
+    for counter in get_filter_counters(sender):
+        was_counted = instance._menu_counted.get(counter.name)
+        if was_counted is None:
+            counters.recount(counter.name)
+        elif was_counted:
+            counters.adjust(counter.name, -1)
+    if sender in RECOUNTED_FIELDS:
+        for name in RECOUNTED_FIELDS[sender][0]:
+            counters.recount(name)
+
+
+for model in {counter.model for counter in counters.FILTER_COUNTERS} | set(RECOUNTED_FIELDS):
+    post_init.connect(remember_menu_counter_state, sender=model, dispatch_uid=f'menu_counters_init_{model.__name__}')
+    post_save.connect(menu_counter_instance_saved, sender=model, dispatch_uid=f'menu_counters_save_{model.__name__}')
+    post_delete.connect(menu_counter_instance_deleted, sender=model, dispatch_uid=f'menu_counters_delete_{model.__name__}')
+
+
+# Changes to bookings are found by refresh_rollups through updated_at, but a booking which is deleted or moves to other
+# dates leaves no trace in the months it left, so those are marked stale
+
+ROLLUP_DATE_FIELDS = {
+    Rental: ('out_at', 'back_at'),
+    JoyRide: ('requested_date',),
+    PerformanceExperience: ('requested_date',),
+}
+
+
+def remember_rollup_months(sender, instance, **kwargs):
+    if get_loaded_values(instance, ROLLUP_DATE_FIELDS[sender]) is None:
+        instance._rollup_months = None
+    else:
+        instance._rollup_months = rollups.get_booking_months(instance)
+
+
+def rollup_booking_saved(sender, instance, created, **kwargs):
+    months = rollups.get_booking_months(instance)
+    if not created and instance._rollup_months:
+        rollups.mark_stale(instance._rollup_months - months)
+    instance._rollup_months = months
+
+
+def rollup_booking_deleted(sender, instance, **kwargs):
+    rollups.mark_stale(instance._rollup_months)
+
+
+for model in ROLLUP_DATE_FIELDS:
+    post_init.connect(remember_rollup_months, sender=model, dispatch_uid=f'rollups_init_{model.__name__}')
+    post_save.connect(rollup_booking_saved, sender=model, dispatch_uid=f'rollups_save_{model.__name__}')
+    post_delete.connect(rollup_booking_deleted, sender=model, dispatch_uid=f'rollups_delete_{model.__name__}')
@@ -1,3 +1,308 @@
+import io
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from freezegun import freeze_time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from backoffice.forms import VehicleForm, VehicleMarketingForm
+from backoffice.counters import get_menu_counts, count_todo_items, COUNTER_NAMES
+from backoffice.models import MenuCounter, VehicleMonthlyRollup, ServiceMonthlyRollup, StaleRollupMonth
+from backoffice.rollups import refresh_rollups, get_service_series
+from fleet.models import Vehicle, VehicleMarketing
+from pri.metrics import Histogram, request_metrics, merge_snapshots, INDEX_CACHE_KEY
+from sales.calculators import get_pricing_version
+from sales.enums import ServiceType
+from sales.models import Reservation, Rental, JoyRide, TaxRate
+from service.models import Damage
+from users.models import Customer, User
+
+
+@freeze_time('2023-06-01 12:00:00')
+class MenuCounterTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(email='customer@test.com')
+        self.customer = Customer.objects.create(user=self.user, coverage_verified=True, license_history='Clean')
+        self.vehicle_marketing = VehicleMarketing.objects.create(
+            price_per_day=500, discount_2_day=10, discount_3_day=20, discount_7_day=40,
+        )
+        self.vehicle = Vehicle.objects.create(vehicle_marketing_id=self.vehicle_marketing.id)
+        TaxRate.objects.create(postal_code=settings.DEFAULT_TAX_ZIP, total_rate=0.06625)
+
+    @staticmethod
+    def at(month, day):
+        return timezone.make_aware(datetime(2023, month, day, 10))
+
+    def test_counts_read_in_one_query(self):
+        Damage.objects.create(vehicle=self.vehicle)
+        self.assertFalse(MenuCounter.objects.exists())
+        self.assertEqual(get_menu_counts()['damages'], 1)
+        self.assertEqual(MenuCounter.objects.count(), len(COUNTER_NAMES))
+        with self.assertNumQueries(1):
+            counts = get_menu_counts()
+        self.assertEqual(set(counts), set(COUNTER_NAMES))
+
+    def test_filter_counter_adjusted_on_save_and_delete(self):
+        get_menu_counts()
+        damage_1 = Damage.objects.create(vehicle=self.vehicle)
+        damage_2 = Damage.objects.create(vehicle=self.vehicle)
+        self.assertEqual(get_menu_counts()['damages'], 2)
+
+        damage_1.is_repaired = True
+        damage_1.save()
+        self.assertEqual(get_menu_counts()['damages'], 1)
+        # Saving again without a change leaves the count alone
+        damage_1.save()
+        damage_2.notes = 'Scratch'
+        damage_2.save()
+        self.assertEqual(get_menu_counts()['damages'], 1)
+
+        damage_1.delete()
+        self.assertEqual(get_menu_counts()['damages'], 1)
+        damage_2.delete()
+        self.assertEqual(get_menu_counts()['damages'], 0)
+
+        # Loaded with the counted field deferred, the counter is recounted instead
+        damage_3 = Damage.objects.create(vehicle=self.vehicle)
+        damage_3 = Damage.objects.only('id').get(pk=damage_3.pk)
+        damage_3.is_repaired = True
+        damage_3.save()
+        self.assertEqual(get_menu_counts()['damages'], 0)
+
+    def test_reservations_expire(self):
+        get_menu_counts()
+        Reservation.objects.create(vehicle=self.vehicle, out_at=self.at(6, 3), back_at=self.at(6, 5))
+        Reservation.objects.create(vehicle=self.vehicle, out_at=self.at(6, 10), back_at=self.at(6, 12))
+        self.assertEqual(get_menu_counts()['reservations'], 2)
+        with freeze_time(self.at(6, 3) + timedelta(minutes=1)):
+            self.assertEqual(get_menu_counts()['reservations'], 1)
+        with freeze_time(self.at(6, 11)):
+            self.assertEqual(get_menu_counts()['reservations'], 0)
+
+    def test_todo_items(self):
+        get_menu_counts()
+        rental = Rental.objects.create(
+            vehicle=self.vehicle, customer=self.customer, out_at=self.at(6, 3), back_at=self.at(6, 5), extra_miles=0,
+            status=Rental.Status.CONFIRMED,
+        )
+        # Deposit to charge
+        counts = get_menu_counts()
+        self.assertEqual(counts['rentals'], 1)
+        self.assertEqual(counts['todo_items'], 1)
+
+        self.customer.coverage_verified = False
+        self.customer.save()
+        self.assertEqual(get_menu_counts()['todo_items'], 2)
+
+        rental.deposit_charged_at = timezone.now()
+        rental.status = Rental.Status.COMPLETE
+        rental.save()
+        # Deposit to refund
+        counts = get_menu_counts()
+        self.assertEqual(counts['rentals'], 0)
+        self.assertEqual(counts['todo_items'], 1)
+
+        rental.deposit_refunded_at = timezone.now()
+        rental.save()
+        self.assertEqual(get_menu_counts()['todo_items'], 0)
+
+    def test_todo_items_without_customer(self):
+        get_menu_counts()
+        rental = Rental.objects.create(
+            vehicle=self.vehicle, out_at=self.at(6, 3), back_at=self.at(6, 5), status=Rental.Status.CONFIRMED,
+        )
+        self.assertEqual(rental.todo_item_count, 1)
+        self.assertEqual(get_menu_counts()['todo_items'], 1)
+
+        # Counted in one query, however many rentals are open
+        Customer.objects.filter(pk=self.customer.pk).update(coverage_verified=False, license_history='')
+        for day in range(6, 10):
+            Rental.objects.create(
+                vehicle=self.vehicle, customer=self.customer, out_at=self.at(6, day), back_at=self.at(6, day + 1),
+                extra_miles=0,
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(count_todo_items(), 9)
+
+
+@freeze_time('2023-06-01 12:00:00')
+class RollupTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.vehicle_1 = Vehicle.objects.create()
+        self.vehicle_2 = Vehicle.objects.create()
+        # Out for two days in May and three in June
+        self.rental_1 = self.create_rental(self.vehicle_1, self.at(5, 30), self.at(6, 4), '500.00', 50)
+        self.rental_2 = self.create_rental(self.vehicle_2, self.at(6, 10), self.at(6, 13), '300.00', 0)
+        self.create_rental(self.vehicle_2, self.at(6, 20), self.at(6, 22), '200.00', 0, status=Rental.Status.CANCELLED)
+        self.joy_ride = JoyRide.objects.create(
+            requested_date=date(2023, 6, 5), status=JoyRide.Status.CONFIRMED,
+            final_price_data={'subtotal': '125.00', 'specific_discount': '25.00'},
+        )
+
+    @staticmethod
+    def at(month, day):
+        return timezone.make_aware(datetime(2023, month, day))
+
+    @staticmethod
+    def create_rental(vehicle, out_at, back_at, subtotal, discount, status=Rental.Status.COMPLETE):
+        return Rental.objects.create(
+            vehicle=vehicle, out_at=out_at, back_at=back_at, status=status,
+            final_price_data={
+                'subtotal': subtotal, 'multi_day_discount': discount, 'specific_discount': 0,
+                'post_multi_day_discount_subtotal': subtotal,
+            },
+        )
+
+    def test_build(self):
+        self.assertEqual(refresh_rollups(), [date(2023, 5, 1), date(2023, 6, 1)])
+
+        may = VehicleMonthlyRollup.objects.get(vehicle=self.vehicle_1, month=date(2023, 5, 1))
+        self.assertEqual(may.num_rentals, 1)
+        self.assertEqual(may.revenue, Decimal('500.00'))
+        self.assertEqual(may.discount_total, Decimal('50.00'))
+        self.assertEqual(may.rental_days, Decimal('2.00'))
+        self.assertEqual(may.utilization_pct, Decimal('6.45'))
+        # Revenue is credited to the month the rental went out; the days to the months they fell in
+        june = VehicleMonthlyRollup.objects.get(vehicle=self.vehicle_1, month=date(2023, 6, 1))
+        self.assertEqual((june.num_rentals, june.revenue, june.rental_days), (0, Decimal('0.00'), Decimal('3.00')))
+        self.assertEqual(june.utilization_pct, Decimal('10.00'))
+
+        rentals = ServiceMonthlyRollup.objects.get(service_type=ServiceType.RENTAL, month=date(2023, 6, 1))
+        self.assertEqual((rentals.num_bookings, rentals.revenue), (1, Decimal('300.00')))
+        self.assertEqual(rentals.rental_days, Decimal('6.00'))
+        self.assertEqual(rentals.utilization_pct, Decimal('10.00'))
+        joy_rides = ServiceMonthlyRollup.objects.get(service_type=ServiceType.JOY_RIDE, month=date(2023, 6, 1))
+        self.assertEqual((joy_rides.num_bookings, joy_rides.revenue), (1, Decimal('125.00')))
+        self.assertEqual(joy_rides.discount_total, Decimal('25.00'))
+        self.assertIsNone(joy_rides.utilization_pct)
+
+        with self.assertNumQueries(1):
+            series = get_service_series(months=3)
+        self.assertEqual(series['months'], [date(2023, 4, 1), date(2023, 5, 1), date(2023, 6, 1)])
+        self.assertEqual(series['series'][ServiceType.RENTAL][date(2023, 5, 1)].revenue, Decimal('500.00'))
+
+    def test_incremental_refresh(self):
+        with freeze_time('2023-06-01 13:00:00'):
+            self.assertEqual(len(refresh_rollups()), 2)
+        with freeze_time('2023-06-01 14:00:00'):
+            self.assertEqual(refresh_rollups(), [])
+            self.rental_2.final_price_data['subtotal'] = '350.00'
+            self.rental_2.save()
+        with freeze_time('2023-06-01 15:00:00'):
+            self.assertEqual(refresh_rollups(), [date(2023, 6, 1)])
+        june = VehicleMonthlyRollup.objects.get(vehicle=self.vehicle_2, month=date(2023, 6, 1))
+        self.assertEqual(june.revenue, Decimal('350.00'))
+
+        # Moving a rental out of a month, or deleting one, leaves that month stale until the next refresh
+        with freeze_time('2023-06-01 16:00:00'):
+            self.rental_1.out_at = self.at(6, 1)
+            self.rental_1.save()
+            self.assertEqual(set(StaleRollupMonth.objects.values_list('month', flat=True)), {date(2023, 5, 1)})
+            self.joy_ride.delete()
+        with freeze_time('2023-06-01 17:00:00'):
+            self.assertEqual(refresh_rollups(), [date(2023, 5, 1), date(2023, 6, 1)])
+        self.assertFalse(StaleRollupMonth.objects.exists())
+        self.assertFalse(VehicleMonthlyRollup.objects.filter(month=date(2023, 5, 1)).exists())
+        joy_rides = ServiceMonthlyRollup.objects.get(service_type=ServiceType.JOY_RIDE, month=date(2023, 6, 1))
+        self.assertEqual(joy_rides.num_bookings, 0)
+
+
+class RequestMetricsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        request_metrics.clear()
+        self.user = User.objects.create_user(email='staff@test.com')
+        self.user.is_admin = True
+        self.user.is_backoffice = True
+        self.user.save()
+
+    def test_histogram(self):
+        histogram = Histogram((1, 5))
+        for value in (0, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual((histogram.count, histogram.sum), (4, 14))
+
+    def test_metrics_endpoint(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('backoffice:metrics'))
+        snapshot = request_metrics.snapshot()
+        counts, total = snapshot['routes']['backoffice:metrics']['histograms']['request_duration_seconds']
+        self.assertEqual(sum(counts), 1)
+        self.assertGreater(sum(snapshot['routes']['backoffice:metrics']['histograms']['request_queries'][0]), 0)
+
+        response = self.client.get(reverse('backoffice:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4')
+        text = response.content.decode()
+        self.assertIn('# TYPE pri_request_duration_seconds histogram', text)
+        self.assertIn('pri_request_duration_seconds_count{route="backoffice:metrics"} 1', text)
+        self.assertIn('pri_request_duration_seconds_bucket{route="backoffice:metrics",le="+Inf"} 1', text)
+
+        self.user.is_admin = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('backoffice:metrics')).status_code, 403)
+
+    def test_published_metrics(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('backoffice:metrics'))
+        request_metrics.publish()
+        self.assertEqual(cache.get(request_metrics.cache_key), request_metrics.snapshot())
+        self.assertEqual(cache.get(INDEX_CACHE_KEY), {request_metrics.cache_key})
+        merged = merge_snapshots([request_metrics.snapshot(), request_metrics.snapshot()])
+        self.assertEqual(sum(merged['routes']['backoffice:metrics']['histograms']['request_duration_seconds'][0]), 2)
+
+        out = io.StringIO()
+        call_command('dump_request_metrics', stdout=out)
+        self.assertIn('backoffice:metrics', out.getvalue())
+
+
+class VehicleDetailViewTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(email='staff@test.com')
+        self.user.is_admin = True
+        self.user.is_backoffice = True
+        self.user.save()
+        self.vehicle_marketing = VehicleMarketing.objects.create(
+            make='Porsche', model='911', year=2020, price_per_day=500,
+        )
+        self.vehicle = Vehicle.objects.create(
+            make='Porsche', model='911', year=2020, vehicle_marketing_id=self.vehicle_marketing.id,
+        )
+
+    @staticmethod
+    def get_post_data(*forms):
+        # What a browser would post for the forms as rendered
+        data = {}
+        for form in forms:
+            for name in form.fields:
+                value = form[name].value()
+                if value is None or value is False:
+                    continue
+                data[name] = 'on' if value is True else value
+        return data
 
-# Create your tests here.
+    def test_price_edit_invalidates_quotes(self):
+        self.client.force_login(self.user)
+        pricing_version = get_pricing_version()
+        post_data = self.get_post_data(
+            VehicleForm(instance=self.vehicle), VehicleMarketingForm(instance=self.vehicle_marketing),
+        )
+        post_data['price_per_day'] = 600
+        response = self.client.post(reverse('backoffice:vehicle-detail', kwargs={'pk': self.vehicle.pk}), post_data)
+        self.assertEqual(response.status_code, 302)
+        self.vehicle_marketing.refresh_from_db()
+        self.assertEqual(self.vehicle_marketing.price_per_day, 600)
+        self.assertNotEqual(get_pricing_version(), pricing_version)
@@ -9,7 +9,7 @@ from backoffice import views
 from backoffice.views import (
     vehicles, reservations, rentals, guided_drives, employees, customers, coupons, toll_tags, tax_rates, bbs,
     consigners, consignment_payments, news, site_content, gift_certificates, adhoc_payments, newsletter_subscriptions,
-    stripe_charges, red_flags, ip_bans, survey_responses, damage, service, mass_email,
+    stripe_charges, red_flags, ip_bans, survey_responses, damage, service, mass_email, schedule, reports,
 )
 
 
@@ -40,6 +40,11 @@ urlpatterns = [
     path('vehicles/marketing/<int:pk>/pictures/', vehicles.VehiclePicturesView.as_view(), name='vehicle-pictures'),
     path('vehicles/marketing/<int:pk>/videos/', vehicles.VehicleVideosView.as_view(), name='vehicle-videos'),
 
+    path('schedule/', schedule.ScheduleView.as_view(), name='schedule'),
+
+    path('reports/revenue/', reports.RevenueReportView.as_view(), name='revenue-report'),
+    path('metrics/', reports.MetricsView.as_view(), name='metrics'),
+
     path('reservations/', reservations.ReservationListView.as_view(), name='reservation-list'),
     path('reservations/create/', reservations.ReservationCreateView.as_view(is_create_view=True), name='reservation-create'),
     path('reservations/<int:pk>/', reservations.ReservationDetailView.as_view(), name='reservation-detail'),
@@ -127,6 +132,7 @@ urlpatterns = [
     path('consigners/', consigners.ConsignerListView.as_view(), name='consigner-list'),
     path('consigners/create/', consigners.ConsignerCreateView.as_view(is_create_view=True), name='consigner-create'),
     path('consigners/<int:pk>/', consigners.ConsignerDetailView.as_view(), name='consigner-detail'),
+    path('consigners/<int:pk>/statement/', consigners.ConsignerStatementView.as_view(), name='consigner-statement'),
     path('consigners/<int:pk>/delete/', consigners.ConsignerDeleteView.as_view(), name='consigner-delete'),
 
     path('consignment_payments/', consignment_payments.ConsignmentPaymentListView.as_view(), name='consignmentpayment-list'),
@@ -11,6 +11,7 @@ from django.utils import timezone
 from django.views.generic import TemplateView, DetailView, UpdateView, CreateView, DeleteView
 from django.contrib.auth.views import LogoutView
 from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
 from django.http import Http404, HttpResponseRedirect
 from django.core.exceptions import FieldError
 from django.core.cache import cache
@@ -18,9 +19,11 @@ from django.core.cache import cache
 from users.views import LoginView
 from users.models import User, Customer
 from backoffice.models import BBSPost
+from backoffice.counters import get_menu_counts, get_todo_list_rentals
 from fleet.models import VehicleMarketing, VehicleStatus
+from fleet.pricing import FleetPriceMatrix
+from sales.calculators import get_pricing_version
 from sales.models import Reservation, Rental, PerformanceExperience, JoyRide, GuidedDrive, GiftCertificate, AdHocPayment
-from service.models import ScheduledService, Damage
 from marketing.models import NewsletterSubscription
 
 
@@ -29,48 +32,28 @@ from marketing.models import NewsletterSubscription
 # Home and login/logout views
 
 class AdminViewMixin:
-    MENU_CONTEXT_CACHE_KEY = 'menu_context'
-    MENU_CONTEXT_CACHE_TIMEOUT = 300  # 300 (5m) is Django default
+    PRICE_MATRIX_CACHE_TIMEOUT = 300  # 300 (5m) is Django default
+
+    def get_price_matrix(self, vehicles):
+        # Keyed on the pricing version and date, so a price change or a promotion starting shows up straight away
+        cache_key = f'menu_price_matrix:{get_pricing_version()}:{timezone.localdate().isoformat()}'
+        price_matrix = cache.get(cache_key)
+        if price_matrix is None:
+            price_matrix = FleetPriceMatrix.for_ready_vehicles(queryset=vehicles)
+            cache.set(cache_key, price_matrix, self.PRICE_MATRIX_CACHE_TIMEOUT)
+        return price_matrix
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
 
-        cached_context = cache.get(self.MENU_CONTEXT_CACHE_KEY)
-        if cached_context:
-            context.update(cached_context)
-            return context
-
-        menu_context = {}
-        menu_context['admin_users'] = User.objects.filter(is_backoffice=True)
-        menu_context['now'] = timezone.now()
-        menu_context['vehicles'] = VehicleMarketing.objects.filter(status=VehicleStatus.READY).order_by('vehicle_type', 'id')
-
-        menu_context['todo_list_rentals'] = Rental.objects.filter(status__in=(
-            Rental.Status.INCOMPLETE,
-            Rental.Status.CONFIRMED,
-            Rental.Status.IN_PROGRESS,
-            Rental.Status.COMPLETE,
-        )).select_related('customer')
-        menu_context['todo_item_count'] = sum([r.todo_item_count for r in menu_context['todo_list_rentals']])
-
-        menu_context['reservations'] = Reservation.objects.filter(
-            status=Reservation.Status.UNCONFIRMED,
-            out_at__gt=timezone.now(),
-        )
-        menu_context['rentals'] = Rental.objects.filter(status__in=(
-            Rental.Status.INCOMPLETE,
-            Rental.Status.CONFIRMED,
-            Rental.Status.IN_PROGRESS,
-        ))
-        menu_context['performance_experiences'] = PerformanceExperience.objects.filter(status=PerformanceExperience.Status.PENDING)
-        menu_context['joy_rides'] = JoyRide.objects.filter(status=JoyRide.Status.PENDING)
-        menu_context['maintenances'] = ScheduledService.objects.filter(is_due=True)
-        menu_context['damages'] = Damage.objects.filter(is_repaired=False)
-        menu_context['gift_certificates'] = GiftCertificate.objects.filter(is_paid=False)
-        menu_context['adhoc_payments'] = AdHocPayment.objects.filter(is_paid=False, is_submitted=True)
-
-        cache.set(self.MENU_CONTEXT_CACHE_KEY, menu_context, self.MENU_CONTEXT_CACHE_TIMEOUT)
-        context.update(menu_context)
+        context['admin_users'] = User.objects.filter(is_backoffice=True)
+        context['now'] = timezone.now()
+        context['vehicles'] = VehicleMarketing.objects.filter(status=VehicleStatus.READY).order_by('vehicle_type', 'id')
+        context['price_matrix'] = self.get_price_matrix(context['vehicles'])
+
+        # Badge counts are materialized (see backoffice.counters); the to-do list itself is only loaded if rendered
+        context['menu_counts'] = get_menu_counts()
+        context['todo_list_rentals'] = get_todo_list_rentals()
         return context
 
 
@@ -93,13 +76,17 @@ class HomeView(AdminViewMixin, TemplateView):
         context['newsletter_subscriptions'] = NewsletterSubscription.objects.filter(confirmed_at__isnull=False)
         context['gift_certificate_total'] = GiftCertificate.objects.filter(is_paid=True).aggregate(total=Sum('amount'))['total']
         context['ad_hoc_payment_total'] = AdHocPayment.objects.filter(is_paid=True).aggregate(total=Sum('amount'))['total']
-        joy_rides = JoyRide.objects.filter(status=JoyRide.Status.COMPLETE)
-        performance_experiences = PerformanceExperience.objects.filter(status=PerformanceExperience.Status.COMPLETE)
-        joy_ride_total = sum([Decimal(j.final_price_data['subtotal']) for j in joy_rides if j.final_price_data])
-        performance_experience_total = sum([Decimal(p.final_price_data['subtotal']) for p in performance_experiences if p.final_price_data])
+        # Summed from the revenue columns (see PricingInputsMixin.revenue_fields) rather than each row's price data
+        joy_ride_total = JoyRide.objects.filter(status=JoyRide.Status.COMPLETE).aggregate(
+            total=Coalesce(Sum('final_subtotal'), Decimal('0')),
+        )['total']
+        performance_experience_total = PerformanceExperience.objects.filter(
+            status=PerformanceExperience.Status.COMPLETE,
+        ).aggregate(total=Coalesce(Sum('final_subtotal'), Decimal('0')))['total']
         context['guided_drive_total'] = joy_ride_total + performance_experience_total
-        rentals = Rental.objects.filter(status=Rental.Status.COMPLETE)
-        context['rental_total'] = sum([Decimal(r.final_price_data['subtotal']) for r in rentals if r.final_price_data])
+        context['rental_total'] = Rental.objects.filter(status=Rental.Status.COMPLETE).aggregate(
+            total=Coalesce(Sum('final_subtotal'), Decimal('0')),
+        )['total']
         context['all_bucks'] = sum((
             context['gift_certificate_total'],
             context['ad_hoc_payment_total'],
@@ -2,6 +2,8 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 
 from django.shortcuts import render, reverse
+from django.views.generic import View
+from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.list import ListView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.http import Http404, HttpResponseRedirect
@@ -9,6 +11,7 @@ from django.contrib.auth.mixins import PermissionRequiredMixin
 
 from . import ListViewMixin, AdminViewMixin
 from backoffice.forms import ConsignerForm
+from consignment import ledger
 from consignment.models import Consigner
 
 
@@ -31,10 +34,22 @@ class ConsignerDetailView(AdminViewMixin, ConsignerViewMixin, ListViewMixin, Upd
     template_name = 'backoffice/consigner/detail.html'
     form_class = ConsignerForm
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['statement'] = ledger.get_statement(self.object, before=ledger.get_cursor(self.request))
+        return context
+
     def get_success_url(self):
         return reverse('backoffice:consigner-detail', kwargs={'pk': self.object.id})
 
 
+class ConsignerStatementView(PermissionRequiredMixin, ConsignerViewMixin, SingleObjectMixin, View):
+    permission_required = ('users.view_consigner',)
+
+    def get(self, request, *args, **kwargs):
+        return ledger.get_statement_response(self.get_object())
+
+
 class ConsignerCreateView(AdminViewMixin, ConsignerViewMixin, ListViewMixin, CreateView):
     template_name = 'backoffice/consigner/detail.html'
     form_class = ConsignerForm
@@ -0,0 +1,80 @@
+import datetime
+
+from django.http import HttpResponse
+from django.views.generic import TemplateView, View
+from django.contrib.auth.mixins import PermissionRequiredMixin, UserPassesTestMixin
+from django.utils import timezone
+
+from . import AdminViewMixin
+from backoffice.models import VehicleMonthlyRollup
+from backoffice.rollups import get_month, get_service_series, get_watermark
+from pri.metrics import request_metrics, to_prometheus
+from sales.enums import ServiceType
+
+
+# Monthly revenue and utilization, charted from the rollup tables kept by the refresh_rollups command, so the page costs
+# the same however much booking history there is
+
+class RevenueReportView(PermissionRequiredMixin, AdminViewMixin, TemplateView):
+    permission_required = ('users.view_rental',)
+    template_name = 'backoffice/report/revenue.html'
+    page_group = 'reports'
+    DEFAULT_MONTHS = 12
+    MAX_MONTHS = 36
+    SERVICE_TYPES = (ServiceType.RENTAL, ServiceType.JOY_RIDE, ServiceType.PERFORMANCE_EXPERIENCE)
+
+    def get_params(self):
+        try:
+            month = datetime.datetime.strptime(self.request.GET['month'], '%Y-%m').date()
+        except (KeyError, ValueError):
+            month = get_month(timezone.localdate())
+        try:
+            num_months = min(max(int(self.request.GET['months']), 1), self.MAX_MONTHS)
+        except (KeyError, ValueError):
+            num_months = self.DEFAULT_MONTHS
+        return month, num_months
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        month, num_months = self.get_params()
+        service_series = get_service_series(months=num_months, end_month=month)
+
+        rows = []
+        for row_month in service_series['months']:
+            rollups = [service_series['series'].get(service_type, {}).get(row_month) for service_type in self.SERVICE_TYPES]
+            rows.append({
+                'month': row_month,
+                'rollups': rollups,
+                'revenue': sum(rollup.revenue for rollup in rollups if rollup),
+                'discount_total': sum(rollup.discount_total for rollup in rollups if rollup),
+                'utilization_pct': rollups[0].utilization_pct if rollups[0] else None,
+            })
+        max_revenue = max((row['revenue'] for row in rows), default=0) or 1
+        for row in rows:
+            row['bars'] = [
+                (service_type, float(rollup.revenue / max_revenue * 100) if rollup else 0)
+                for service_type, rollup in zip(self.SERVICE_TYPES, row['rollups'])
+            ]
+
+        context['page_group'] = self.page_group
+        context['month'] = month
+        context['num_months'] = num_months
+        context['service_types'] = [service_type.label for service_type in self.SERVICE_TYPES]
+        context['rows'] = rows
+        context['vehicle_rollups'] = VehicleMonthlyRollup.objects.filter(month=month).select_related(
+            'vehicle',
+        ).order_by('-revenue')
+        context['refreshed_at'] = get_watermark()
+        return context
+
+
+# Per-route request metrics of all app processes (see pri.metrics) in the Prometheus text format, for scraping
+
+class MetricsView(UserPassesTestMixin, View):
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(to_prometheus(request_metrics.get_all()), content_type='text/plain; version=0.0.4')
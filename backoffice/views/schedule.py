@@ -0,0 +1,28 @@
+from django.views.generic import TemplateView
+from django.contrib.auth.mixins import PermissionRequiredMixin
+
+from . import AdminViewMixin
+from fleet.schedule import FleetSchedule
+
+
+# Gantt board of every vehicle's bookings over a window of up to FleetSchedule.MAX_DAYS days; the same data is served
+# as JSON by api.views.FleetScheduleView
+
+class ScheduleView(PermissionRequiredMixin, AdminViewMixin, TemplateView):
+    permission_required = ('users.view_rental',)
+    template_name = 'backoffice/schedule/board.html'
+    page_group = 'schedule'
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        try:
+            schedule = FleetSchedule.from_params(self.request.GET.get('start_date'), self.request.GET.get('days'))
+        except ValueError as e:
+            context['error'] = str(e)
+            schedule = FleetSchedule.from_params()
+        context['page_group'] = self.page_group
+        context['schedule'] = schedule.as_dict()
+        context['days'] = schedule.get_days()
+        context['day_width'] = 100 / schedule.num_days
+        context['max_days'] = FleetSchedule.MAX_DAYS
+        return context
@@ -64,7 +64,11 @@ class VehicleDetailView(AdminViewMixin, VehicleViewMixin, ListViewMixin, UpdateV
 
         marketing_form = VehicleMarketingForm(self.request.POST)
         marketing_form.is_valid()
-        VehicleMarketing.objects.filter(id=vehicle.vehicle_marketing_id).update(**marketing_form.cleaned_data)
+        # Saved rather than updated in place, so sales.signals sees a price change and invalidates cached quotes
+        vehicle_marketing = vehicle.vehicle_marketing
+        for field, value in marketing_form.cleaned_data.items():
+            setattr(vehicle_marketing, field, value)
+        vehicle_marketing.save(update_fields=list(marketing_form.cleaned_data))
         return HttpResponseRedirect(self.get_success_url())
 
     def get_marketing_form_class(self):
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from consignment.models import Consigner, ConsignmentPayment, ConsignmentReservation
+from consignment.models import Consigner, ConsignmentPayment, ConsignmentReservation, ConsignerLedgerEntry
 
 
 class ConsignerAdmin(admin.ModelAdmin):
@@ -15,6 +15,11 @@ class ConsignmentReservationAdmin(admin.ModelAdmin):
     list_display = ('id', 'consigner', 'vehicle', 'out_at', 'back_at',)
 
 
+class ConsignerLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'consigner', 'entry_type', 'transacted_at', 'amount', 'revenue_balance', 'paid_balance',)
+
+
 admin.site.register(Consigner, ConsignerAdmin)
 admin.site.register(ConsignmentPayment, ConsignmentPaymentAdmin)
 admin.site.register(ConsignmentReservation, ConsignmentReservationAdmin)
+admin.site.register(ConsignerLedgerEntry, ConsignerLedgerEntryAdmin)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ConsignmentConfig(AppConfig):
     name = 'consignment'
+
+    def ready(self):
+        # Register signal receivers
+        from consignment import signals  # noqa: F401
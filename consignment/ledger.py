@@ -0,0 +1,225 @@
+# Posting to and reading from the consigner ledger (ConsignerLedgerEntry). What a rental or payment should have posted
+# to each consigner is compared with what the ledger already holds for it, and any difference is appended as a new row,
+# so posting is idempotent and the same code backfills, repairs after bulk updates (sync_consigner_ledger) and follows
+# single saves (consignment.signals). Rental revenue is credited to the consigner owning the vehicle when the rental
+# completes, and stays with them if the vehicle later changes hands.
+
+import csv
+import decimal
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from consignment.models import Consigner, ConsignmentPayment, ConsignerLedgerEntry
+from sales.models import Rental
+
+LEDGER_PAGE_SIZE = 50
+
+ZERO = decimal.Decimal('0')
+
+LINK_FIELDS = {
+    ConsignerLedgerEntry.EntryType.RENTAL: 'rental_id',
+    ConsignerLedgerEntry.EntryType.PAYMENT: 'payment_id',
+}
+
+
+def get_rental_consigners(rentals) -> dict:
+    # {rental id: consigner id} of the consigner each rental was first posted to
+    posted_consigners = {}
+    for rental_id, consigner_id in ConsignerLedgerEntry.objects.filter(
+        entry_type=ConsignerLedgerEntry.EntryType.RENTAL, rental__in=rentals,
+    ).order_by('id').values_list('rental_id', 'consigner_id'):
+        posted_consigners.setdefault(rental_id, consigner_id)
+    return posted_consigners
+
+
+def get_expected_rentals(rentals) -> dict:
+    """
+    {(consigner id, rental id): (amount, transacted_at)} for the completed rentals of consigners' vehicles. A rental
+    already posted stays with the consigner it was posted to, whoever owns the vehicle now; the vehicle's current owner
+    is only used for rentals not posted yet.
+    """
+    posted_consigners = get_rental_consigners(rentals)
+    posted_rentals = ConsignerLedgerEntry.objects.filter(
+        entry_type=ConsignerLedgerEntry.EntryType.RENTAL, rental__isnull=False,
+    ).values('rental_id')
+    expected = {}
+    for rental_id, owner_id, gross_revenue, out_at in rentals.filter(
+        Q(vehicle__external_owner__isnull=False) | Q(id__in=posted_rentals), status=Rental.Status.COMPLETE,
+    ).values_list('id', 'vehicle__external_owner_id', 'final_gross_revenue', 'out_at'):
+        consigner_id = posted_consigners.get(rental_id, owner_id)
+        expected[(consigner_id, rental_id)] = (gross_revenue or ZERO, out_at)
+    return expected
+
+
+def get_expected_payments(payments) -> dict:
+    # {(consigner id, payment id): (amount, transacted_at)}
+    return {
+        (consigner_id, payment_id): (amount, paid_at)
+        for payment_id, consigner_id, amount, paid_at in payments.filter(
+            consigner__isnull=False, amount__isnull=False,
+        ).values_list('id', 'consigner_id', 'amount', 'paid_at')
+    }
+
+
+def get_posted(entry_type: int, **filters) -> dict:
+    # {(consigner id, rental or payment id): total posted}
+    link_field = LINK_FIELDS[entry_type]
+    entries = ConsignerLedgerEntry.objects.filter(entry_type=entry_type, **{f'{link_field}__isnull': False}, **filters)
+    return {
+        (row['consigner_id'], row[link_field]): row['total']
+        for row in entries.values('consigner_id', link_field).annotate(total=Sum('amount')).order_by()
+    }
+
+
+def get_postings(entry_type: int, expected: dict, posted: dict) -> list:
+    """
+    The rows needed to bring what is posted in line with what is expected, as (transacted_at, entry_type, link id,
+    consigner id, amount). A first posting is dated by its rental or payment; a correction is dated now.
+    """
+    now = timezone.now()
+    postings = []
+    for key in expected.keys() | posted.keys():
+        amount, transacted_at = expected.get(key, (ZERO, None))
+        delta = amount - posted.get(key, ZERO)
+        if delta:
+            consigner_id, link_id = key
+            if key in posted or not transacted_at:
+                transacted_at = now
+            postings.append((transacted_at, entry_type, link_id, consigner_id, delta))
+    return postings
+
+
+def post(postings: list, dry_run: bool = False) -> list:
+    """
+    Appends the postings, oldest first, each row carrying its consigner's balances after it. Consigners are locked
+    while their balances are read and extended, so concurrent postings can't interleave.
+    """
+    postings = sorted(postings)
+    if dry_run or not postings:
+        return postings
+    consigner_ids = sorted({posting[3] for posting in postings})
+    with transaction.atomic():
+        list(Consigner.objects.select_for_update().filter(pk__in=consigner_ids).order_by('pk').values_list('pk'))
+        balances = {}
+        for consigner_id in consigner_ids:
+            balances[consigner_id] = ConsignerLedgerEntry.objects.filter(consigner_id=consigner_id).order_by(
+                '-id',
+            ).values_list('revenue_balance', 'paid_balance').first() or (ZERO, ZERO)
+        entries = []
+        for transacted_at, entry_type, link_id, consigner_id, amount in postings:
+            revenue_balance, paid_balance = balances[consigner_id]
+            if entry_type == ConsignerLedgerEntry.EntryType.RENTAL:
+                revenue_balance += amount
+            else:
+                paid_balance += amount
+            balances[consigner_id] = (revenue_balance, paid_balance)
+            entries.append(ConsignerLedgerEntry(
+                consigner_id=consigner_id, entry_type=entry_type, transacted_at=transacted_at, amount=amount,
+                revenue_balance=revenue_balance, paid_balance=paid_balance, **{LINK_FIELDS[entry_type]: link_id},
+            ))
+        ConsignerLedgerEntry.objects.bulk_create(entries)
+    return postings
+
+
+def sync_rentals(rentals=None, dry_run: bool = False) -> list:
+    # Posts what the given rentals (all, if None) are owed but haven't had posted, or have had posted wrongly
+    rental_type = ConsignerLedgerEntry.EntryType.RENTAL
+    if rentals is None:
+        expected, posted = get_expected_rentals(Rental.objects.all()), get_posted(rental_type)
+    else:
+        expected, posted = get_expected_rentals(rentals), get_posted(rental_type, rental__in=rentals)
+    return post(get_postings(rental_type, expected, posted), dry_run=dry_run)
+
+
+def sync_payments(payments=None, dry_run: bool = False) -> list:
+    payment_type = ConsignerLedgerEntry.EntryType.PAYMENT
+    if payments is None:
+        expected, posted = get_expected_payments(ConsignmentPayment.objects.all()), get_posted(payment_type)
+    else:
+        expected, posted = get_expected_payments(payments), get_posted(payment_type, payment__in=payments)
+    return post(get_postings(payment_type, expected, posted), dry_run=dry_run)
+
+
+def sync_all(dry_run: bool = False) -> list:
+    # Rentals and payments are posted together so a backfill comes out in date order
+    rental_type, payment_type = ConsignerLedgerEntry.EntryType.RENTAL, ConsignerLedgerEntry.EntryType.PAYMENT
+    postings = get_postings(
+        rental_type, get_expected_rentals(Rental.objects.all()), get_posted(rental_type),
+    ) + get_postings(
+        payment_type, get_expected_payments(ConsignmentPayment.objects.all()), get_posted(payment_type),
+    )
+    return post(postings, dry_run=dry_run)
+
+
+def reverse(entry_type: int, link_id: int) -> list:
+    # Takes back everything posted for a rental or payment which is being deleted
+    return post(get_postings(entry_type, {}, get_posted(entry_type, **{LINK_FIELDS[entry_type]: link_id})))
+
+
+def get_balances(consigner: Consigner) -> dict:
+    latest = consigner.ledger_entries.order_by('-id').values_list('revenue_balance', 'paid_balance').first()
+    total_revenue, total_paid = latest or (ZERO, ZERO)
+    return {'total_revenue': total_revenue, 'total_paid': total_paid}
+
+
+def get_cursor(request) -> int:
+    # The before entry id given for a statement page, or None for the latest page
+    before = request.GET.get('before', '')
+    return int(before) if before.isdigit() else None
+
+
+def get_statement(consigner: Consigner, before: int = None, entry_type: int = None,
+                  page_size: int = LEDGER_PAGE_SIZE) -> dict:
+    """
+    A page of the consigner's ledger, newest first, starting below the entry id before (from the latest entry, if
+    None), along with the id to pass as before for the next page (None on the last page) and the current balances.
+    """
+    entries = consigner.ledger_entries.select_related('rental__vehicle', 'payment').order_by('-id')
+    if entry_type:
+        entries = entries.filter(entry_type=entry_type)
+    if before:
+        entries = entries.filter(id__lt=before)
+    page = list(entries[:page_size + 1])
+    older = page[page_size - 1].id if len(page) > page_size else None
+    return {
+        'history': page[:page_size],
+        'older': older,
+        'is_latest': not before,
+        **get_balances(consigner),
+    }
+
+
+class Echo:
+    # File-like object handing back what's written to it, for streaming csv.writer output
+
+    def write(self, value):
+        return value
+
+
+def get_statement_rows(consigner: Consigner):
+    yield ['Date', 'Type', 'Reference', 'Vehicle', 'Amount', 'Gross to Date', 'Paid to Date', 'Balance']
+    entries = consigner.ledger_entries.select_related('rental__vehicle').order_by('id')
+    for entry in entries.iterator(chunk_size=500):
+        if entry.is_rental:
+            reference = entry.rental.confirmation_code if entry.rental else ''
+            vehicle = entry.rental.vehicle.vehicle_name if entry.rental and entry.rental.vehicle else ''
+        else:
+            reference, vehicle = (f'Payment {entry.payment_id}' if entry.payment_id else ''), ''
+        yield [
+            timezone.localtime(entry.transacted_at).strftime('%m/%d/%Y'), entry.get_entry_type_display(), reference,
+            vehicle, entry.amount, entry.revenue_balance, entry.paid_balance, entry.balance,
+        ]
+
+
+def get_statement_response(consigner: Consigner) -> StreamingHttpResponse:
+    # The consigner's whole ledger as a CSV download, streamed a chunk of rows at a time
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in get_statement_rows(consigner)), content_type='text/csv',
+    )
+    filename = f'statement-{consigner.id}-{timezone.localdate():%Y%m%d}.csv'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
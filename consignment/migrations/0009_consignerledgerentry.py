@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0073_rollup_columns'),
+        ('consignment', '0008_alter_consignmentreservation_back_at_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsignerLedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_type', models.IntegerField(choices=[(1, 'Rental'), (2, 'Payment')])),
+                ('transacted_at', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=9)),
+                ('revenue_balance', models.DecimalField(decimal_places=2, max_digits=11)),
+                ('paid_balance', models.DecimalField(decimal_places=2, max_digits=11)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('consigner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='consignment.consigner')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='consignment.consignmentpayment')),
+                ('rental', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='sales.rental')),
+            ],
+            options={
+                'ordering': ('id',),
+                'indexes': [models.Index(fields=('consigner', 'entry_type', 'id'), name='consigner_ledger_type_idx')],
+            },
+        ),
+    ]
@@ -1,16 +1,11 @@
-import decimal
-
 import pytz
 from encrypted_fields import fields
-from itertools import chain
 
 from django.conf import settings
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.shortcuts import reverse
 
-from sales.models import Rental
-
 
 class Consigner(models.Model):
     user = models.OneToOneField('users.User', null=True, blank=True, on_delete=models.SET_NULL)
@@ -36,29 +31,6 @@ class Consigner(models.Model):
             vehicle_links.append(f'<a href="{url}">{vehicle.model}</a>')
         return ', '.join(vehicle_links)
 
-    @property
-    def revenue_history(self):
-        # rental_qs = Rental.objects.filter(vehicle__in=self.vehicle_set.all()).annotate(dummy_amount=Value(None, output_field=models.IntegerField())).values_list('id', 'out_at', 'final_price_data', 'dummy_amount')
-        # payment_qs = self.consignmentpayment_set.all().annotate(dummy_price_data=Value({}, output_field=models.JSONField())).values_list('id', 'paid_at', 'dummy_price_data', 'amount')
-        # return rental_qs.union(payment_qs)
-        rental_qs = Rental.objects.filter(vehicle__in=self.vehicle_set.all(), status=Rental.Status.COMPLETE)
-        payment_qs = self.consignmentpayment_set.all()
-        combined_history = list(chain(rental_qs, payment_qs))
-        sorted_history = sorted(combined_history, key=lambda x: x.transaction_time)
-        total_revenue = 0
-        total_paid = 0
-        for transaction in sorted_history:
-            if transaction._meta.model_name == 'rental':
-                total_revenue += decimal.Decimal(transaction.final_price_data['post_multi_day_discount_subtotal'])
-            else:
-                total_paid += decimal.Decimal(transaction.amount)
-            transaction.running_total = total_revenue
-        return {
-            'history': sorted_history,
-            'total_revenue': total_revenue,
-            'total_paid': total_paid,
-        }
-
     def __str__(self):
         return f'[{self.id}] {self.full_name}'
 
@@ -88,3 +60,45 @@ class ConsignmentPayment(models.Model):
     @property
     def transaction_time(self):
         return self.paid_at
+
+
+# Append-only statement of each consigner's account: a row per rental revenue or payment posted, carrying the consigner's
+# revenue and paid totals as of that row, so a page of history or the current balance is read without summing it all.
+# Rows are never changed; a rental or payment which is later cancelled, corrected or deleted gets a further row for the
+# difference (see consignment.ledger).
+
+class ConsignerLedgerEntry(models.Model):
+
+    class EntryType(models.IntegerChoices):
+        RENTAL = (1, 'Rental')
+        PAYMENT = (2, 'Payment')
+
+    consigner = models.ForeignKey('consignment.Consigner', on_delete=models.CASCADE, related_name='ledger_entries')
+    entry_type = models.IntegerField(choices=EntryType.choices)
+    rental = models.ForeignKey('sales.Rental', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    payment = models.ForeignKey(
+        'consignment.ConsignmentPayment', null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
+    )
+    transacted_at = models.DateTimeField()
+    amount = models.DecimalField(max_digits=9, decimal_places=2)
+    revenue_balance = models.DecimalField(max_digits=11, decimal_places=2)
+    paid_balance = models.DecimalField(max_digits=11, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = (
+            models.Index(fields=('consigner', 'entry_type', 'id'), name='consigner_ledger_type_idx'),
+        )
+
+    @property
+    def is_rental(self):
+        return self.entry_type == self.EntryType.RENTAL
+
+    @property
+    def is_adjustment(self):
+        return self.amount < 0
+
+    @property
+    def balance(self):
+        return self.revenue_balance - self.paid_balance
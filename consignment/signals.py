@@ -0,0 +1,48 @@
+from django.db.models.signals import post_init, post_save, pre_delete
+
+from consignment import ledger
+from consignment.models import ConsignmentPayment, ConsignerLedgerEntry
+from sales.models import Rental
+
+
+# Fields whose change can alter what a rental or payment has posted to the consigner ledger; saves changing none of
+# them skip the ledger queries
+
+LEDGER_FIELDS = {
+    Rental: (ConsignerLedgerEntry.EntryType.RENTAL, ('status', 'vehicle_id', 'final_gross_revenue')),
+    ConsignmentPayment: (ConsignerLedgerEntry.EntryType.PAYMENT, ('consigner_id', 'amount')),
+}
+
+
+def get_ledger_values(instance):
+    fields = LEDGER_FIELDS[type(instance)][1]
+    # None if any of the fields was deferred, rather than loading it
+    if instance.get_deferred_fields() & set(fields):
+        return None
+    return tuple(getattr(instance, field) for field in fields)
+
+
+def remember_ledger_values(sender, instance, **kwargs):
+    instance._ledger_values = get_ledger_values(instance)
+
+
+def ledger_instance_saved(sender, instance, created, **kwargs):
+    values = get_ledger_values(instance)
+    if created and sender is Rental and instance.status != Rental.Status.COMPLETE:
+        pass
+    elif created or instance._ledger_values is None or values != instance._ledger_values:
+        if sender is Rental:
+            ledger.sync_rentals(Rental.objects.filter(pk=instance.pk))
+        else:
+            ledger.sync_payments(ConsignmentPayment.objects.filter(pk=instance.pk))
+    instance._ledger_values = values
+
+
+def ledger_instance_deleted(sender, instance, **kwargs):
+    ledger.reverse(LEDGER_FIELDS[sender][0], instance.pk)
+
+
+for model in LEDGER_FIELDS:
+    post_init.connect(remember_ledger_values, sender=model, dispatch_uid=f'ledger_init_{model.__name__}')
+    post_save.connect(ledger_instance_saved, sender=model, dispatch_uid=f'ledger_save_{model.__name__}')
+    pre_delete.connect(ledger_instance_deleted, sender=model, dispatch_uid=f'ledger_delete_{model.__name__}')
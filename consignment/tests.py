@@ -1,3 +1,228 @@
+from datetime import date, datetime
+from decimal import Decimal
+from freezegun import freeze_time
+
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from fleet.models import Vehicle
+from users.models import User
+from sales.models import Rental
+from consignment import ledger
+from consignment.models import Consigner, ConsignmentReservation, ConsignmentPayment, ConsignerLedgerEntry
+from consignment.utils import ConsignerOccupancy, EventCalendar
+
+
+@freeze_time('2023-06-15 12:00:00')
+class ConsignerOccupancyTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(email='consigner@test.com')
+        self.consigner = Consigner.objects.create(user=self.user, first_name='Test', last_name='Consigner')
+        self.other_consigner = Consigner.objects.create(first_name='Other', last_name='Consigner')
+        self.vehicle_1 = Vehicle.objects.create(external_owner=self.consigner, slug='vehicle-1')
+        self.vehicle_2 = Vehicle.objects.create(external_owner=self.consigner, slug='vehicle-2')
+        self.other_vehicle = Vehicle.objects.create(external_owner=self.other_consigner, slug='other-vehicle')
+        self.rental_1 = Rental.objects.create(vehicle=self.vehicle_1, out_at=self.at(6, 10), back_at=self.at(6, 12))
+        self.rental_2 = Rental.objects.create(vehicle=self.vehicle_2, out_at=self.at(6, 11), back_at=self.at(6, 14))
+        # Runs from before the window into it
+        self.rental_3 = Rental.objects.create(vehicle=self.vehicle_1, out_at=self.at(4, 20), back_at=self.at(5, 2))
+        Rental.objects.create(
+            vehicle=self.vehicle_1, out_at=self.at(6, 20), back_at=self.at(6, 22), status=Rental.Status.CANCELLED,
+        )
+        Rental.objects.create(vehicle=self.other_vehicle, out_at=self.at(6, 1), back_at=self.at(6, 5))
+        self.reservation_1 = ConsignmentReservation.objects.create(
+            consigner=self.consigner, vehicle=self.vehicle_1, out_at=self.at(6, 25), back_at=self.at(6, 27),
+        )
+        self.reservation_2 = ConsignmentReservation.objects.create(
+            consigner=self.consigner, vehicle=self.vehicle_2, out_at=self.at(6, 26), back_at=self.at(7, 1),
+        )
+
+    @staticmethod
+    def at(month, day):
+        return timezone.make_aware(datetime(2023, month, day, 10))
+
+    def get_occupancy(self, vehicle=None):
+        return ConsignerOccupancy.for_months(date(2023, 5, 1), 3, self.consigner, vehicle=vehicle)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            occupancy = self.get_occupancy()
+        self.assertEqual(occupancy.start_date, date(2023, 5, 1))
+        self.assertEqual(occupancy.end_date, date(2023, 7, 31))
+
+    def test_occupancy(self):
+        occupancy = self.get_occupancy()
+        rented = [day for day in range(1, 31) if occupancy.is_rented(date(2023, 6, day))]
+        self.assertEqual(rented, [10, 11, 12, 13, 14])
+        self.assertTrue(occupancy.is_rented(date(2023, 5, 1)))
+        self.assertTrue(occupancy.is_rented(date(2023, 5, 2)))
+        self.assertFalse(occupancy.is_rented(date(2023, 5, 3)))
+        # Cancelled rentals and other consigners' vehicles don't count
+        self.assertFalse(occupancy.is_rented(date(2023, 6, 21)))
+        self.assertFalse(occupancy.is_rented(date(2023, 6, 3)))
+
+        self.assertFalse(occupancy.is_reserved(date(2023, 6, 24)))
+        self.assertEqual(occupancy.get_reservation_ids(date(2023, 6, 25)), [self.reservation_1.id])
+        self.assertEqual(
+            occupancy.get_reservation_ids(date(2023, 6, 27)), sorted([self.reservation_1.id, self.reservation_2.id])
+        )
+        self.assertEqual(occupancy.get_reservation_ids(date(2023, 6, 28)), [self.reservation_2.id])
+        self.assertEqual(occupancy.get_reservation_ids(date(2023, 7, 1)), [self.reservation_2.id])
+        self.assertEqual(occupancy.get_reservation_ids(date(2023, 7, 2)), [])
+
+        with self.assertRaises(ValueError):
+            occupancy.is_rented(date(2023, 8, 1))
+
+    def test_occupancy_for_vehicle(self):
+        occupancy = self.get_occupancy(vehicle=self.vehicle_2)
+        rented = [day for day in range(1, 31) if occupancy.is_rented(date(2023, 6, day))]
+        self.assertEqual(rented, [11, 12, 13, 14])
+        self.assertFalse(occupancy.is_rented(date(2023, 5, 1)))
+        self.assertEqual(occupancy.get_reservation_ids(date(2023, 6, 27)), [self.reservation_2.id])
+
+    def test_event_calendar(self):
+        occupancy = self.get_occupancy()
+        event_calendar = EventCalendar(year=2023, month=6, occupancy=occupancy, firstweekday=6)
+        with self.assertNumQueries(0):
+            html = event_calendar.formatmonth()
+        self.assertIn('class="thu today"', html)
+        self.assertIn('class="sat rental"', html)
+        self.assertIn(
+            f'class="tue reservation" date="06/27/2023" reservationid="{self.reservation_1.id},{self.reservation_2.id}"',
+            html,
+        )
+
+    def test_calendar_widget(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('consignment:calendar-widget'), {'month_offset': -1})
+        self.assertEqual(response.status_code, 200)
+        # Focused on May, so April to June, with the rental running from April into May
+        self.assertIn('April 2023', response.content.decode())
+        self.assertIn('June 2023', response.content.decode())
+        self.assertNotIn('July 2023', response.content.decode())
+        self.assertIn('this-month rental" date="04/30/2023"', response.content.decode())
+        self.assertIn('this-month rental" date="05/01/2023"', response.content.decode())
+
+    def test_calendar_widget_data(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('consignment:calendar-widget-data', kwargs={'slug': self.vehicle_1.slug}))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['today'], '2023-06-15')
+        self.assertEqual([(month['year'], month['month']) for month in data['months']], [(2023, 5), (2023, 6), (2023, 7)])
+        june = data['months'][1]['days']
+        self.assertEqual(len(june), 30)
+        self.assertEqual(june[9], {'date': '2023-06-10', 'rental': True, 'reservation_ids': []})
+        self.assertEqual(june[12], {'date': '2023-06-13', 'rental': False, 'reservation_ids': []})
+        self.assertEqual(june[26], {'date': '2023-06-27', 'rental': False, 'reservation_ids': [self.reservation_1.id]})
+
+
+class ConsignerLedgerTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(email='consigner@test.com')
+        self.consigner = Consigner.objects.create(user=self.user, first_name='Test', last_name='Consigner')
+        self.vehicle = Vehicle.objects.create(external_owner=self.consigner)
+        self.rental_1 = self.create_rental(self.at(5, 1), '100.00')
+        self.rental_2 = self.create_rental(self.at(5, 10), '250.00')
+        self.cancelled_rental = self.create_rental(self.at(5, 20), '999.00', status=Rental.Status.CANCELLED)
+        self.payment = ConsignmentPayment.objects.create(consigner=self.consigner, paid_at=self.at(5, 5), amount=80)
+
+    @staticmethod
+    def at(month, day):
+        return timezone.make_aware(datetime(2023, month, day, 10))
+
+    def create_rental(self, out_at, gross_revenue, status=Rental.Status.COMPLETE):
+        return Rental.objects.create(
+            vehicle=self.vehicle, out_at=out_at, status=status,
+            final_price_data={'subtotal': gross_revenue, 'post_multi_day_discount_subtotal': gross_revenue},
+        )
+
+    def get_entries(self):
+        return list(self.consigner.ledger_entries.values_list(
+            'entry_type', 'amount', 'revenue_balance', 'paid_balance',
+        ))
+
+    def test_posted_on_save(self):
+        rental, payment = ConsignerLedgerEntry.EntryType.RENTAL, ConsignerLedgerEntry.EntryType.PAYMENT
+        self.assertEqual(self.get_entries(), [
+            (rental, Decimal('100.00'), Decimal('100.00'), Decimal('0.00')),
+            (rental, Decimal('250.00'), Decimal('350.00'), Decimal('0.00')),
+            (payment, Decimal('80.00'), Decimal('350.00'), Decimal('80.00')),
+        ])
+
+        # Completing a rental posts it; changing its revenue or cancelling it posts the difference
+        self.cancelled_rental.status = Rental.Status.COMPLETE
+        self.cancelled_rental.save()
+        self.rental_2.final_price_data = {'subtotal': '200.00', 'post_multi_day_discount_subtotal': '200.00'}
+        self.rental_2.save()
+        self.rental_1.status = Rental.Status.CANCELLED
+        self.rental_1.save()
+        # Saves not changing what's owed post nothing
+        self.rental_1.save()
+        self.payment.delete()
+        self.assertEqual(self.get_entries()[3:], [
+            (rental, Decimal('999.00'), Decimal('1349.00'), Decimal('80.00')),
+            (rental, Decimal('-50.00'), Decimal('1299.00'), Decimal('80.00')),
+            (rental, Decimal('-100.00'), Decimal('1199.00'), Decimal('80.00')),
+            (payment, Decimal('-80.00'), Decimal('1199.00'), Decimal('0.00')),
+        ])
+        self.assertEqual(ledger.sync_all(), [])
+
+    def test_sync_all(self):
+        ConsignerLedgerEntry.objects.all().delete()
+        self.assertEqual(len(ledger.sync_all(dry_run=True)), 3)
+        self.assertFalse(ConsignerLedgerEntry.objects.exists())
+        self.assertEqual(len(ledger.sync_all()), 3)
+        # A backfill comes out in date order
+        self.assertEqual(
+            [(entry.rental_id, entry.payment_id) for entry in self.consigner.ledger_entries.all()],
+            [(self.rental_1.id, None), (None, self.payment.id), (self.rental_2.id, None)],
+        )
+        self.assertEqual(ledger.sync_all(), [])
+
+    def test_vehicle_changing_hands(self):
+        new_owner = Consigner.objects.create(
+            user=User.objects.create_user(email='new-owner@test.com'), first_name='New', last_name='Owner',
+        )
+        self.vehicle.external_owner = new_owner
+        self.vehicle.save()
+        self.assertEqual(ledger.sync_all(), [])
+        self.rental_2.save()
+        self.assertEqual(ledger.get_balances(self.consigner)['total_revenue'], Decimal('350.00'))
+
+        # Later rentals go to the new owner, and past ones stay put even once the vehicle leaves consignment
+        self.create_rental(self.at(6, 1), '300.00')
+        self.assertEqual(ledger.get_balances(new_owner)['total_revenue'], Decimal('300.00'))
+        self.vehicle.external_owner = None
+        self.vehicle.save()
+        self.assertEqual(ledger.sync_all(), [])
+        self.assertEqual(ledger.get_balances(self.consigner)['total_revenue'], Decimal('350.00'))
+        self.assertEqual(ledger.get_balances(new_owner)['total_revenue'], Decimal('300.00'))
+
+    def test_statement_pages(self):
+        with self.assertNumQueries(2):
+            statement = ledger.get_statement(self.consigner, page_size=2)
+        self.assertEqual([entry.amount for entry in statement['history']], [Decimal('80.00'), Decimal('250.00')])
+        self.assertEqual(statement['total_revenue'], Decimal('350.00'))
+        self.assertEqual(statement['total_paid'], Decimal('80.00'))
+        statement = ledger.get_statement(self.consigner, before=statement['older'], page_size=2)
+        self.assertEqual([entry.amount for entry in statement['history']], [Decimal('100.00')])
+        self.assertIsNone(statement['older'])
+        self.assertEqual(statement['total_revenue'], Decimal('350.00'))
+
+        statement = ledger.get_statement(self.consigner, entry_type=ConsignerLedgerEntry.EntryType.PAYMENT)
+        self.assertEqual([entry.payment_id for entry in statement['history']], [self.payment.id])
 
-# Create your tests here.
+    def test_statement_csv(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('consignment:statement'))
+        self.assertEqual(response.status_code, 200)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0], 'Date,Type,Reference,Vehicle,Amount,Gross to Date,Paid to Date,Balance')
+        self.assertTrue(rows[3].startswith(f'05/05/2023,Payment,Payment {self.payment.id},,80.00,350.00,80.00,270.00'))
@@ -22,10 +22,13 @@ urlpatterns = [
     path('proceeds/<str:slug>/', views.ProceedsView.as_view(), name='proceeds'),
     path('calendar_widget/', views.CalendarWidgetView.as_view(), name='calendar-widget'),
     path('calendar_widget/<str:slug>/', views.CalendarWidgetView.as_view(), name='calendar-widget'),
+    path('calendar_widget_data/', views.CalendarWidgetDataView.as_view(), name='calendar-widget-data'),
+    path('calendar_widget_data/<str:slug>/', views.CalendarWidgetDataView.as_view(), name='calendar-widget-data'),
     path('reserve/<str:slug>/', views.ReserveView.as_view(), name='reserve'),
     path('unreserve/<int:pk>/', views.ReleaseReservationView.as_view(), name='release-reservation'),
 
     path('payments/history/', views.PaymentHistoryView.as_view(), name='payment-history'),
+    path('payments/statement/', views.StatementView.as_view(), name='statement'),
     path('payments/info/', views.PaymentInfoView.as_view(), name='payment-info'),
 
     path('password/', views.PasswordView.as_view(), name='password'),
@@ -4,19 +4,132 @@ import pytz
 from dateutil.relativedelta import relativedelta
 
 from django.conf import settings
+from django.db.models import IntegerField, Value
 from django.utils import timezone
 
 from consignment.models import Consigner, ConsignmentReservation
 from sales.models import Rental
 
 
+class ConsignerOccupancy:
+    """
+    Which days from start_date to end_date (inclusive) a consigner's vehicles (or just vehicle, if given) are out on a
+    rental or held by one of the consigner's own reservations. Rentals (other than cancelled ones) and consigner
+    reservations are fetched together in a single query, and each booking is bucketed into the local days it spans by a
+    sweep over the window, giving a bitmap of RENTAL/RESERVATION flags per day plus the ids of the consigner reservations
+    covering each day (which the widget needs to release them).
+    """
+    RENTAL = 1
+    RESERVATION = 2
+
+    def __init__(self, start_date: datetime.date, end_date: datetime.date, consigner: Consigner, vehicle=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.num_days = (end_date - start_date).days + 1
+        self.timezone = pytz.timezone(settings.TIME_ZONE)
+        self.days = bytearray(self.num_days)
+        self.reservation_ids = {}
+        self.load(consigner, vehicle)
+
+    @classmethod
+    def for_months(cls, first_month: datetime.date, num_months: int, consigner: Consigner, vehicle=None):
+        # Covers num_months whole months starting with the month of first_month
+        start_date = first_month.replace(day=1)
+        end_date = start_date + relativedelta(months=num_months) - datetime.timedelta(days=1)
+        return cls(start_date, end_date, consigner, vehicle=vehicle)
+
+    def get_day_start(self, date: datetime.date) -> datetime.datetime:
+        return self.timezone.localize(datetime.datetime.combine(date, datetime.time.min))
+
+    def get_bookings(self, consigner: Consigner, vehicle=None):
+        window_start = self.get_day_start(self.start_date)
+        window_end = self.get_day_start(self.end_date + datetime.timedelta(days=1))
+        rentals = Rental.objects.filter(
+            vehicle__external_owner=consigner, out_at__lt=window_end, back_at__gte=window_start,
+        ).exclude(status=Rental.Status.CANCELLED)
+        consigner_reservations = ConsignmentReservation.objects.filter(
+            consigner=consigner, out_at__lt=window_end, back_at__gte=window_start,
+        )
+        if vehicle:
+            rentals = rentals.filter(vehicle=vehicle)
+            consigner_reservations = consigner_reservations.filter(vehicle=vehicle)
+        # Default orderings are cleared, as ORDER BY isn't allowed inside a UNION on every backend
+        return rentals.order_by().annotate(
+            kind=Value(self.RENTAL, output_field=IntegerField()),
+        ).values_list('id', 'out_at', 'back_at', 'kind').union(
+            consigner_reservations.order_by().annotate(
+                kind=Value(self.RESERVATION, output_field=IntegerField()),
+            ).values_list('id', 'out_at', 'back_at', 'kind'),
+            all=True,
+        )
+
+    def load(self, consigner: Consigner, vehicle=None) -> None:
+        # Per-day change in the number of bookings of each kind, and the reservations starting and ending on each day
+        deltas = {self.RENTAL: [0] * (self.num_days + 1), self.RESERVATION: [0] * (self.num_days + 1)}
+        starting = {}
+        ending = {}
+        for booking_id, out_at, back_at, kind in self.get_bookings(consigner, vehicle=vehicle):
+            first = max((out_at.astimezone(self.timezone).date() - self.start_date).days, 0)
+            last = min((back_at.astimezone(self.timezone).date() - self.start_date).days, self.num_days - 1)
+            if first > last:
+                continue
+            deltas[kind][first] += 1
+            deltas[kind][last + 1] -= 1
+            if kind == self.RESERVATION:
+                starting.setdefault(first, []).append(booking_id)
+                ending.setdefault(last + 1, []).append(booking_id)
+
+        counts = {self.RENTAL: 0, self.RESERVATION: 0}
+        active_reservation_ids = set()
+        for day in range(self.num_days):
+            for kind, kind_deltas in deltas.items():
+                counts[kind] += kind_deltas[day]
+                if counts[kind]:
+                    self.days[day] |= kind
+            active_reservation_ids.difference_update(ending.get(day, ()))
+            active_reservation_ids.update(starting.get(day, ()))
+            if active_reservation_ids:
+                self.reservation_ids[day] = sorted(active_reservation_ids)
+
+    def get_index(self, date: datetime.date) -> int:
+        index = (date - self.start_date).days
+        if not 0 <= index < self.num_days:
+            raise ValueError(f'{date} is outside {self.start_date} to {self.end_date}.')
+        return index
+
+    def is_rented(self, date: datetime.date) -> bool:
+        return bool(self.days[self.get_index(date)] & self.RENTAL)
+
+    def is_reserved(self, date: datetime.date) -> bool:
+        return bool(self.days[self.get_index(date)] & self.RESERVATION)
+
+    def get_reservation_ids(self, date: datetime.date) -> list:
+        return self.reservation_ids.get(self.get_index(date), [])
+
+    def get_month(self, year: int, month: int) -> list:
+        # Every day of the month, for rendering on the client
+        month_days = []
+        for day in range(1, calendar.monthrange(year, month)[1] + 1):
+            date = datetime.date(year, month, day)
+            month_days.append({
+                'date': date,
+                'rental': self.is_rented(date),
+                'reservation_ids': self.get_reservation_ids(date),
+            })
+        return month_days
+
+
 class EventCalendar(calendar.HTMLCalendar):
+    """
+    A month of the consigner calendar widget, rendered from a ConsignerOccupancy covering it (which can be shared by
+    several months), so rendering doesn't query the database.
+    """
 
-    def __init__(self, year=None, month=None, consigner=None, vehicle=None, **kwargs):
+    def __init__(self, year=None, month=None, occupancy=None, today=None, **kwargs):
         self.year = year
         self.month = month
-        self.consigner = consigner
-        self.vehicle = vehicle
+        self.occupancy = occupancy
+        self.today = today or timezone.localdate()
         super().__init__(**kwargs)
 
     def formatday(self, day, weekday):
@@ -26,37 +139,21 @@ class EventCalendar(calendar.HTMLCalendar):
         if day == 0:
             # day outside month
             return '<td class="%s">&nbsp;</td>' % self.cssclass_noday
-        focus_date = datetime.datetime(self.year, self.month, day)
-        focus_date = pytz.timezone(settings.TIME_ZONE).localize(focus_date)
-
-        # Filter rentals/reservations down to the current (localized) date, without hitting the DB again
-        rentals = set(filter(lambda r: r.out_date <= focus_date.date() <= r.back_date, self.rentals))
-        consigner_reservations = set(filter(lambda r: r.out_date <= focus_date.date() <= r.back_date, self.consigner_reservations))
+        focus_date = datetime.date(self.year, self.month, day)
 
         date_str = focus_date.strftime(settings.DATE_FORMAT_INPUT)
         classes = self.cssclasses[weekday]
         reservation_id_str = ''
-        if focus_date.date() == timezone.now().astimezone(pytz.timezone(settings.TIME_ZONE)).date():
+        if focus_date == self.today:
             classes += ' today'
-        if rentals:
+        if self.occupancy.is_rented(focus_date):
             classes += ' rental'
-        if consigner_reservations:
+        if self.occupancy.is_reserved(focus_date):
             classes += ' reservation'
-            reservation_id_str = 'reservationid="%s"' % ','.join([str(r.id) for r in consigner_reservations])
+            reservation_id_str = 'reservationid="%s"' % ','.join(
+                [str(r) for r in self.occupancy.get_reservation_ids(focus_date)]
+            )
         return '<td class="%s" date="%s" %s><div class="day-label">%d</div></td>' % (classes, date_str, reservation_id_str, day)
 
     def formatmonth(self, withyear=True):
-        month_start = datetime.datetime(self.year, self.month, 1)
-        month_start = pytz.timezone(settings.TIME_ZONE).localize(month_start)
-        next_month_start = month_start + relativedelta(months=1)
-
-        # Get filtered rentals and reservations which are relevant for the selected month
-        self.rentals = Rental.objects.filter(out_at__lte=next_month_start, back_at__gte=month_start)
-        self.rentals = self.rentals.filter(vehicle__external_owner=self.consigner)
-        self.consigner_reservations = ConsignmentReservation.objects.filter(out_at__lte=next_month_start, back_at__gte=month_start)
-        self.consigner_reservations = self.consigner_reservations.filter(consigner=self.consigner)
-        if self.vehicle:
-            self.rentals = self.rentals.filter(vehicle=self.vehicle)
-            self.consigner_reservations = self.consigner_reservations.filter(vehicle=self.vehicle)
-
         return super().formatmonth(self.year, self.month, withyear=withyear)
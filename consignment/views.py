@@ -4,8 +4,11 @@ from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
 from django.shortcuts import render
-from django.views.generic import TemplateView, FormView, CreateView, UpdateView, DeleteView
+from django.views.generic import View, TemplateView, FormView, CreateView, UpdateView, DeleteView
+from django.views.generic.base import ContextMixin
 from django.urls import reverse, reverse_lazy
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.http import Http404, JsonResponse
@@ -15,8 +18,9 @@ from django.contrib.auth.views import LoginView, PasswordResetView, PasswordRese
 from users.views import LogoutView
 from fleet.models import Vehicle, VehicleStatus
 from sales.models import Rental
-from consignment.utils import EventCalendar
-from consignment.models import Consigner, ConsignmentReservation
+from consignment import ledger
+from consignment.utils import ConsignerOccupancy, EventCalendar
+from consignment.models import Consigner, ConsignmentReservation, ConsignerLedgerEntry
 from consignment.forms import PasswordForm, ConsignerPaymentInfoForm, ConsignmentReservationForm
 
 logger = logging.getLogger(__name__)
@@ -68,34 +72,47 @@ class ProceedsView(SidebarMixin, VehicleContextMixin, TemplateView):
             vehicle__in=self.request.user.consigner.vehicle_set.all(),
             # vehicle__status=VehicleStatus.READY,
             status=Rental.Status.COMPLETE,
-        ).order_by('out_at')
+        ).select_related('vehicle').order_by('out_at')
         if 'vehicle' in context:
             context['past_rentals'] = context['past_rentals'].filter(vehicle=context['vehicle'])
-        context['total_gross'] = sum([Decimal(x.gross_revenue) for x in context['past_rentals']])
+        context['total_gross'] = context['past_rentals'].aggregate(
+            total=Coalesce(Sum('final_gross_revenue'), Decimal('0')),
+        )['total']
         return context
 
 
-class CalendarWidgetView(VehicleContextMixin, TemplateView):
-    template_name = 'consignment/ajax/calendar_widget.html'
+class CalendarWidgetMixin:
+    """
+    The three months shown by the calendar widget (the month month_offset months from now, and the months either side of
+    it), with the consigner's occupancy over all three loaded at once.
+    """
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        now = timezone.now()
+    def get_month_offset(self):
         try:
-            month_offset = int(self.request.GET.get('month_offset'))
+            return int(self.request.GET.get('month_offset'))
         except (TypeError, ValueError):
-            month_offset = 0
+            return 0
+
+    def get_months(self, today):
+        focus_date = today.replace(day=1) + relativedelta(months=self.get_month_offset())
+        return [focus_date + relativedelta(months=offset) for offset in (-1, 0, 1)]
+
+    def get_occupancy(self, months, vehicle=None):
+        return ConsignerOccupancy.for_months(months[0], len(months), self.request.user.consigner, vehicle=vehicle)
 
-        focus_date = now + relativedelta(months=month_offset)
-        prev_date = focus_date - relativedelta(months=1)
-        next_date = focus_date + relativedelta(months=1)
 
-        consigner = self.request.user.consigner
-        vehicle = context.get('vehicle')
+class CalendarWidgetView(CalendarWidgetMixin, VehicleContextMixin, TemplateView):
+    template_name = 'consignment/ajax/calendar_widget.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        today = timezone.localdate()
+        prev_date, focus_date, next_date = self.get_months(today)
+        occupancy = self.get_occupancy([prev_date, focus_date, next_date], vehicle=context.get('vehicle'))
 
-        focus_cal = EventCalendar(year=focus_date.year, month=focus_date.month, consigner=consigner, vehicle=vehicle, firstweekday=6)
-        prev_cal = EventCalendar(year=prev_date.year, month=prev_date.month, consigner=consigner, vehicle=vehicle, firstweekday=6)
-        next_cal = EventCalendar(year=next_date.year, month=next_date.month, consigner=consigner, vehicle=vehicle, firstweekday=6)
+        focus_cal = EventCalendar(year=focus_date.year, month=focus_date.month, occupancy=occupancy, today=today, firstweekday=6)
+        prev_cal = EventCalendar(year=prev_date.year, month=prev_date.month, occupancy=occupancy, today=today, firstweekday=6)
+        next_cal = EventCalendar(year=next_date.year, month=next_date.month, occupancy=occupancy, today=today, firstweekday=6)
         day_cssclasses = [
             'mon calendar-date this-month',
             'tue calendar-date this-month',
@@ -124,6 +141,29 @@ class CalendarWidgetView(VehicleContextMixin, TemplateView):
         return context
 
 
+class CalendarWidgetDataView(CalendarWidgetMixin, VehicleContextMixin, ContextMixin, View):
+    """
+    The calendar widget's three months as JSON, for rendering on the client: each day's date, whether it's taken by a
+    rental, and the ids of the consigner reservations on it.
+    """
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        today = timezone.localdate()
+        months = self.get_months(today)
+        occupancy = self.get_occupancy(months, vehicle=context.get('vehicle'))
+        return JsonResponse({
+            'today': today,
+            'months': [
+                {
+                    'year': month.year,
+                    'month': month.month,
+                    'days': occupancy.get_month(month.year, month.month),
+                } for month in months
+            ],
+        })
+
+
 class ReserveView(CreateView):
     form_class = ConsignmentReservationForm
     model = ConsignmentReservation
@@ -166,6 +206,21 @@ class PaymentHistoryView(SidebarMixin, TemplateView):
     template_name = 'consignment/payment_history.html'
     selected_page = 'payments'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['statement'] = ledger.get_statement(
+            self.request.user.consigner,
+            before=ledger.get_cursor(self.request),
+            entry_type=ConsignerLedgerEntry.EntryType.PAYMENT,
+        )
+        return context
+
+
+class StatementView(View):
+
+    def get(self, request, *args, **kwargs):
+        return ledger.get_statement_response(request.user.consigner)
+
 
 class PaymentInfoView(SidebarMixin, UpdateView):
     template_name = 'consignment/payment_info.html'
@@ -0,0 +1,137 @@
+from array import array
+
+from django.conf import settings
+from django.utils import timezone
+
+from fleet.models import VehicleMarketing
+from sales.pricing import get_multi_day_discount_pct
+
+
+class DayIndexedValues:
+    """
+    Read-only view of one vehicle's slice of a FleetPriceMatrix array, indexed by number of days (1-based).
+    Accepts string indexes so templates can use e.g. {{ prices.3 }}.
+    """
+    def __init__(self, values: array, offset: int, max_days: int):
+        self.values = values
+        self.offset = offset
+        self.max_days = max_days
+
+    def __getitem__(self, num_days):
+        num_days = int(num_days)
+        if not 1 <= num_days <= self.max_days:
+            raise IndexError(f'num_days must be between 1 and {self.max_days}.')
+        return self.values[self.offset + num_days - 1]
+
+    def __iter__(self):
+        return iter(self.values[self.offset:self.offset + self.max_days])
+
+    def __len__(self):
+        return self.max_days
+
+
+class VehiclePriceRow(DayIndexedValues):
+    """
+    One vehicle's row in a FleetPriceMatrix. Indexing by number of days returns the multi-day discounted price
+    (before promotions or extra miles).
+    """
+    def __init__(self, matrix: 'FleetPriceMatrix', index: int):
+        super().__init__(matrix.prices, index * matrix.max_days, matrix.max_days)
+        self.matrix = matrix
+        self.vehicle = matrix.vehicles[index]
+
+    @property
+    def promotional(self) -> DayIndexedValues:
+        return DayIndexedValues(self.matrix.promotional_prices, self.offset, self.max_days)
+
+    @property
+    def miles_included(self) -> DayIndexedValues:
+        return DayIndexedValues(self.matrix.miles_included, self.offset, self.max_days)
+
+    def as_dict(self) -> dict:
+        return {num_days: round(price, 2) for num_days, price in enumerate(self, start=1)}
+
+
+class FleetPriceMatrix:
+    """
+    Computes the rental price of every vehicle for every duration from 1 to max_days in a single pass over one
+    snapshot of VehicleMarketing rows, so that price lists can be rendered without per-cell model method calls.
+
+    Values are stored in flat arrays, one row of max_days cells per vehicle:
+    - prices: base price less multi-day discount
+    - promotional_prices: prices less the discount of the promotion in effect (if any)
+    - miles_included: miles included for the duration
+    Extra-miles surcharges are a separate vector, in the order of settings.EXTRA_MILES_PRICES, since they do not
+    depend on the vehicle.
+    """
+    MAX_DAYS = 14
+
+    def __init__(self, vehicles, promotion=None, max_days: int = MAX_DAYS):
+        self.vehicles = list(vehicles)
+        self.promotion = promotion
+        self.max_days = max_days
+        self.vehicle_index = {vehicle.id: index for index, vehicle in enumerate(self.vehicles)}
+
+        self.extra_miles_options = list(settings.EXTRA_MILES_PRICES.keys())
+        self.extra_miles_costs = array('d', (
+            float(settings.EXTRA_MILES_PRICES[extra_miles]['cost']) for extra_miles in self.extra_miles_options
+        ))
+
+        cell_count = len(self.vehicles) * max_days
+        self.prices = array('d', [0.0]) * cell_count
+        self.promotional_prices = array('d', [0.0]) * cell_count
+        self.miles_included = array('l', [0]) * cell_count
+
+        durations = range(1, max_days + 1)
+        for index, vehicle in enumerate(self.vehicles):
+            offset = index * max_days
+            price_per_day = float(vehicle.price_per_day or 0)
+            miles_per_day = vehicle.miles_included or 0
+            discount_pcts = (vehicle.discount_2_day or 0, vehicle.discount_3_day or 0, vehicle.discount_7_day or 0)
+            for num_days in durations:
+                discount_pct = get_multi_day_discount_pct(num_days, *discount_pcts)
+                price = price_per_day * num_days * (1 - discount_pct / 100)
+                cell = offset + num_days - 1
+                self.prices[cell] = price
+                self.promotional_prices[cell] = price - self.get_promotion_discount(price)
+                self.miles_included[cell] = miles_per_day * num_days
+
+    @classmethod
+    def for_ready_vehicles(cls, effective_date=None, pricing_context=None, queryset=None, **kwargs):
+        # TODO: Refactor sales.models classes to avoid this nested import
+        from sales.calculators import PricingContext
+        from sales.enums import ServiceType
+        if queryset is None:
+            queryset = VehicleMarketing.objects.ready().order_by('vehicle_type', 'id')
+        pricing_context = pricing_context or PricingContext()
+        effective_date = effective_date or timezone.localdate()
+        promotion = pricing_context.get_promotion(effective_date, service_type=ServiceType.RENTAL)
+        return cls(queryset, promotion=promotion, **kwargs)
+
+    def get_promotion_discount(self, value: float) -> float:
+        if not self.promotion:
+            return 0
+        return float(self.promotion.get_discount_value(value) or 0)
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def __iter__(self):
+        return (VehiclePriceRow(self, index) for index in range(len(self.vehicles)))
+
+    def __contains__(self, vehicle_id):
+        return vehicle_id in self.vehicle_index
+
+    def row(self, vehicle_id: int) -> VehiclePriceRow:
+        return VehiclePriceRow(self, self.vehicle_index[vehicle_id])
+
+    def get_extra_miles_cost(self, extra_miles: int) -> float:
+        try:
+            return self.extra_miles_costs[self.extra_miles_options.index(int(extra_miles))]
+        except ValueError:
+            return 0
+
+    def get_price(self, vehicle_id: int, num_days: int, extra_miles: int = 0, promotional: bool = False) -> float:
+        row = self.row(vehicle_id)
+        price = row.promotional[num_days] if promotional else row[num_days]
+        return price + self.get_extra_miles_cost(extra_miles)
@@ -0,0 +1,232 @@
+# Fleet-wide schedule board: every vehicle's rentals, reservations, guided drives, consigner reservations and scheduled
+# services over a window of days, laid out in lanes for a Gantt chart. The board is built from one range query per kind
+# of booking plus one for the vehicles, so the number of queries doesn't grow with the size of the fleet or the window.
+
+import datetime
+import heapq
+from typing import NamedTuple
+
+import pytz
+
+from django.conf import settings
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+
+from fleet.models import Vehicle
+
+
+class ScheduleItem(NamedTuple):
+    kind: str
+    id: int
+    vehicle_id: int
+    start: datetime.datetime
+    end: datetime.datetime
+    label: str
+    status: str
+    url: str
+
+
+def get_url_template(url_name: str) -> str:
+    # Detail page URL with a {} placeholder for the pk, so reverse() runs once per kind of item rather than per item
+    return reverse(url_name, kwargs={'pk': 0}).replace('/0/', '/{}/')
+
+
+def layout_lanes(items) -> list:
+    """
+    Sweep-line interval partitioning: items are taken in order of start, and each goes into the lowest-numbered lane
+    which is free by then (an item may start in a lane at the moment the previous one ends), opening a new lane only if
+    all are busy. This takes O(n log n) and uses the fewest lanes possible, i.e. the most items overlapping at any one
+    moment.
+    """
+    lanes = []
+    busy_lanes = []  # Heap of (end, lane index)
+    free_lanes = []  # Heap of lane index
+    for item in sorted(items, key=lambda item: (item.start, item.end)):
+        while busy_lanes and busy_lanes[0][0] <= item.start:
+            heapq.heappush(free_lanes, heapq.heappop(busy_lanes)[1])
+        if free_lanes:
+            lane = heapq.heappop(free_lanes)
+        else:
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(item)
+        heapq.heappush(busy_lanes, (item.end, lane))
+    return lanes
+
+
+class FleetSchedule:
+    """
+    Everything scheduled on the fleet's vehicles from start_date for num_days days (up to MAX_DAYS). Rentals (other
+    than cancelled ones), reservations and consigner reservations span their out and back times; guided drives take up
+    the whole requested date on each of their vehicle choices, and scheduled services the whole date they are next due.
+    """
+    MAX_DAYS = 90
+
+    RESERVATION = 'reservation'
+    RENTAL = 'rental'
+    JOY_RIDE = 'joy_ride'
+    PERFORMANCE_EXPERIENCE = 'performance_experience'
+    CONSIGNMENT = 'consignment'
+    SERVICE = 'service'
+
+    def __init__(self, start_date: datetime.date, num_days: int):
+        if not 1 <= num_days <= self.MAX_DAYS:
+            raise ValueError(f'The schedule can cover 1 to {self.MAX_DAYS} days.')
+        self.start_date = start_date
+        self.num_days = num_days
+        self.end_date = start_date + datetime.timedelta(days=num_days)
+        self.timezone = pytz.timezone(settings.TIME_ZONE)
+        self.start = self.get_day_start(self.start_date)
+        self.end = self.get_day_start(self.end_date)
+        self.vehicles = []
+        self.items = {}
+        self.load()
+
+    @classmethod
+    def from_params(cls, start_date: str = None, num_days: str = None, default_num_days: int = 30):
+        # Builds a schedule from request parameters (YYYY-MM-DD and a number of days); raises ValueError if invalid
+        start_date = datetime.date.fromisoformat(start_date) if start_date else timezone.localdate()
+        num_days = int(num_days) if num_days else default_num_days
+        return cls(start_date, num_days)
+
+    def get_day_start(self, date: datetime.date) -> datetime.datetime:
+        return self.timezone.localize(datetime.datetime.combine(date, datetime.time.min))
+
+    def get_day(self, date: datetime.date) -> tuple:
+        # A whole local day, as (start, end)
+        return self.get_day_start(date), self.get_day_start(date + datetime.timedelta(days=1))
+
+    def add(self, item: ScheduleItem) -> None:
+        # Items on vehicles which aren't on the board (e.g. relinquished) are left out
+        if item.vehicle_id in self.items:
+            self.items[item.vehicle_id].append(item)
+
+    def load(self) -> None:
+        # TODO: Refactor sales.models classes to avoid this nested import
+        from sales.models import BaseReservation, Reservation, Rental, GuidedDrive, JoyRide, PerformanceExperience
+        from consignment.models import ConsignmentReservation
+        from service.models import ScheduledService
+
+        vehicles = Vehicle.objects.filter(
+            Q(relinquished_on__isnull=True) | Q(relinquished_on__gte=self.start_date)
+        ).order_by('vehicle_type', 'make', 'model', 'id')
+        for vehicle_id, year, make, model in vehicles.values_list('id', 'year', 'make', 'model'):
+            self.vehicles.append({'id': vehicle_id, 'name': ' '.join(str(part) for part in (year, make, model) if part)})
+            self.items[vehicle_id] = []
+
+        reservation_url = get_url_template('backoffice:reservation-detail')
+        rental_url = get_url_template('backoffice:rental-detail')
+        base_reservations = BaseReservation.objects.filter(
+            vehicle__isnull=False, out_at__lt=self.end, back_at__gte=self.start,
+        ).exclude(rental__status=Rental.Status.CANCELLED)
+        for (
+            base_reservation_id, vehicle_id, out_at, back_at, rental_id, rental_status, reservation_status,
+            first_name, last_name,
+        ) in base_reservations.values_list(
+            'id', 'vehicle_id', 'out_at', 'back_at', 'rental__pk', 'rental__status', 'reservation__status',
+            'customer__first_name', 'customer__last_name',
+        ):
+            label = f'{first_name} {last_name}' if first_name or last_name else ''
+            if rental_id:
+                self.add(ScheduleItem(
+                    self.RENTAL, base_reservation_id, vehicle_id, out_at, back_at, label,
+                    Rental.Status(rental_status).label, rental_url.format(base_reservation_id),
+                ))
+            else:
+                status = Reservation.Status(reservation_status).label if reservation_status is not None else ''
+                self.add(ScheduleItem(
+                    self.RESERVATION, base_reservation_id, vehicle_id, out_at, back_at, label, status,
+                    reservation_url.format(base_reservation_id),
+                ))
+
+        consigner_url = get_url_template('backoffice:consigner-detail')
+        consignment_reservations = ConsignmentReservation.objects.filter(
+            vehicle__isnull=False, out_at__lt=self.end, back_at__gte=self.start,
+        )
+        for (
+            consignment_reservation_id, vehicle_id, out_at, back_at, consigner_id, first_name, last_name,
+        ) in consignment_reservations.values_list(
+            'id', 'vehicle_id', 'out_at', 'back_at', 'consigner_id', 'consigner__first_name', 'consigner__last_name',
+        ):
+            # Consigner reservations link to the consigner
+            label = f'{first_name} {last_name}' if consigner_id else ''
+            url = consigner_url.format(consigner_id) if consigner_id else ''
+            self.add(ScheduleItem(
+                self.CONSIGNMENT, consignment_reservation_id, vehicle_id, out_at, back_at, label, '', url,
+            ))
+
+        for kind, model_class, url_name in (
+            (self.JOY_RIDE, JoyRide, 'backoffice:joyride-detail'),
+            (self.PERFORMANCE_EXPERIENCE, PerformanceExperience, 'backoffice:perfexp-detail'),
+        ):
+            url = get_url_template(url_name)
+            guided_drives = model_class.objects.filter(
+                requested_date__gte=self.start_date, requested_date__lt=self.end_date,
+            ).exclude(status=GuidedDrive.Status.CANCELLED)
+            for (
+                guided_drive_id, requested_date, status, first_name, last_name, *vehicle_ids,
+            ) in guided_drives.values_list(
+                'id', 'requested_date', 'status', 'customer__first_name', 'customer__last_name',
+                'vehicle_choice_1_id', 'vehicle_choice_2_id', 'vehicle_choice_3_id',
+            ):
+                start, end = self.get_day(requested_date)
+                label = f'{first_name} {last_name}' if first_name or last_name else ''
+                for vehicle_id in set(vehicle_ids) - {None}:
+                    self.add(ScheduleItem(
+                        kind, guided_drive_id, vehicle_id, start, end, label, GuidedDrive.Status(status).label,
+                        url.format(guided_drive_id),
+                    ))
+
+        service_url = get_url_template('backoffice:service-detail-scheduled')
+        scheduled_services = ScheduledService.objects.filter(
+            vehicle__isnull=False, next_at__gte=self.start, next_at__lt=self.end,
+        )
+        for service_id, vehicle_id, next_at, name, is_due in scheduled_services.values_list(
+            'id', 'vehicle_id', 'next_at', 'name', 'is_due',
+        ):
+            start, end = self.get_day(next_at.astimezone(self.timezone).date())
+            self.add(ScheduleItem(
+                self.SERVICE, service_id, vehicle_id, start, end, name, 'Due' if is_due else '',
+                service_url.format(service_id),
+            ))
+
+    def get_position(self, item: ScheduleItem) -> tuple:
+        # Left edge and width of item as percentages of the window, clipped to it
+        window = (self.end - self.start).total_seconds()
+        start = max(item.start, self.start)
+        end = min(item.end, self.end)
+        left = (start - self.start).total_seconds() / window * 100
+        width = max((end - start).total_seconds(), 0) / window * 100
+        return round(left, 3), round(width, 3)
+
+    def get_days(self) -> list:
+        return [self.start_date + datetime.timedelta(days=day) for day in range(self.num_days)]
+
+    def as_dict(self) -> dict:
+        vehicles = []
+        for vehicle in self.vehicles:
+            lanes = []
+            for lane in layout_lanes(self.items[vehicle['id']]):
+                lane_items = []
+                for item in lane:
+                    left, width = self.get_position(item)
+                    lane_items.append({
+                        'kind': item.kind,
+                        'id': item.id,
+                        'start': item.start,
+                        'end': item.end,
+                        'label': item.label,
+                        'status': item.status,
+                        'url': item.url,
+                        'left': left,
+                        'width': width,
+                    })
+                lanes.append(lane_items)
+            vehicles.append({**vehicle, 'lanes': lanes})
+        return {
+            'start_date': self.start_date,
+            'end_date': self.end_date - datetime.timedelta(days=1),
+            'num_days': self.num_days,
+            'vehicles': vehicles,
+        }
@@ -1,3 +1,233 @@
+import random
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
 from django.test import TestCase
+from django.utils import timezone
+
+from fleet.models import Vehicle, VehicleMarketing, VehicleStatus
+from fleet.pricing import FleetPriceMatrix
+from fleet.schedule import FleetSchedule, ScheduleItem, layout_lanes
+from sales.calculators import RentalPriceCalculator, quantize_currency
+from sales.models import TaxRate, Promotion, BaseReservation, Reservation, Rental, JoyRide
+from consignment.models import ConsignmentReservation
+from service.models import ScheduledService
+
+
+class FleetPriceMatrixTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.vehicle_1 = VehicleMarketing.objects.create(
+            status=VehicleStatus.READY,
+            price_per_day=500,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+            miles_included=100,
+        )
+        self.vehicle_2 = VehicleMarketing.objects.create(
+            status=VehicleStatus.READY,
+            price_per_day=1250,
+            discount_2_day=5,
+            discount_3_day=0,
+            discount_7_day=25,
+            miles_included=75,
+        )
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code='07430',
+            total_rate=0.06625,
+        )
+        self.promotion_1 = Promotion.objects.create(
+            percent=20,
+            name='Father\'s Day',
+            end_date=date(2022, 6, 11),
+        )
+
+    def test_matches_calculator(self):
+        """
+        Every cell agrees with the post-multi-day-discount subtotal of RentalPriceCalculator
+        """
+        price_matrix = FleetPriceMatrix.for_ready_vehicles(effective_date=date(2022, 6, 1))
+        for vehicle in (self.vehicle_1, self.vehicle_2):
+            prices = price_matrix.row(vehicle.id)
+            for num_days in range(1, FleetPriceMatrix.MAX_DAYS + 1):
+                price_data = RentalPriceCalculator(
+                    vehicle, num_days, 0, coupon_code=None, email=None, tax_zip='07430',
+                    effective_date=date(2022, 6, 1),
+                ).get_price_data()
+                self.assertEqual(quantize_currency(prices[num_days]), price_data['post_multi_day_discount_subtotal'])
+                self.assertEqual(
+                    quantize_currency(prices.promotional[num_days]),
+                    price_data['post_multi_day_discount_subtotal'] - price_data['promotion_discount'],
+                )
+                self.assertEqual(prices.miles_included[num_days], vehicle.miles_included * num_days)
+
+    def test_extra_miles_and_template_lookups(self):
+        price_matrix = FleetPriceMatrix.for_ready_vehicles(effective_date=date(2022, 7, 1))
+        self.assertIsNone(price_matrix.promotion)
+        self.assertEqual(price_matrix.get_price(self.vehicle_1.id, 2, extra_miles=200), 900 + 330)
+        self.assertEqual(price_matrix.get_price(self.vehicle_1.id, 2, extra_miles=999), 900)
+        # Template variable resolution passes indexes as strings
+        self.assertEqual(price_matrix.row(self.vehicle_2.id)['7'], 1250 * 7 * 0.75)
+        with self.assertRaises(IndexError):
+            price_matrix.row(self.vehicle_2.id)[FleetPriceMatrix.MAX_DAYS + 1]
+
+    def test_single_snapshot_query(self):
+        with self.assertNumQueries(1, using='front'):
+            price_matrix = FleetPriceMatrix(VehicleMarketing.objects.ready().order_by('id'))
+            rows = [price_matrix.row(vehicle.id).as_dict() for vehicle in price_matrix.vehicles]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0][3], Decimal('1200.00'))
+
+
+def at(month, day, hour=10):
+    return timezone.make_aware(datetime(2023, month, day, hour))
+
+
+class FleetScheduleTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.vehicle_1 = Vehicle.objects.create(year=2020, make='Ferrari', model='F8')
+        self.vehicle_2 = Vehicle.objects.create(year=2019, make='Porsche', model='911')
+        self.vehicle_3 = Vehicle.objects.create(make='Lotus', model='Evora', relinquished_on=date(2023, 1, 1))
+        self.rental_1 = Rental.objects.create(vehicle=self.vehicle_1, out_at=at(6, 1), back_at=at(6, 4))
+        self.rental_2 = Rental.objects.create(vehicle=self.vehicle_1, out_at=at(6, 4), back_at=at(6, 6))
+        self.reservation_1 = Reservation.objects.create(vehicle=self.vehicle_1, out_at=at(6, 2), back_at=at(6, 5))
+        self.reservation_2 = Reservation.objects.create(vehicle=self.vehicle_1, out_at=at(6, 3), back_at=at(6, 7))
+        Rental.objects.create(
+            vehicle=self.vehicle_1, out_at=at(6, 2), back_at=at(6, 3), status=Rental.Status.CANCELLED,
+        )
+        self.consignment_reservation_1 = ConsignmentReservation.objects.create(
+            vehicle=self.vehicle_2, out_at=at(5, 28), back_at=at(6, 2),
+        )
+        self.joy_ride_1 = JoyRide.objects.create(
+            requested_date=date(2023, 6, 10), vehicle_choice_1=self.vehicle_1, vehicle_choice_2=self.vehicle_2,
+        )
+        self.scheduled_service_1 = ScheduledService.objects.create(
+            vehicle=self.vehicle_2, name='Oil change', next_at=at(6, 15), is_due=True,
+        )
+        # Outside the window
+        Rental.objects.create(vehicle=self.vehicle_2, out_at=at(7, 5), back_at=at(7, 8))
+        Rental.objects.create(vehicle=self.vehicle_3, out_at=at(6, 5), back_at=at(6, 8))
+
+    def test_layout_lanes(self):
+        schedule = FleetSchedule(date(2023, 6, 1), 30)
+        lanes = schedule.as_dict()['vehicles']
+
+        # Relinquished vehicles are left off
+        self.assertEqual([vehicle['id'] for vehicle in lanes], [self.vehicle_1.id, self.vehicle_2.id])
+        self.assertEqual(lanes[0]['name'], '2020 Ferrari F8')
+
+        # rental_2 follows rental_1 in the first lane, as it starts when rental_1 ends
+        self.assertEqual([[(item['kind'], item['id']) for item in lane] for lane in lanes[0]['lanes']], [
+            [('rental', self.rental_1.id), ('rental', self.rental_2.id), ('joy_ride', self.joy_ride_1.id)],
+            [('reservation', self.reservation_1.id)],
+            [('reservation', self.reservation_2.id)],
+        ])
+        self.assertEqual([[(item['kind'], item['id']) for item in lane] for lane in lanes[1]['lanes']], [
+            [
+                ('consignment', self.consignment_reservation_1.id),
+                ('joy_ride', self.joy_ride_1.id),
+                ('service', self.scheduled_service_1.id),
+            ],
+        ])
+
+        # Items are positioned as percentages of the window, and clipped to it
+        consignment_reservation = lanes[1]['lanes'][0][0]
+        self.assertEqual(consignment_reservation['left'], 0)
+        self.assertEqual(consignment_reservation['width'], round(34 / (30 * 24) * 100, 3))
+        joy_ride = lanes[1]['lanes'][0][1]
+        self.assertEqual(joy_ride['left'], round(9 / 30 * 100, 3))
+        self.assertEqual(joy_ride['width'], round(1 / 30 * 100, 3))
+        self.assertEqual(joy_ride['url'], f'/backoffice/joy_rides/{self.joy_ride_1.id}/')
+        self.assertEqual(lanes[1]['lanes'][0][2]['status'], 'Due')
+
+    def test_lanes_are_minimal(self):
+        rng = random.Random(0)
+        items = []
+        for index in range(200):
+            start = at(1, 1) + timedelta(hours=rng.randrange(0, 24 * 60))
+            end = start + timedelta(hours=rng.randrange(1, 24 * 5))
+            items.append(ScheduleItem(FleetSchedule.SERVICE, index, 1, start, end, '', '', ''))
+        lanes = layout_lanes(items)
+        # The number of lanes is the most items in progress at any one moment
+        max_overlap = max(sum(1 for other in items if other.start <= item.start < other.end) for item in items)
+        self.assertEqual(len(lanes), max_overlap)
+        for lane in lanes:
+            for previous, item in zip(lane, lane[1:]):
+                self.assertLessEqual(previous.end, item.start)
+
+    def test_queries(self):
+        # One query for the vehicles and one for each kind of booking
+        with self.assertNumQueries(6):
+            FleetSchedule(date(2023, 6, 1), 90).as_dict()
+
+    def test_max_days(self):
+        with self.assertRaises(ValueError):
+            FleetSchedule(date(2023, 6, 1), FleetSchedule.MAX_DAYS + 1)
+        with self.assertRaises(ValueError):
+            FleetSchedule.from_params('2023-06-31', '30')
+
+
+class FleetScheduleBenchmarkTestCase(TestCase):
+    """
+    A fleet of 50 vehicles with a year of bookings: back-to-back rentals of 1 to 5 days, a reservation overlapping
+    every fourth one, a weekly joy ride, a consigner reservation a month and a scheduled service a month per vehicle.
+    A 90 day board has to be built in under 100ms.
+    """
+    NUM_VEHICLES = 50
+    TIME_LIMIT_SECS = 0.1
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        vehicles = Vehicle.objects.bulk_create([
+            Vehicle(year=2020, make='Make', model=f'Model {index}') for index in range(cls.NUM_VEHICLES)
+        ])
+        base_reservations, consignment_reservations, scheduled_services, rental_indexes = [], [], [], set()
+        for vehicle in vehicles:
+            out_at = at(1, 1)
+            while out_at.year == 2023:
+                back_at = out_at + timedelta(days=rng.randint(1, 5))
+                if rng.random() < 0.7:
+                    rental_indexes.add(len(base_reservations))
+                base_reservations.append(BaseReservation(vehicle=vehicle, out_at=out_at, back_at=back_at))
+                if len(base_reservations) % 4 == 0:
+                    base_reservations.append(BaseReservation(
+                        vehicle=vehicle, out_at=out_at + timedelta(days=1), back_at=back_at + timedelta(days=1),
+                    ))
+                out_at = back_at + timedelta(days=rng.randint(0, 2))
+            for month in range(1, 13):
+                consignment_reservations.append(ConsignmentReservation(
+                    vehicle=vehicle, out_at=at(month, 10), back_at=at(month, 12),
+                ))
+                scheduled_services.append(ScheduledService(vehicle=vehicle, name='Service', next_at=at(month, 20)))
+        for index, base_reservation in enumerate(base_reservations):
+            base_reservation.confirmation_code = f'B{index:07d}'
+        BaseReservation.objects.bulk_create(base_reservations)
+        # Rental can't be bulk created, being a multi-table child; insert just its own table's rows for the parents
+        for index in rental_indexes:
+            Rental(basereservation_ptr=base_reservations[index], status=Rental.Status.CONFIRMED).save_base(raw=True)
+        ConsignmentReservation.objects.bulk_create(consignment_reservations)
+        ScheduledService.objects.bulk_create(scheduled_services)
+        JoyRide.objects.bulk_create([
+            JoyRide(
+                requested_date=date(2023, 1, 1) + timedelta(weeks=week),
+                vehicle_choice_1=vehicles[week % cls.NUM_VEHICLES],
+                vehicle_choice_2=vehicles[(week + 1) % cls.NUM_VEHICLES],
+                confirmation_code=f'J{week:07d}',
+            ) for week in range(52)
+        ])
 
-# Create your tests here.
+    def test_benchmark(self):
+        timings = []
+        for _ in range(5):
+            started_at = time.perf_counter()
+            board = FleetSchedule(date(2023, 4, 1), FleetSchedule.MAX_DAYS).as_dict()
+            timings.append(time.perf_counter() - started_at)
+        self.assertEqual(len(board['vehicles']), self.NUM_VEHICLES)
+        self.assertGreater(sum(len(lane) for vehicle in board['vehicles'] for lane in vehicle['lanes']), 1000)
+        self.assertLess(min(timings), self.TIME_LIMIT_SECS)
@@ -8,6 +8,7 @@ from django.utils import timezone
 
 from users.models import Customer
 from fleet.models import Vehicle, VehicleMarketing, VehicleType, VehicleStatus
+from fleet.pricing import FleetPriceMatrix
 from marketing.models import NewsItem, Tweet, SiteContent, NewsletterSubscription, SurveyResponse
 from marketing.forms import NewsletterSubscribeForm, NewsletterUnsubscribeForm, SurveyResponseForm
 from sales.tasks import send_email
@@ -79,6 +80,7 @@ class VehicleView(NavMenuMixin, TemplateView):
         context['vehicle'] = VehicleMarketing.objects.ready().filter(slug__iexact=slug).first()
         if not context['vehicle']:
             raise Http404
+        context['vehicle_prices'] = FleetPriceMatrix([context['vehicle']]).row(context['vehicle'].id)
         return context
 
 
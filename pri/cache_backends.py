@@ -0,0 +1,33 @@
+# Cache backends counting the hits and misses of reads made while handling a request, for the request metrics (see
+# pri.metrics). Use these in CACHES in place of the Django backends of the same names.
+
+from django.core.cache.backends import locmem, redis
+
+from pri.metrics import record_cache_read
+
+MISSING = object()
+
+
+class CacheReadsMixin:
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, MISSING, version=version)
+        if value is MISSING:
+            record_cache_read(0, 1)
+            return default
+        record_cache_read(1, 0)
+        return value
+
+
+class LocMemCache(CacheReadsMixin, locmem.LocMemCache):
+    # get_many goes through get, so is counted already
+    pass
+
+
+class RedisCache(CacheReadsMixin, redis.RedisCache):
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super().get_many(keys, version=version)
+        record_cache_read(len(values), len(keys) - len(values))
+        return values
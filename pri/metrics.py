@@ -0,0 +1,347 @@
+# Per-route request metrics kept in fixed-size in-process histograms and counters, recorded by RequestMetricsMiddleware:
+# wall time, SQL query count and time, template render time, time waiting on third-party services and cache hits and
+# misses; and per-service metrics of the outbound calls made through pri.outbound. Recording a request only
+# increments a few counters; the text format and merging are done when the metrics are read. Each process publishes a
+# snapshot of its own to the default cache every REQUEST_METRICS_PUBLISH_SECS, so the metrics endpoint and the
+# dump_request_metrics command can report on every app process rather than whichever one serves them.
+
+import atexit
+import bisect
+import contextvars
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name: (help, bucket upper bounds); each also has a +Inf bucket
+HISTOGRAMS = {
+    'request_duration_seconds': ('Wall time of requests', DURATION_BUCKETS),
+    'request_queries': ('SQL queries per request', QUERY_COUNT_BUCKETS),
+    'request_query_seconds': ('Time spent in SQL queries per request', DURATION_BUCKETS),
+    'request_template_seconds': ('Time spent rendering template responses per request', DURATION_BUCKETS),
+    'request_outbound_seconds': ('Time spent waiting on third-party services per request', DURATION_BUCKETS),
+}
+COUNTERS = {
+    'cache_hits_total': 'Cache reads finding their key',
+    'cache_misses_total': 'Cache reads not finding their key',
+}
+
+METRIC_PREFIX = 'pri_'
+UNRESOLVED_ROUTE = 'unresolved'
+INDEX_CACHE_KEY = 'request_metrics_processes'
+
+# RequestStats of the request being handled in this thread (or task), if any
+current_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    # What one request spent its time on, gathered while it's handled
+    __slots__ = (
+        'queries', 'query_time', 'template_time', 'cache_hits', 'cache_misses', 'render_started_at', 'outbound',
+    )
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_started_at = None
+        # {service: [calls, seconds]}
+        self.outbound = {}
+
+    @property
+    def outbound_time(self) -> float:
+        return sum(seconds for calls, seconds in self.outbound.values())
+
+    def add_outbound_call(self, service: str, duration: float) -> None:
+        totals = self.outbound.setdefault(service, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+
+    def get_breakdown(self) -> str:
+        # Where the request's time went, e.g. 'SQL 0.120s (14 queries), stripe 2.310s (1 call)'
+        parts = [f'SQL {self.query_time:.3f}s ({self.queries} queries)']
+        if self.template_time:
+            parts.append(f'templates {self.template_time:.3f}s')
+        for service, (calls, seconds) in sorted(self.outbound.items(), key=lambda item: item[1][1], reverse=True):
+            parts.append(f'{service} {seconds:.3f}s ({calls} call{"s" if calls != 1 else ""})')
+        return ', '.join(parts)
+
+    def time_query(self, execute, sql, params, many, context):
+        # Database execute_wrapper
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started_at
+
+    def start_render(self) -> None:
+        self.render_started_at = time.perf_counter()
+
+    def end_render(self, response) -> None:
+        # TemplateResponse post-render callback
+        if self.render_started_at is not None:
+            self.template_time += time.perf_counter() - self.render_started_at
+            self.render_started_at = None
+
+
+def record_cache_read(hits: int, misses: int) -> None:
+    stats = current_stats.get()
+    if stats is not None:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+class Histogram:
+    """
+    Counts of observations falling in each bucket (the last being +Inf) and their sum. The counts are per bucket, not
+    cumulative; to_prometheus adds them up.
+    """
+    def __init__(self, buckets: tuple, counts: list = None, total: float = 0.0):
+        self.buckets = buckets
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.sum = total
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def merge(self, counts: list, total: float) -> None:
+        self.counts = [count + other for count, other in zip(self.counts, counts)]
+        self.sum += total
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.histograms = {name: Histogram(buckets) for name, (help_text, buckets) in HISTOGRAMS.items()}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def record(self, duration: float, stats: RequestStats) -> None:
+        self.histograms['request_duration_seconds'].observe(duration)
+        self.histograms['request_queries'].observe(stats.queries)
+        self.histograms['request_query_seconds'].observe(stats.query_time)
+        self.histograms['request_template_seconds'].observe(stats.template_time)
+        self.histograms['request_outbound_seconds'].observe(stats.outbound_time)
+        self.counters['cache_hits_total'] += stats.cache_hits
+        self.counters['cache_misses_total'] += stats.cache_misses
+
+    def snapshot(self) -> dict:
+        return {
+            'histograms': {
+                name: (list(histogram.counts), histogram.sum) for name, histogram in self.histograms.items()
+            },
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, snapshot: dict) -> None:
+        for name, (counts, total) in snapshot['histograms'].items():
+            if name in self.histograms:
+                self.histograms[name].merge(counts, total)
+        for name, value in snapshot['counters'].items():
+            if name in self.counters:
+                self.counters[name] += value
+
+
+class ServiceMetrics:
+    # Outbound calls to one third-party service: their durations, and their failures by error (exception class name,
+    # or e.g. 'HTTP 503')
+
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.errors = {}
+
+    def record(self, duration: float, error: str = None) -> None:
+        self.duration.observe(duration)
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {'duration': (list(self.duration.counts), self.duration.sum), 'errors': dict(self.errors)}
+
+    def merge(self, snapshot: dict) -> None:
+        self.duration.merge(*snapshot['duration'])
+        for error, count in snapshot['errors'].items():
+            self.errors[error] = self.errors.get(error, 0) + count
+
+
+class RequestMetrics:
+    """
+    The metrics of this process, by route (the resolved view_name, e.g. 'backoffice:home') and by outbound service.
+    Routes come from the URL conf, so their number is bounded; requests matching no route share UNRESOLVED_ROUTE.
+    Snapshots are {'routes': {route: ...}, 'services': {service: ...}}.
+    """
+    def __init__(self):
+        self.routes = {}
+        self.services = {}
+        self.lock = threading.Lock()
+        self.published_at = time.monotonic()
+        self.cache_key = f'request_metrics:{socket.gethostname()}:{os.getpid()}'
+
+    def record(self, route: str, duration: float, stats: RequestStats) -> None:
+        with self.lock:
+            route_metrics = self.routes.get(route)
+            if route_metrics is None:
+                route_metrics = self.routes[route] = RouteMetrics()
+            route_metrics.record(duration, stats)
+
+    def record_outbound(self, service: str, duration: float, error: str = None) -> None:
+        with self.lock:
+            service_metrics = self.services.get(service)
+            if service_metrics is None:
+                service_metrics = self.services[service] = ServiceMetrics()
+            service_metrics.record(duration, error)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'routes': {route: route_metrics.snapshot() for route, route_metrics in self.routes.items()},
+                'services': {service: metrics.snapshot() for service, metrics in self.services.items()},
+            }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.routes = {}
+            self.services = {}
+
+    def publish(self) -> None:
+        # Stores this process's snapshot in the cache and makes sure it's listed in the index of processes
+        timeout = settings.REQUEST_METRICS_TIMEOUT_SECS
+        self.published_at = time.monotonic()
+        cache.set(self.cache_key, self.snapshot(), timeout)
+        process_keys = cache.get(INDEX_CACHE_KEY) or set()
+        if self.cache_key not in process_keys:
+            cache.set(INDEX_CACHE_KEY, process_keys | {self.cache_key}, timeout)
+
+    def publish_if_due(self) -> None:
+        if time.monotonic() - self.published_at >= settings.REQUEST_METRICS_PUBLISH_SECS:
+            self.publish()
+
+    def get_all(self) -> dict:
+        # The merged snapshots of every process which has published, with this process's own metrics as they are now
+        snapshots = cache.get_many(cache.get(INDEX_CACHE_KEY) or ())
+        snapshots[self.cache_key] = self.snapshot()
+        return merge_snapshots(snapshots.values())
+
+
+request_metrics = RequestMetrics()
+atexit.register(request_metrics.publish)
+
+
+def merge_snapshots(snapshots) -> dict:
+    routes, services = {}, {}
+    for snapshot in snapshots:
+        for route, route_snapshot in snapshot['routes'].items():
+            if route not in routes:
+                routes[route] = RouteMetrics()
+            routes[route].merge(route_snapshot)
+        for service, service_snapshot in snapshot['services'].items():
+            if service not in services:
+                services[service] = ServiceMetrics()
+            services[service].merge(service_snapshot)
+    return {
+        'routes': {route: route_metrics.snapshot() for route, route_metrics in routes.items()},
+        'services': {service: service_metrics.snapshot() for service, service_metrics in services.items()},
+    }
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(bound) -> str:
+    return '+Inf' if bound is None else repr(float(bound))
+
+
+def get_histogram_lines(metric: str, label: str, buckets: tuple, counts: list, total: float) -> list:
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*buckets, None), counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{{label},le="{format_bound(bound)}"}} {cumulative}')
+    lines.append(f'{metric}_sum{{{label}}} {total!r}')
+    lines.append(f'{metric}_count{{{label}}} {cumulative}')
+    return lines
+
+
+def to_prometheus(snapshot: dict) -> str:
+    # The snapshot in the Prometheus text exposition format (version 0.0.4)
+    lines = []
+    routes, services = snapshot['routes'], snapshot['services']
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        metric = METRIC_PREFIX + name
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for route in sorted(routes):
+            label = f'route="{escape_label(route)}"'
+            lines += get_histogram_lines(metric, label, buckets, *routes[route]['histograms'][name])
+    for name, help_text in COUNTERS.items():
+        metric = METRIC_PREFIX + name
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        for route in sorted(routes):
+            lines.append(f'{metric}{{route="{escape_label(route)}"}} {routes[route]["counters"][name]}')
+
+    metric = METRIC_PREFIX + 'outbound_duration_seconds'
+    lines += [f'# HELP {metric} Duration of calls to third-party services', f'# TYPE {metric} histogram']
+    for service in sorted(services):
+        label = f'service="{escape_label(service)}"'
+        lines += get_histogram_lines(metric, label, DURATION_BUCKETS, *services[service]['duration'])
+    metric = METRIC_PREFIX + 'outbound_errors_total'
+    lines += [f'# HELP {metric} Failed calls to third-party services', f'# TYPE {metric} counter']
+    for service in sorted(services):
+        for error, count in sorted(services[service]['errors'].items()):
+            lines.append(f'{metric}{{service="{escape_label(service)}",error="{escape_label(error)}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_summary(snapshot: dict) -> list:
+    """
+    Per route averages, as dicts with route, requests, total_secs, duration_ms, queries, query_ms, template_ms,
+    outbound_ms and cache_hit_pct (None without cache reads), the routes taking the most time in total first.
+    """
+    rows = []
+    for route, route_snapshot in snapshot['routes'].items():
+        histograms, counters = route_snapshot['histograms'], route_snapshot['counters']
+        requests = sum(histograms['request_duration_seconds'][0])
+        if not requests:
+            continue
+        cache_reads = counters['cache_hits_total'] + counters['cache_misses_total']
+        rows.append({
+            'route': route,
+            'requests': requests,
+            'total_secs': histograms['request_duration_seconds'][1],
+            'duration_ms': histograms['request_duration_seconds'][1] / requests * 1000,
+            'queries': histograms['request_queries'][1] / requests,
+            'query_ms': histograms['request_query_seconds'][1] / requests * 1000,
+            'template_ms': histograms['request_template_seconds'][1] / requests * 1000,
+            'outbound_ms': histograms['request_outbound_seconds'][1] / requests * 1000,
+            'cache_hit_pct': counters['cache_hits_total'] / cache_reads * 100 if cache_reads else None,
+        })
+    return sorted(rows, key=lambda row: row['total_secs'], reverse=True)
+
+
+def get_service_summary(snapshot: dict) -> list:
+    # Per service call counts, mean duration and errors, as dicts with service, calls, total_secs, duration_ms, errors
+    rows = []
+    for service, service_snapshot in snapshot['services'].items():
+        counts, total = service_snapshot['duration']
+        calls = sum(counts)
+        rows.append({
+            'service': service,
+            'calls': calls,
+            'total_secs': total,
+            'duration_ms': total / calls * 1000 if calls else 0.0,
+            'errors': sum(service_snapshot['errors'].values()),
+        })
+    return sorted(rows, key=lambda row: row['total_secs'], reverse=True)
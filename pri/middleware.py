@@ -1,21 +1,88 @@
-import datetime
 import hashlib
+import time
+from contextlib import ExitStack
 
 from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.conf import settings
-from django.urls import resolve, reverse, reverse_lazy
+from django.db import connections
+from django.urls import Resolver404, resolve, reverse, reverse_lazy
 from django.core.exceptions import PermissionDenied
 from django.utils.deprecation import MiddlewareMixin
-from django.contrib.sessions.models import Session
 from django.utils import timezone
 
-from users.models import SessionVisit
+from pri.metrics import RequestStats, current_stats, request_metrics, UNRESOLVED_ROUTE
+from users.visits import start_visit, session_visit_buffer
 from consignment.models import Consigner
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+class RequestMetricsMiddleware:
+    """
+    Records each request's wall time, SQL queries (through an execute_wrapper on every database connection), template
+    response render time, outbound calls (see pri.outbound) and cache reads against its route (see pri.metrics), and
+    logs requests taking longer than SLOW_REQUEST_SECS with a breakdown of their time. Put first in MIDDLEWARE, so the
+    time of the rest of the stack is included. Templates rendered by the view itself (e.g. with render()) count towards
+    the view's time rather than template time.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        started_at = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats.time_query))
+                response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        duration = time.perf_counter() - started_at
+        route = request.resolver_match.view_name if request.resolver_match else UNRESOLVED_ROUTE
+        request_metrics.record(route, duration, stats)
+        if duration >= settings.SLOW_REQUEST_SECS:
+            logger.warning(f'Slow request {request.method} {route} {duration:.3f}s: {stats.get_breakdown()}')
+        request_metrics.publish_if_due()
+        return response
+
+    def process_template_response(self, request, response):
+        # Called last before the response is rendered
+        stats = current_stats.get()
+        if stats is not None:
+            stats.start_render()
+            response.add_post_render_callback(stats.end_render)
+        return response
+
+
+def resolve_request(request):
+    # The URL match stored by ResolveURLMiddleware, or resolved here if it hasn't run; None for a URL matching no route
+    if request.resolver_match is None:
+        try:
+            request.resolver_match = resolve(request.path_info)
+        except Resolver404:
+            return None
+    return request.resolver_match
+
+
+class ResolveURLMiddleware:
+    """
+    Resolves the requested URL once, ahead of the middleware which route on it, and stores the match as
+    request.resolver_match (where Django puts it later for the view). A URL matching no route is left for Django's own
+    404 handling.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        resolve_request(request)
+        return self.get_response(request)
+
+
 class LoginRequiredMiddleware(MiddlewareMixin):
     """
     Middleware that requires a user to be authenticated to view any page other
@@ -25,30 +92,49 @@ class LoginRequiredMiddleware(MiddlewareMixin):
     Unauthenticated views (i.e. the front site) do not have a resolved.app_name
     because they are not mapped to a namespace in the central pri/urls.py.
     """
+    # Apps handling authentication themselves: the front site (no app_name) and the admin site
+    EXEMPT_APPS = frozenset(('', 'admin'))
+    # Login route for each app whose views redirect elsewhere than '<app_name>:login'
+    LOGIN_ROUTES = {
+        'api': 'login',
+    }
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.exempt_routes = frozenset(settings.AUTH_EXEMPT_ROUTES)
+        self.login_urls = {}
+
+    def get_login_url(self, app_name):
+        if app_name not in self.login_urls:
+            self.login_urls[app_name] = reverse(self.LOGIN_ROUTES.get(app_name, f'{app_name}:login'))
+        return self.login_urls[app_name]
+
     def process_request(self, request):
         assert hasattr(request, 'user'), """
         The Login Required middleware needs to be after AuthenticationMiddleware.
         Also make sure to include the template context_processor:
         'django.contrib.auth.context_processors.auth'."""
 
-        if not request.user.is_authenticated:
-            resolved = resolve(request.path_info)
-            current_route_name = resolved.url_name
-            logger.info(f'{current_route_name} {resolved.app_name}')
+        if request.user.is_authenticated:
+            return None
+        resolved = resolve_request(request)
+        if resolved is None or resolved.app_name in self.EXEMPT_APPS or resolved.url_name in self.exempt_routes:
+            return None
+        logger.debug(f'Redirecting {resolved.app_name}:{resolved.url_name} to login')
+        return HttpResponseRedirect(self.get_login_url(resolved.app_name))
+
 
-            # Exempt unauthenticated front-site views, and defer to the built-in auth for admin site
-            if not resolved.app_name or resolved.app_name == 'admin':
-                return None
+def is_backoffice_user(user):
+    # May want to use the more granular Django permissions system instead of just allowing all is_admin
+    return user.is_backoffice
 
-            if current_route_name not in settings.AUTH_EXEMPT_ROUTES:
-                if resolved.app_name == 'api':
-                    logger.info('redirecting to login from api')
-                    return HttpResponseRedirect(reverse('login'))
-                if resolved.app_name:
-                    logger.info(f'redirecting to login from {resolved.app_name}')
-                    return HttpResponseRedirect(reverse(f'{resolved.app_name}:login'))
-                logger.info('redirecting to login with no app_name')
-                return HttpResponseRedirect(reverse('login'))
+
+def is_consigner(user):
+    try:
+        user.consigner
+    except Consigner.DoesNotExist:
+        return False
+    return True
 
 
 class PermissionsMiddleware(object):
@@ -58,55 +144,51 @@ class PermissionsMiddleware(object):
     For apps such as customer_portal, additional logic (such as checking whether the user is an active customer)
     may need to be added.
     """
+    # Check an authenticated user must pass to use each app's views
+    APP_CHECKS = {
+        'backoffice': is_backoffice_user,
+        'consignment': is_consigner,
+    }
+    EXEMPT_ROUTES = frozenset(('sign-out',))
 
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        resolved = resolve(request.path_info)
-        if resolved.url_name == 'sign-out':
-            return self.get_response(request)
-
-        if request.user.is_authenticated:
-            # May want to use the more granular Django permissions system instead of just allowing all is_admin
-            if resolved.app_name == 'backoffice' and not request.user.is_backoffice:
-                logger.info(f'{request.user} not authorized for backoffice.')
+        resolved = resolve_request(request)
+        if resolved and resolved.url_name not in self.EXEMPT_ROUTES and request.user.is_authenticated:
+            check = self.APP_CHECKS.get(resolved.app_name)
+            if check and not check(request.user):
+                logger.info(f'{request.user} not authorized for {resolved.app_name}.')
                 raise PermissionDenied
 
-            if resolved.app_name == 'consignment':
-                try:
-                    request.user.consigner
-                except Consigner.DoesNotExist:
-                    logger.info(f'{request.user} not authorized for consignment.')
-                    raise PermissionDenied
-
         return self.get_response(request)
 
 
 class RemoteHostMiddleware(MiddlewareMixin):
+    """
+    Resolves the remote IP and host, remembers them in the session, and records a SessionVisit the first time a session
+    is seen in an hour. The session is only modified (and so saved) when a remembered value changes; last_access is the
+    start of the latest visit. Whether a visit is new is answered from the cache, and new visits are written in batches
+    (see users.visits), so a typical page view costs no database writes.
+    """
 
-    def visited_within_hour(self, request):
-        one_hour_ago = timezone.now() - datetime.timedelta(hours=1)
-        return SessionVisit.objects.filter(
-            session__session_key=request.session.session_key,
-            visited_at__gte=one_hour_ago,
-        ).exists()
-
-    def record_session_visit(self, request):
-        try:
-            session = Session.objects.get(session_key=request.session.session_key)
-            SessionVisit.objects.create(session=session)
-        except Session.DoesNotExist:
-            pass
+    @staticmethod
+    def set_session_value(request, key, value):
+        if request.session.get(key) != value:
+            request.session[key] = value
 
     def process_request(self, request):
         # Resolve the remote_ip and remote_host and store in session for tracking and reflection in templates
         request.remote_ip = request.META.get('REMOTE_ADDR') or request.META.get('HTTP_X_FORWARDED_FOR')
         request.remote_host = request.META.get('REMOTE_HOST') or request.remote_ip
-        request.session['remote_ip'] = request.remote_ip
-        request.session['user_agent_hash'] = hashlib.md5(request.META.get('HTTP_USER_AGENT', '').encode('utf-8')).hexdigest()
-        request.session['last_access'] = timezone.now().isoformat()
-
-        # If this session has not visited in the past hour, record a SessionVisit
-        if not self.visited_within_hour(request):
-            self.record_session_visit(request)
+        self.set_session_value(request, 'remote_ip', request.remote_ip)
+        user_agent_hash = hashlib.md5(request.META.get('HTTP_USER_AGENT', '').encode('utf-8')).hexdigest()
+        self.set_session_value(request, 'user_agent_hash', user_agent_hash)
+
+        # A session is only given a key once saved, so its first request can't be recorded yet
+        session_key = request.session.session_key
+        if session_key and start_visit(session_key):
+            visited_at = timezone.now()
+            request.session['last_access'] = visited_at.isoformat()
+            session_visit_buffer.add(session_key, visited_at)
@@ -0,0 +1,71 @@
+# Blocking calls to third-party services (Stripe, Avalara, reCAPTCHA, SMTP, wkhtmltopdf, ip-api) go through
+# outbound_call, which times each one into the per-service metrics (see pri.metrics) and into the stats of the request
+# making it, so a slow request can be put down to the service it waited on. Each service has a timeout in
+# OUTBOUND_TIMEOUT_SECS (Avalara's is AVALARA_TIMEOUT_SECS, given to its client).
+
+import logging
+import time
+from contextlib import contextmanager
+
+import requests
+
+from django.conf import settings
+
+from pri.metrics import current_stats, request_metrics
+
+logger = logging.getLogger(__name__)
+
+STRIPE = 'stripe'
+AVALARA = 'avalara'
+RECAPTCHA = 'recaptcha'
+SMTP = 'smtp'
+WKHTMLTOPDF = 'wkhtmltopdf'
+IP_API = 'ip_api'
+
+
+def get_timeout(service: str) -> float:
+    return settings.OUTBOUND_TIMEOUT_SECS[service]
+
+
+class OutboundCall:
+    # Handed out by outbound_call; set error for a call which returned normally but failed (e.g. an HTTP 5xx)
+    __slots__ = ('service', 'error')
+
+    def __init__(self, service: str):
+        self.service = service
+        self.error = None
+
+
+@contextmanager
+def outbound_call(service: str):
+    """
+    Times the enclosed call to service. An exception raised from it counts as an error of the exception's class, and
+    is re-raised.
+    """
+    call = OutboundCall(service)
+    started_at = time.perf_counter()
+    try:
+        yield call
+    except Exception as e:
+        call.error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started_at
+        request_metrics.record_outbound(service, duration, call.error)
+        stats = current_stats.get()
+        if stats is not None:
+            stats.add_outbound_call(service, duration)
+        if call.error:
+            logger.warning(f'{service} call failed after {duration:.3f}s: {call.error}')
+        else:
+            logger.debug(f'{service} call took {duration:.3f}s')
+
+
+def http_request(service: str, method: str, url: str, **kwargs) -> requests.Response:
+    # An HTTP request to service with its timeout; an error status is counted as an error but left to the caller
+    kwargs.setdefault('timeout', get_timeout(service))
+    with outbound_call(service) as call:
+        response = requests.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            call.error = f'HTTP {response.status_code}'
+    return response
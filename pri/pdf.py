@@ -9,6 +9,7 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import os
+import subprocess
 from os.path import basename, splitext
 
 from django.conf import settings
@@ -18,6 +19,31 @@ from django.test import override_settings
 from django.views.generic import TemplateView
 import pdfkit
 
+from pri.outbound import WKHTMLTOPDF, get_timeout, outbound_call
+
+
+def html_to_pdf(html, options=None):
+    """
+    Converts HTML to PDF with wkhtmltopdf (at $WKHTMLTOPDF_BIN, if set), as pdfkit.from_string does, but killing
+    wkhtmltopdf if it runs longer than its outbound timeout.
+
+    :rtype: bytes
+    """
+    kwargs = {}
+    wkhtmltopdf_bin = os.environ.get('WKHTMLTOPDF_BIN')
+    if wkhtmltopdf_bin:
+        kwargs['configuration'] = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_bin)
+    pdf = pdfkit.PDFKit(html, 'string', options=options, **kwargs)
+
+    with outbound_call(WKHTMLTOPDF):
+        result = subprocess.run(
+            pdf.command(), input=html.encode('utf-8'), capture_output=True, timeout=get_timeout(WKHTMLTOPDF),
+        )
+        stderr = (result.stderr or b'').decode('utf-8', errors='replace')
+        if result.returncode != 0 or 'Error' in stderr:
+            raise IOError(f'wkhtmltopdf exited with code {result.returncode}:\n{stderr}')
+    return result.stdout
+
 
 class PDFView(TemplateView):
     #: Set to change the filename of the PDF.
@@ -65,14 +91,7 @@ class PDFView(TemplateView):
         if 'debug' in self.request.GET and settings.DEBUG:
             options['debug-javascript'] = 1
 
-        kwargs = {}
-        wkhtmltopdf_bin = os.environ.get('WKHTMLTOPDF_BIN')
-        if wkhtmltopdf_bin:
-            kwargs['configuration'] = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_bin)
-
-        pdf = pdfkit.from_string(html, False, options, **kwargs)
-
-        return pdf
+        return html_to_pdf(html, options)
 
     def get_pdfkit_options(self):
         """
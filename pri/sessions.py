@@ -0,0 +1,216 @@
+# Session engine (SESSION_ENGINE = 'pri.sessions') keeping sessions in the SESSION_CACHE_ALIAS cache, with the database
+# as a lazily written backup which is read only when the cache doesn't have a session. New sessions are inserted right
+# away, so their keys are unique and can be referenced (e.g. by SessionVisit); later changes are buffered per process
+# and written at the end of a request once they are due, several saves of a session becoming one update. A save
+# changing nothing but SESSION_COALESCED_KEYS (timestamps) goes to the cache only, unless the database copy is older
+# than SESSION_DB_WRITE_INTERVAL_SECS. The cache must be shared by all app processes (e.g. Redis in production): with a
+# per-process cache, a session deleted on logout in one process would still be served from another's cache. A local
+# memory cache is refused unless DEBUG or SESSION_LOCAL_CACHE_ALLOWED (for tests) is set.
+
+import atexit
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.utils import timezone
+
+KEY_PREFIX = 'pri.sessions'
+
+
+def get_session_cache():
+    session_cache = caches[settings.SESSION_CACHE_ALIAS]
+    if isinstance(session_cache, LocMemCache) and not (settings.DEBUG or settings.SESSION_LOCAL_CACHE_ALLOWED):
+        raise ImproperlyConfigured(
+            f'The {settings.SESSION_CACHE_ALIAS!r} cache is local to each process; pri.sessions needs a cache shared '
+            f'by all app processes, such as Redis.'
+        )
+    return session_cache
+
+
+def get_digest(session_data: dict) -> str:
+    # Fingerprint of the session data less the coalesced keys, to tell whether a save changed anything else
+    significant = {key: value for key, value in session_data.items() if key not in settings.SESSION_COALESCED_KEYS}
+    return hashlib.sha1(json.dumps(significant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SessionWriteBuffer:
+    """
+    Process-local buffer of session rows waiting to be written, holding the latest data per session key. Flushed at
+    the end of a request (on request_finished, in the request's thread and connection) once the oldest waiting write
+    is SESSION_DB_WRITE_DELAY_SECS old or SESSION_DB_WRITE_BUFFER_SIZE are waiting, and at exit. Only existing rows
+    are updated; a session deleted in the meantime (e.g. by logging out in another process) stays deleted.
+    """
+    def __init__(self):
+        self.writes = {}
+        self.oldest = None
+        self.lock = threading.Lock()
+
+    def add(self, session_key: str, session_data: str, expire_date: datetime.datetime) -> None:
+        with self.lock:
+            self.writes[session_key] = (session_data, expire_date)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def get(self, session_key: str):
+        # The (session_data, expire_date) waiting for session_key, if any
+        with self.lock:
+            return self.writes.get(session_key)
+
+    def discard(self, session_key: str) -> None:
+        with self.lock:
+            self.writes.pop(session_key, None)
+
+    def is_due(self) -> bool:
+        with self.lock:
+            if not self.writes:
+                return False
+            return (
+                len(self.writes) >= settings.SESSION_DB_WRITE_BUFFER_SIZE
+                or time.monotonic() - self.oldest >= settings.SESSION_DB_WRITE_DELAY_SECS
+            )
+
+    def flush(self) -> int:
+        # Writes the waiting rows, returning the number written
+        with self.lock:
+            writes, self.writes, self.oldest = self.writes, {}, None
+        if not writes:
+            return 0
+        model = SessionStore.get_model_class()
+        existing = set(model.objects.filter(session_key__in=writes).values_list('session_key', flat=True))
+        sessions = [
+            model(session_key=session_key, session_data=session_data, expire_date=expire_date)
+            for session_key, (session_data, expire_date) in writes.items() if session_key in existing
+        ]
+        model.objects.bulk_update(sessions, ('session_data', 'expire_date'))
+        return len(sessions)
+
+    def flush_if_due(self, **kwargs) -> None:
+        if self.is_due():
+            self.flush()
+
+
+session_write_buffer = SessionWriteBuffer()
+request_finished.connect(session_write_buffer.flush_if_due, dispatch_uid='session_write_buffer')
+atexit.register(session_write_buffer.flush)
+
+
+class SessionStore(DBStore):
+    """
+    Cached sessions with a lazily written database copy. Each cache entry holds the session data with the digest and
+    time of the last database write, which decide whether a save needs one.
+    """
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._cache = get_session_cache()
+        # (digest, epoch seconds) of the data as last written to the database
+        self._db_state = None
+        super().__init__(session_key)
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def load(self):
+        try:
+            entry = self._cache.get(self.cache_key)
+        except Exception:
+            # Don't fail if there's an error in the cache; fall back to the database
+            entry = None
+        if entry is not None:
+            self._db_state = entry['db_state']
+            return entry['session']
+
+        pending = session_write_buffer.get(self.session_key)
+        if pending:
+            session_data = self.decode(pending[0])
+        else:
+            session_data = super().load()
+        if self.session_key:
+            self._db_state = (get_digest(session_data), time.time())
+            self.set_cache(session_data)
+        return session_data
+
+    def set_cache(self, session_data: dict) -> None:
+        # The expiry is read from session_data, as the session may not be loaded yet
+        self._cache.set(
+            self.cache_key,
+            {'session': session_data, 'db_state': self._db_state},
+            self.get_expiry_age(expiry=session_data.get('_session_expiry')),
+        )
+
+    def exists(self, session_key):
+        if session_key and (self.cache_key_prefix + session_key) in self._cache:
+            return True
+        return super().exists(session_key)
+
+    def needs_db_write(self, digest: str) -> bool:
+        return (
+            self._db_state is None
+            or self._db_state[0] != digest
+            or time.time() - self._db_state[1] >= settings.SESSION_DB_WRITE_INTERVAL_SECS
+        )
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        session_data = self._get_session(no_load=must_create)
+        digest = get_digest(session_data)
+        if must_create:
+            # Inserted at once, raising CreateError if the key is taken
+            super().save(must_create=True)
+            self._db_state = (digest, time.time())
+        elif self.needs_db_write(digest):
+            session_write_buffer.add(self.session_key, self.encode(session_data), self.get_expiry_date())
+            self._db_state = (digest, time.time())
+        self.set_cache(session_data)
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(self.cache_key_prefix + session_key)
+        session_write_buffer.discard(session_key)
+        super().delete(session_key)
+
+    def flush(self):
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
+
+    @classmethod
+    def clear_expired(cls):
+        """
+        Deletes expired rows in batches of SESSION_CLEANUP_BATCH_SIZE, keeping short locks on a busy table. A row is
+        only treated as expired once SESSION_DB_WRITE_INTERVAL_SECS past its expire_date, as the cached session may
+        have been extended without the row being written yet.
+        """
+        model = cls.get_model_class()
+        cutoff = timezone.now() - datetime.timedelta(seconds=settings.SESSION_DB_WRITE_INTERVAL_SECS)
+        while True:
+            session_keys = list(model.objects.filter(expire_date__lt=cutoff).values_list(
+                'session_key', flat=True,
+            )[:settings.SESSION_CLEANUP_BATCH_SIZE])
+            if not session_keys:
+                return
+            model.objects.filter(session_key__in=session_keys).delete()
@@ -86,9 +86,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pri.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'pri.middleware.ResolveURLMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django_otp.middleware.OTPMiddleware',
@@ -345,6 +347,67 @@ EXTRA_MILES_PRICES = {
 }
 EXTRA_MILES_OVERAGE_PER_MILE = 1.95
 
+# Maximum number of quotes accepted by a single batch quote request
+BATCH_QUOTE_MAX_ITEMS = 100
+
+# Sessions are kept in the database unless a cache shared by all app processes is configured as 'sessions', in which
+# case SESSION_ENGINE = 'pri.sessions' keeps them in that cache and writes them to the database lazily, e.g.:
+#   SESSION_ENGINE: pri.sessions
+#   CACHES:
+#     sessions:
+#       BACKEND: pri.cache_backends.RedisCache
+#       LOCATION: redis://127.0.0.1:6379/1
+# pri.sessions refuses the local memory cache below outside DEBUG, unless LOCAL_CACHE_ALLOWED (meant for tests).
+# Saves changing only the COALESCED_KEYS reach the database at most every DB_WRITE_INTERVAL_SECS. Other changes are
+# written at the end of a request once DB_WRITE_DELAY_SECS old or DB_WRITE_BUFFER_SIZE are waiting. The
+# pri.cache_backends backends count cache hits and misses for the request metrics.
+CACHES = {
+    'default': {
+        'BACKEND': 'pri.cache_backends.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': 'pri.cache_backends.LocMemCache',
+        'LOCATION': 'sessions',
+    },
+}
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_LOCAL_CACHE_ALLOWED = False
+SESSION_COALESCED_KEYS = ('last_access',)
+SESSION_DB_WRITE_INTERVAL_SECS = 600
+SESSION_DB_WRITE_DELAY_SECS = 5
+SESSION_DB_WRITE_BUFFER_SIZE = 100
+SESSION_CLEANUP_BATCH_SIZE = 1000
+
+# A session visit (users.SessionVisit) is recorded at most once per interval per session. Visits are buffered in each
+# process and written in batches every FLUSH_SECS, or as soon as BUFFER_SIZE are waiting.
+SESSION_VISIT_INTERVAL_SECS = 3600
+SESSION_VISIT_FLUSH_SECS = 10
+SESSION_VISIT_BUFFER_SIZE = 100
+SESSION_VISIT_BACKGROUND_WRITE = True
+
+# Request metrics (see pri.metrics) are published by each process to the default cache every PUBLISH_SECS, and dropped
+# TIMEOUT_SECS after a process last published
+REQUEST_METRICS_PUBLISH_SECS = 60
+REQUEST_METRICS_TIMEOUT_SECS = 86400
+# Requests taking longer are logged with a breakdown of where the time went (SQL, templates, third-party services)
+SLOW_REQUEST_SECS = 2.0
+
+# Timeouts of blocking calls to third-party services (see pri.outbound); Avalara's is AVALARA_TIMEOUT_SECS
+OUTBOUND_TIMEOUT_SECS = {
+    'stripe': 30,
+    'recaptcha': 5,
+    'smtp': 10,
+    'wkhtmltopdf': 60,
+    'ip_api': 3,
+}
+
+# Cached quotes are invalidated by bumping a pricing version in the cache whenever a price input is saved. With more
+# than one app process, CACHES must point at a shared backend for the bump to reach every process; sales.cache refuses
+# the local memory cache outside DEBUG unless VERSION_LOCAL_CACHE_ALLOWED (for a single app process).
+PRICE_DATA_CACHE_TIMEOUT = 3600
+VERSION_LOCAL_CACHE_ALLOWED = False
+
 JOY_RIDE_PRICES = {
     '1_pax': 250,
     '2_pax': 450,
@@ -368,6 +431,9 @@ SURVEY_DISCOUNT_PCT = 5
 EXTEND_THRESHOLD_HOURS = 6
 # 30m + 1 second to allow reservations of up to 30m beyond the time of delivery
 RENTAL_GRACE_PERIOD_SECS = 1801
+# Bookings ending up to this many days ago are held in the in-memory availability index; conflict checks reaching
+# further back query the database
+AVAILABILITY_INDEX_DAYS_BACK = 90
 
 # Backoffice site seconds of idle until push to "sleeping" page
 ADMIN_SLEEP_TIMEOUT_SECS = 1500
@@ -385,6 +451,11 @@ AVALARA_MACHINE_NAME = 'Backend server 001'
 AVALARA_ENVIRONMENT = None
 DEFAULT_TAX_ZIP = '07456'
 DEFAULT_TAX_RATE = '0.07'
+AVALARA_TIMEOUT_SECS = 10
+# Quotes use the stored rate (or DEFAULT_TAX_RATE) right away; missing or stale rates are refreshed from Avalara by a
+# background thread in each process, or in bulk by the refresh_tax_rates command
+TAX_RATE_BACKGROUND_REFRESH = True
+TAX_RATE_REFRESH_WORKERS = 8
 
 # Stripe
 STRIPE_ENABLED = True
@@ -112,6 +112,7 @@ urlpatterns = [
     path('media_inquiries/', marketing_views.MediaInquiriesView.as_view(), name='media-inquiries'),
 
     path('api/vehicles/', api_views.GetVehiclesView.as_view(), name='get-vehicles'),
+    path('api/vehicles/available/', api_views.AvailableVehiclesView.as_view(), name='get-available-vehicles'),
     path('api/vehicles/<int:vehicle_id>/', api_views.GetVehicleView.as_view(), name='get-vehicle'),
     path('api/vehicles/<int:vehicle_id>/pics/', api_views.GetVehiclePicsView.as_view(), name='get-vehicle-pics'),
 
@@ -119,6 +120,7 @@ urlpatterns = [
     path('api/validate/rental/payment/', api_views.ValidateRentalPaymentView.as_view(), name='validate-rental-payment'),
     path('api/validate/rental/login/', api_views.ValidateRentalLoginView.as_view(), name='validate-rental-login'),
     path('api/validate/rental/confirm/', api_views.ValidateRentalConfirmView.as_view(), name='validate-rental-confirm'),
+    path('api/quote/rental/batch/', api_views.BatchRentalQuoteView.as_view(), name='batch-rental-quote'),
 
     path('api/validate/joyride/details/', api_views.ValidateJoyRideDetailsView.as_view(), name='validate-joyride-details'),
     path('api/validate/joyride/payment/', api_views.ValidateJoyRidePaymentView.as_view(), name='validate-joyride-payment'),
@@ -142,6 +144,7 @@ urlpatterns = [
     path('api/customers/search/', api_views.SearchCustomersView.as_view(), name='search-customers'),
     path('api/tax_rate/', api_views.TaxRateByZipView.as_view(), name='tax-rate-by-zip'),
     path('api/check_schedule_conflict/', api_views.CheckScheduleConflictView.as_view(), name='check-schedule-conflict'),
+    path('api/fleet_schedule/', api_views.FleetScheduleView.as_view(), name='fleet-schedule'),
     path('api/send_insurance_auth/', api_views.SendInsuranceAuthView.as_view(), name='send-insurance-auth'),
     path('api/send_welcome_email/', api_views.SendWelcomeEmailView.as_view(), name='send-welcome-email'),
     path('api/send_gift_cert_email/', api_views.SendGiftCertEmailView.as_view(), name='send-gift-cert-email'),
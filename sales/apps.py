@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class SalesConfig(AppConfig):
     name = 'sales'
+
+    def ready(self):
+        # Register signal receivers
+        from sales import signals  # noqa: F401
+        from sales.cache import check_version_cache
+        check_version_cache()
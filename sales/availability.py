@@ -0,0 +1,337 @@
+# Vehicle availability for schedule conflict checks. Every rental, reservation and consigner reservation (a block put on
+# the vehicle by its consigner) which occupies a vehicle is held in AvailabilityIndex, an in-memory interval tree per
+# vehicle and kind of booking, so "is vehicle V free between A and B" is answered without a query. The index is loaded
+# with one range query per table and kept current by sales.signals as bookings are saved and deleted.
+
+import datetime
+import threading
+from array import array
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from fleet.models import Vehicle
+from sales.cache import get_version, bump_version
+from sales.models import BaseReservation, Rental
+from consignment.models import ConsignmentReservation
+
+AVAILABILITY_VERSION_CACHE_KEY = 'availability_version'
+
+RESERVATION = BaseReservation.ReservationType.RESERVATION.value
+RENTAL = BaseReservation.ReservationType.RENTAL.value
+CONSIGNMENT = 'consignment'
+KINDS = (RESERVATION, RENTAL, CONSIGNMENT)
+
+KIND_LABELS = {RESERVATION: 'reservation', RENTAL: 'rental', CONSIGNMENT: 'consigner reservation'}
+
+# What keeps a vehicle from being booked: unconfirmed reservations don't, as they may never go ahead
+BLOCKING_KINDS = (RENTAL, CONSIGNMENT)
+
+
+class Booking(NamedTuple):
+    # kind and id identify the row: a BaseReservation id for rentals and reservations, a ConsignmentReservation id
+    # for consignment blocks
+    kind: str
+    id: int
+
+    @property
+    def label(self):
+        return f'{KIND_LABELS[self.kind]} {self.id}'
+
+
+class Conflict(NamedTuple):
+    booking: Booking
+    vehicle_id: int
+    out_at: datetime.datetime
+    back_at: datetime.datetime
+
+
+def to_timestamp(value: datetime.datetime) -> int:
+    return int(value.timestamp())
+
+
+def from_timestamp(value: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+
+
+class IntervalTree:
+    """
+    Static interval tree over closed intervals, kept as arrays sorted by start. The node for a slice [lo, hi) of the
+    arrays is its midpoint, and max_ends[mid] is the latest end anywhere in that slice, so a search can skip every
+    subtree that ends before the query begins. overlaps() takes O(log n); search() lists the k overlapping intervals
+    in O(min(n, k log n)).
+    """
+    def __init__(self, intervals: Iterable[tuple]):
+        # intervals are (start, end, booking) tuples, with start and end as epoch seconds
+        intervals = sorted(intervals)
+        self.starts = array('q', (interval[0] for interval in intervals))
+        self.ends = array('q', (interval[1] for interval in intervals))
+        self.bookings = [interval[2] for interval in intervals]
+        self.max_ends = array('q', self.ends)
+        self.build(0, len(self.bookings))
+
+    def __len__(self):
+        return len(self.bookings)
+
+    def build(self, lo: int, hi: int) -> Optional[int]:
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        max_end = max(
+            max_end for max_end in (self.ends[mid], self.build(lo, mid), self.build(mid + 1, hi))
+            if max_end is not None
+        )
+        self.max_ends[mid] = max_end
+        return max_end
+
+    def overlaps(self, start: int, end: int) -> bool:
+        lo, hi = 0, len(self.bookings)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.starts[mid] <= end and self.ends[mid] >= start:
+                return True
+            # If anything on the left ends in time but doesn't overlap, it starts after end, and so does everything on
+            # the right; so only one side ever needs searching
+            if lo < mid and self.max_ends[(lo + mid) // 2] >= start:
+                hi = mid
+            else:
+                lo = mid + 1
+        return False
+
+    def search(self, start: int, end: int):
+        # Yields (start, end, booking) for every interval overlapping [start, end]
+        stack = [(0, len(self.bookings))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_ends[mid] < start:
+                continue
+            stack.append((lo, mid))
+            if self.starts[mid] <= end:
+                if self.ends[mid] >= start:
+                    yield self.starts[mid], self.ends[mid], self.bookings[mid]
+                stack.append((mid + 1, hi))
+
+
+class AvailabilityIndex:
+    """
+    Rentals (other than cancelled ones), reservations and consigner reservations which end no earlier than
+    AVAILABILITY_INDEX_DAYS_BACK days before the index was loaded, grouped into an IntervalTree per vehicle and kind.
+    Loaded on first use and rebuilt whenever the availability version changes; bookings saved or deleted in this
+    process are applied to it in place (see record()). Checks reaching back before the loaded window go to the database.
+
+    Overlap is inclusive, as it always was for conflict checks: a booking ending at the moment another begins is a
+    conflict.
+
+    A booking saved by another process only reaches this index once that process's version bump is seen, so a check
+    made before saving a booking passes confirm=True: a free answer from the index is then confirmed with a query.
+    """
+    def __init__(self):
+        self.version = None
+        self.since = None
+        self.intervals = {}
+        self.bookings = {}
+        self.trees = {}
+        self.lock = threading.RLock()
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.version = None
+
+    def ensure_loaded(self) -> None:
+        with self.lock:
+            # Read the version before loading, so a bump made while loading is picked up on the next check
+            version = get_version(AVAILABILITY_VERSION_CACHE_KEY)
+            if self.version != version:
+                self.load()
+                self.version = version
+
+    def load(self) -> None:
+        since = timezone.now() - datetime.timedelta(days=settings.AVAILABILITY_INDEX_DAYS_BACK)
+        self.since = to_timestamp(since)
+        self.intervals, self.bookings, self.trees = {}, {}, {}
+        for booking, vehicle_id, out_at, back_at in self.query(back_at_gte=since):
+            self.add(booking, vehicle_id, to_timestamp(out_at), to_timestamp(back_at))
+
+    @staticmethod
+    def query(vehicle_id: int = None, back_at_gte: datetime.datetime = None, out_at_lte: datetime.datetime = None):
+        # Yields (booking, vehicle_id, out_at, back_at) for the bookings in the given range, one query per table
+        filters = {'vehicle__isnull': False, 'out_at__isnull': False, 'back_at__isnull': False}
+        if vehicle_id is not None:
+            filters['vehicle_id'] = vehicle_id
+        if back_at_gte is not None:
+            filters['back_at__gte'] = back_at_gte
+        if out_at_lte is not None:
+            filters['out_at__lte'] = out_at_lte
+
+        base_reservations = BaseReservation.objects.filter(**filters).exclude(rental__status=Rental.Status.CANCELLED)
+        for pk, booking_vehicle_id, out_at, back_at, rental_id in base_reservations.values_list(
+            'id', 'vehicle_id', 'out_at', 'back_at', 'rental__pk',
+        ):
+            yield Booking(RENTAL if rental_id else RESERVATION, pk), booking_vehicle_id, out_at, back_at
+
+        consignment_reservations = ConsignmentReservation.objects.filter(**filters)
+        for pk, booking_vehicle_id, out_at, back_at in consignment_reservations.values_list(
+            'id', 'vehicle_id', 'out_at', 'back_at',
+        ):
+            yield Booking(CONSIGNMENT, pk), booking_vehicle_id, out_at, back_at
+
+    def add(self, booking: Booking, vehicle_id: int, start: int, end: int) -> None:
+        self.intervals.setdefault((vehicle_id, booking.kind), {})[booking] = (start, end)
+        self.bookings[booking] = vehicle_id
+        self.trees.pop((vehicle_id, booking.kind), None)
+
+    def discard(self, booking: Booking) -> None:
+        vehicle_id = self.bookings.pop(booking, None)
+        if vehicle_id is not None:
+            self.intervals[(vehicle_id, booking.kind)].pop(booking, None)
+            self.trees.pop((vehicle_id, booking.kind), None)
+
+    def get_tree(self, vehicle_id: int, kind: str) -> IntervalTree:
+        # Trees are rebuilt from the vehicle's intervals on first use after a change to them
+        with self.lock:
+            tree = self.trees.get((vehicle_id, kind))
+            if tree is None:
+                intervals = self.intervals.get((vehicle_id, kind), {})
+                tree = IntervalTree((start, end, booking) for booking, (start, end) in intervals.items())
+                self.trees[(vehicle_id, kind)] = tree
+            return tree
+
+    @staticmethod
+    def get_booking(instance) -> Booking:
+        if isinstance(instance, ConsignmentReservation):
+            return Booking(CONSIGNMENT, instance.pk)
+        if isinstance(instance, Rental):
+            return Booking(RENTAL, instance.pk)
+        return Booking(RESERVATION, instance.pk)
+
+    @staticmethod
+    def get_interval(instance) -> Optional[tuple]:
+        # The (vehicle_id, start, end) that instance occupies, or None if it doesn't occupy a vehicle
+        if not (instance.vehicle_id and instance.out_at and instance.back_at):
+            return None
+        if isinstance(instance, Rental) and instance.status == Rental.Status.CANCELLED:
+            return None
+        return instance.vehicle_id, to_timestamp(instance.out_at), to_timestamp(instance.back_at)
+
+    def record(self, booking: Booking, interval: Optional[tuple]) -> None:
+        """
+        Applies a saved (or, with interval None, deleted) booking to the index and bumps the availability version. If
+        the index was current, i.e. nothing else has bumped the version since it was loaded, it is kept as it is;
+        otherwise it is reloaded on the next check.
+        """
+        with self.lock:
+            if self.version is not None:
+                self.discard(booking)
+                if interval:
+                    self.add(booking, *interval)
+            version = bump_version(AVAILABILITY_VERSION_CACHE_KEY)
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+            else:
+                self.version = None
+
+    def get_conflicts(
+        self,
+        vehicle_id: int,
+        out_at: datetime.datetime,
+        back_at: datetime.datetime,
+        kinds: Iterable[str] = KINDS,
+        exclude: Iterable[Booking] = (),
+        confirm: bool = False,
+    ) -> list:
+        # Returns the Conflicts for vehicle_id between out_at and back_at, in order of out_at
+        exclude = set(exclude)
+        start, end = to_timestamp(out_at), to_timestamp(back_at)
+        self.ensure_loaded()
+        if start < self.since:
+            return self.query_conflicts(vehicle_id, out_at, back_at, kinds=kinds, exclude=exclude)
+
+        conflicts = []
+        for kind in kinds:
+            for conflict_start, conflict_end, booking in self.get_tree(vehicle_id, kind).search(start, end):
+                if booking not in exclude:
+                    conflicts.append(
+                        Conflict(booking, vehicle_id, from_timestamp(conflict_start), from_timestamp(conflict_end))
+                    )
+        if not conflicts and confirm:
+            return self.query_conflicts(vehicle_id, out_at, back_at, kinds=kinds, exclude=exclude)
+        return sorted(conflicts, key=lambda conflict: conflict.out_at)
+
+    def query_conflicts(
+        self,
+        vehicle_id: int,
+        out_at: datetime.datetime,
+        back_at: datetime.datetime,
+        kinds: Iterable[str] = KINDS,
+        exclude: Iterable[Booking] = (),
+    ) -> list:
+        # get_conflicts() answered from the database
+        conflicts = [
+            Conflict(booking, vehicle_id, conflict_out_at, conflict_back_at)
+            for booking, _, conflict_out_at, conflict_back_at in self.query(
+                vehicle_id=vehicle_id, back_at_gte=out_at, out_at_lte=back_at,
+            )
+            if booking.kind in kinds and booking not in exclude
+        ]
+        return sorted(conflicts, key=lambda conflict: conflict.out_at)
+
+    def is_available(
+        self,
+        vehicle_id: int,
+        out_at: datetime.datetime,
+        back_at: datetime.datetime,
+        kinds: Iterable[str] = KINDS,
+        exclude: Iterable[Booking] = (),
+        confirm: bool = False,
+    ) -> bool:
+        exclude = set(exclude)
+        start, end = to_timestamp(out_at), to_timestamp(back_at)
+        self.ensure_loaded()
+        if exclude or start < self.since:
+            return not self.get_conflicts(vehicle_id, out_at, back_at, kinds=kinds, exclude=exclude, confirm=confirm)
+        if any(self.get_tree(vehicle_id, kind).overlaps(start, end) for kind in kinds):
+            return False
+        return not confirm or not self.query_conflicts(vehicle_id, out_at, back_at, kinds=kinds)
+
+    def get_unavailable_vehicle_ids(
+        self,
+        out_at: datetime.datetime,
+        back_at: datetime.datetime,
+        kinds: Iterable[str] = BLOCKING_KINDS,
+    ) -> set:
+        # Every vehicle with a booking of the given kinds between out_at and back_at
+        start, end = to_timestamp(out_at), to_timestamp(back_at)
+        self.ensure_loaded()
+        if start < self.since:
+            return {
+                vehicle_id for booking, vehicle_id, _, _ in self.query(back_at_gte=out_at, out_at_lte=back_at)
+                if booking.kind in kinds
+            }
+        with self.lock:
+            vehicle_ids = {vehicle_id for vehicle_id, kind in self.intervals if kind in kinds}
+        return {
+            vehicle_id for vehicle_id in vehicle_ids
+            if any(self.get_tree(vehicle_id, kind).overlaps(start, end) for kind in kinds)
+        }
+
+
+availability_index = AvailabilityIndex()
+
+
+def get_free_vehicle_ids(vehicle_marketing_ids: Iterable[int], out_at: datetime.datetime, back_at: datetime.datetime):
+    """
+    Maps each of vehicle_marketing_ids which has a Vehicle free of rentals and consigner reservations between out_at
+    and back_at to the id of the first such Vehicle. VehicleMarketing lives in the front database, so its Vehicles are
+    found with one query on vehicle_marketing_id rather than one lookup per vehicle.
+    """
+    unavailable_vehicle_ids = availability_index.get_unavailable_vehicle_ids(out_at, back_at)
+    vehicles = Vehicle.objects.filter(vehicle_marketing_id__in=vehicle_marketing_ids).order_by('pk')
+    free_vehicle_ids = {}
+    for vehicle_id, vehicle_marketing_id in vehicles.values_list('id', 'vehicle_marketing_id'):
+        if vehicle_id not in unavailable_vehicle_ids:
+            free_vehicle_ids.setdefault(vehicle_marketing_id, vehicle_id)
+    return free_vehicle_ids
@@ -0,0 +1,46 @@
+# Version counters kept in the cache. Data derived from the database (cached quotes, in-memory indexes) remembers the
+# version it was built under and is ignored or rebuilt once the version has been bumped, in this or any other process
+# sharing the cache. The default cache must therefore be shared by all app processes (e.g. Redis in production): with a
+# per-process cache, a bump would never reach the other processes, which would go on serving stale prices,
+# availability, tax rates and IP bans. A local memory cache is refused unless DEBUG or VERSION_LOCAL_CACHE_ALLOWED (for
+# a deployment with a single app process) is set.
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+
+def check_version_cache() -> None:
+    # Called once at startup (see SalesConfig.ready)
+    if isinstance(caches['default'], LocMemCache) and not (settings.DEBUG or settings.VERSION_LOCAL_CACHE_ALLOWED):
+        raise ImproperlyConfigured(
+            'The default cache is local to each process; the version keys in sales.cache need a cache shared by all '
+            'app processes, such as Redis, or VERSION_LOCAL_CACHE_ALLOWED for a single app process.'
+        )
+
+
+def get_new_version() -> int:
+    # Seed from the clock rather than 1, so a version key evicted from the cache can never be re-created with a value
+    # that older derived data was built under
+    return time.time_ns()
+
+
+def get_version(cache_key: str) -> int:
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, get_new_version(), None)
+        version = cache.get(cache_key)
+    return version
+
+
+def bump_version(cache_key: str) -> int:
+    # Returns the new version
+    try:
+        return cache.incr(cache_key)
+    except ValueError:
+        version = get_new_version()
+        cache.set(cache_key, version, None)
+        return version
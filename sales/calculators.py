@@ -1,29 +1,225 @@
+import bisect
 import datetime
 import decimal
+import hashlib
 from abc import ABC
 from typing import Optional
 
 from django.conf import settings
-from django.db.models import Q
+from django.core.cache import cache
 
 from fleet.models import VehicleMarketing
 from sales.models import Promotion, Coupon, TaxRate
+from sales.cache import get_version, bump_version
 from sales.enums import ServiceType
+from sales.tax_rates import get_tax_rate, get_tax_rate_values_version
+from sales.pricing import (
+    quantize_currency, get_rental_price_data, get_performance_experience_price_data, get_joy_ride_price_data,
+)
 from users.models import Customer
 
 
-def quantize_currency(value) -> decimal.Decimal:
-    cents = decimal.Decimal('0.01')
-    return decimal.Decimal(value).quantize(cents, decimal.ROUND_HALF_UP)
+PRICING_VERSION_CACHE_KEY = 'pricing_version'
+
+
+def get_pricing_version() -> int:
+    return get_version(PRICING_VERSION_CACHE_KEY)
+
+
+def bump_pricing_version() -> None:
+    # Called from sales.signals whenever a model that feeds into prices is saved; every cached quote keyed on the
+    # previous version is ignored from then on
+    bump_version(PRICING_VERSION_CACHE_KEY)
+
+
+def get_price_data_cache_key(calculator_class, **kwargs) -> str:
+    normalized_inputs = []
+    for key, value in sorted(kwargs.items()):
+        if key == 'pricing_context':
+            continue
+        if isinstance(value, VehicleMarketing):
+            value = value.id
+        elif key == 'coupon_code' and value:
+            value = value.upper()
+        elif isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+            value = str(decimal.Decimal(str(value)).normalize())
+        normalized_inputs.append(f'{key}={value}')
+    inputs_hash = hashlib.sha1('&'.join(normalized_inputs).encode()).hexdigest()
+    versions = f'{get_pricing_version()}:{get_tax_rate_values_version()}'
+    return f'price_data:{versions}:{calculator_class.__name__}:{inputs_hash}'
+
+
+def get_cached_price_data(calculator_class, **kwargs) -> dict:
+    """
+    Returns calculator_class(**kwargs).get_price_data(), cached under the normalized calculator inputs and the current
+    pricing and tax rate values versions, so repeated identical quotes do not touch the database.
+    """
+    cache_key = get_price_data_cache_key(calculator_class, **kwargs)
+    price_data = cache.get(cache_key)
+    if price_data is None:
+        price_data = calculator_class(**kwargs).get_price_data()
+        cache.set(cache_key, price_data, settings.PRICE_DATA_CACHE_TIMEOUT)
+    return price_data
+
+
+class PromotionIndex:
+    """
+    Process-local index of every Promotion and Coupon, loaded with a single query and rebuilt whenever the pricing
+    version changes (sales.signals bumps it, and invalidates the index directly, when a promotion or coupon is saved or
+    deleted; the version also carries changes made by other processes if the cache is shared).
+
+    Promotions are indexed per service type as a sorted list of dates at which the set of promotions in effect changes,
+    with the promotion that wins on each segment (the first by id, as a .first() query would pick), so resolving the
+    promotion for a date is a bisect. Coupons are indexed by upper-cased code.
+    """
+    def __init__(self):
+        self.version = None
+        self.promotion_intervals = {}
+        self.coupons = {}
+
+    def invalidate(self) -> None:
+        self.version = None
+
+    def ensure_loaded(self) -> None:
+        # Read the version before loading, so a bump made while loading is picked up on the next lookup
+        pricing_version = get_pricing_version()
+        if self.version != pricing_version:
+            self.load()
+            self.version = pricing_version
+
+    def load(self) -> None:
+        promotions = list(Promotion.objects.select_related('coupon').order_by('pk'))
+        coupons = {}
+        for promotion in promotions:
+            try:
+                coupon = promotion.coupon
+            except Coupon.DoesNotExist:
+                continue
+            coupons.setdefault(coupon.code.upper(), []).append(coupon)
+
+        # Coupons are Promotions too, and have always been eligible as promotions if they have a date range
+        promotions = [promotion for promotion in promotions if promotion.end_date]
+        promotion_intervals = {None: self.build_intervals(promotions)}
+        for service_type in ServiceType:
+            promotion_intervals[service_type] = self.build_intervals([
+                promotion for promotion in promotions if promotion.service_type in ('', service_type.value)
+            ])
+        self.promotion_intervals, self.coupons = promotion_intervals, coupons
+
+    @staticmethod
+    def build_intervals(promotions):
+        # Each boundary starts a segment (up to the next boundary) over which the same promotions are in effect
+        boundaries = sorted(
+            {datetime.date.min}
+            | {promotion.start_date for promotion in promotions if promotion.start_date}
+            | {promotion.end_date + datetime.timedelta(days=1) for promotion in promotions}
+        )
+        winners = [
+            next((
+                promotion for promotion in promotions
+                if (promotion.start_date is None or promotion.start_date <= boundary) and promotion.end_date >= boundary
+            ), None)
+            for boundary in boundaries
+        ]
+        return boundaries, winners
+
+    def get_promotion(self, effective_date: datetime.date, service_type: ServiceType = None) -> Optional[Promotion]:
+        if not effective_date:
+            return None
+        self.ensure_loaded()
+        boundaries, winners = self.promotion_intervals[service_type]
+        return winners[bisect.bisect_right(boundaries, effective_date) - 1]
+
+    def get_coupon(self, coupon_code: str) -> Optional[Coupon]:
+        if not coupon_code:
+            return None
+        self.ensure_loaded()
+        coupons = self.coupons.get(coupon_code.upper())
+        return coupons[0] if coupons else None
+
+    def get_unexpired_coupon(self, coupon_code: str, effective_date: datetime.date) -> Optional[Coupon]:
+        if not coupon_code:
+            return None
+        self.ensure_loaded()
+        return next((
+            coupon for coupon in self.coupons.get(coupon_code.upper(), [])
+            if coupon.end_date is None or coupon.end_date >= effective_date
+        ), None)
+
+
+promotion_index = PromotionIndex()
+
+
+class PricingContext:
+    """
+    Resolves the external inputs to a price calculation (effective promotion, coupon, customer and tax rate) once and
+    remembers them, so that every calculator built during a request or batch shares one set of lookups instead of
+    querying again. Each input is memoized under its own key: (effective date, service type), upper-cased coupon code,
+    email, tax ZIP, and vehicle marketing id. Promotions and coupons come from the process-wide promotion_index, tax
+    rates from sales.tax_rates. Batch jobs can preload vehicle marketing up front.
+    """
+    def __init__(self):
+        self.promotions = {}
+        self.coupons = {}
+        self.customers = {}
+        self.tax_rates = {}
+        self.vehicle_marketing = {}
+
+    def get_promotion(self, effective_date: datetime.date, service_type: ServiceType = None) -> Optional[Promotion]:
+        if not effective_date:
+            return None
+        key = (effective_date, service_type)
+        if key not in self.promotions:
+            self.promotions[key] = promotion_index.get_promotion(effective_date, service_type=service_type)
+        return self.promotions[key]
+
+    def get_coupon(self, coupon_code: str) -> Optional[Coupon]:
+        if not coupon_code:
+            return None
+        key = coupon_code.upper()
+        if key not in self.coupons:
+            self.coupons[key] = promotion_index.get_coupon(coupon_code)
+        return self.coupons[key]
+
+    def get_customer(self, email: str) -> Optional[Customer]:
+        if not email:
+            return None
+        if email not in self.customers:
+            self.customers[email] = Customer.objects.filter(user__email=email).select_related('user').first()
+        return self.customers[email]
+
+    def add_customer(self, customer: Customer) -> None:
+        # Seed the context with a customer the caller has already loaded
+        if customer and customer.email:
+            self.customers[customer.email] = customer
+
+    def get_tax_rate(self, tax_zip: str) -> TaxRate:
+        if not tax_zip:
+            raise ValueError('No tax ZIP provided.')
+        if tax_zip not in self.tax_rates:
+            self.tax_rates[tax_zip] = get_tax_rate(tax_zip)
+        return self.tax_rates[tax_zip]
+
+    def get_vehicle_marketing(self, vehicle) -> VehicleMarketing:
+        if vehicle.vehicle_marketing_id not in self.vehicle_marketing:
+            self.vehicle_marketing[vehicle.vehicle_marketing_id] = vehicle.vehicle_marketing
+        return self.vehicle_marketing[vehicle.vehicle_marketing_id]
+
+    def preload_vehicle_marketing(self, vehicle_marketing_ids=None) -> None:
+        # VehicleMarketing lives in the front DB, so it can't be joined to the reservations; fetch it separately
+        queryset = VehicleMarketing.objects.all()
+        if vehicle_marketing_ids is not None:
+            queryset = queryset.filter(id__in=set(vehicle_marketing_ids))
+        self.vehicle_marketing.update(queryset.in_bulk())
 
 
 class PriceCalculator(ABC):
     """
-    Abstract base class implementing utility methods for calculating price structure.
-    Unimplemented methods must be implemented in subclasses such as RentalPriceCalculator.
-    Promotion/coupon/customer/military/one-time discounts are common to all calculators; subclasses
-    with other specific types of discounts (such as multi-day) should implement getter methods on
-    a similar pattern.
+    Abstract base class which resolves the inputs common to all calculators (promotion, coupon, customer, tax rate)
+    through a PricingContext and hands them to the pure functions in sales.pricing as plain values.
+    Promotion/coupon/customer/military/one-time discounts are common to all calculators; subclasses pass their own
+    service-specific inputs (vehicle rates, number of days, number of passengers, etc.) in get_price_data().
+    Pass the same PricingContext to several calculators to resolve the lookups only once.
     """
     service_type: ServiceType = None
 
@@ -32,32 +228,14 @@ class PriceCalculator(ABC):
     effective_date: datetime.date = None
 
     promotion: Promotion = None
-    promotion_discount: float = None
-    post_promotion_discount_subtotal: float = None
-
     coupon: Coupon = None
-    coupon_discount: float = None
-    post_coupon_discount_subtotal: float = None
-
     customer: Customer = None
-    customer_discount: float = None
-    post_customer_discount_subtotal: float = None
-
     is_military: bool = False
-    military_discount: float = None
-    post_military_discount_subtotal: float = None
-
-    one_time_discount: float = None
     one_time_discount_pct: float = None
-    post_one_time_discount_subtotal: float = None
-
-    specific_discount: float = None
-    specific_discount_label: str = ''
-    post_specific_discount: float = None
-
-    subtotal: float = 0.0
     override_subtotal: float = None
 
+    pricing_context: PricingContext = None
+
     def __init__(
             self,
             coupon_code: str,
@@ -67,7 +245,9 @@ class PriceCalculator(ABC):
             is_military: bool = False,
             override_subtotal: float = None,
             one_time_discount_pct: float = None,
+            pricing_context: PricingContext = None,
     ):
+        self.pricing_context = pricing_context or PricingContext()
         self.effective_date = effective_date
         self.promotion = self.get_effective_promotion()
         self.coupon = self.get_coupon(coupon_code)
@@ -80,117 +260,33 @@ class PriceCalculator(ABC):
         self.one_time_discount_pct = one_time_discount_pct
 
     def get_effective_promotion(self) -> Optional[Promotion]:
-        if not self.effective_date:
-            return None
-        # Get all promotions in effect on the given date
-        effective_promotions = Promotion.objects.filter(
-            (Q(start_date__isnull=True) | Q(start_date__lte=self.effective_date)),
-            end_date__gte=self.effective_date,
-        )
-        # Restrict to a specific service type if given
-        if self.service_type:
-            effective_promotions = effective_promotions.filter(
-                Q(service_type='') | Q(service_type=self.service_type.value)
-            )
-        return effective_promotions.first()
+        return self.pricing_context.get_promotion(self.effective_date, service_type=self.service_type)
 
     def get_coupon(self, coupon_code: str) -> Optional[Coupon]:
-        return Coupon.objects.filter(code__iexact=coupon_code).first()
+        return self.pricing_context.get_coupon(coupon_code)
 
     def get_customer(self, email: str) -> Optional[Customer]:
-        return Customer.objects.filter(user__email=email).first()
+        return self.pricing_context.get_customer(email)
 
     def get_tax_rate(self, tax_zip: str) -> TaxRate:
-        if not tax_zip:
-            raise ValueError('No tax ZIP provided.')
-        tax_rate, tax_rate_created = TaxRate.objects.get_or_create(postal_code=tax_zip)
-        return tax_rate
-
-    def get_promotion_discount(self, value: float = None) -> float:
-        if not self.promotion:
-            return 0
-        if value is None:
-            raise ValueError('No base value provided.')
-        return self.promotion.get_discount_value(value)
-
-    def get_coupon_discount(self, value=None) -> float:
-        if not self.coupon:
-            return 0
-        if value is None:
-            raise ValueError('No base value provided.')
-        if self.coupon.is_expired_on(self.effective_date):
-            return 0
-        return self.coupon.get_discount_value(value)
-
-    def get_customer_discount(self, value=None) -> float:
-        if value is None:
-            raise ValueError('No base value provided.')
-        if self.customer and self.customer.discount_pct:
-            return value * self.customer.discount_pct / 100
-        return 0
-
-    def get_military_discount(self, value=None) -> float:
-        if value is None:
-            raise ValueError('No base value provided.')
-        if self.is_military:
-            return value * settings.MILITARY_DISCOUNT_PCT / 100
-        return 0
-
-    def get_one_time_discount(self, value: float = None) -> float:
-        if value is None:
-            raise ValueError('No base value provided.')
-        if self.one_time_discount_pct:
-            return value * self.one_time_discount_pct / 100
-        return 0
-
-    def calculate_specific_discount(self, value: float) -> None:
-        self.promotion_discount = self.get_promotion_discount(value=value)
-        self.coupon_discount = self.get_coupon_discount(value=value)
-        self.customer_discount = self.get_customer_discount(value=value)
-        self.military_discount = self.get_military_discount(value=value)
-        self.one_time_discount = self.get_one_time_discount(value=value)
-
-        specific_discounts = [
-            dict(discount=self.promotion_discount, label='Promotional discount'),
-            dict(discount=self.coupon_discount, label='Coupon discount'),
-            dict(discount=self.customer_discount, label='Customer discount'),
-            dict(discount=self.military_discount, label='Military discount'),
-            dict(discount=self.one_time_discount, label='One-time discount'),
-        ]
-
-        specific_discounts = sorted(specific_discounts, key=lambda x: x['discount'], reverse=True)
-        self.specific_discount = specific_discounts[0]['discount']
-        if self.specific_discount:
-            self.specific_discount_label = specific_discounts[0]['label']
-
-    def get_tax_amount(self, value: float = None) -> float:
-        if value is None:
-            value = self.pre_tax_subtotal
-        return float(self.tax_rate.total_rate) * value
+        return self.pricing_context.get_tax_rate(tax_zip)
 
-    def apply_discount(self, value: float = None) -> float:
-        return self.subtotal - float(value)
-
-    def apply_surcharge(self, value: float = None) -> float:
-        return self.subtotal + float(value)
-
-    @property
-    def base_price(self) -> float:
-        raise NotImplementedError
-
-    @property
-    def computed_subtotal(self) -> float:
-        return self.subtotal
-
-    @property
-    def pre_tax_subtotal(self) -> float:
-        # subtotal should be incrementally calculated in __init__() and returned as its final value
-        return self.override_subtotal or self.computed_subtotal
-
-    @property
-    def total_with_tax(self) -> float:
-        tax_amount = self.get_tax_amount(self.pre_tax_subtotal)
-        return self.pre_tax_subtotal + tax_amount
+    def get_pricing_kwargs(self) -> dict:
+        # Plain-value inputs shared by all the sales.pricing price functions
+        coupon = self.coupon
+        if coupon and coupon.is_expired_on(self.effective_date):
+            coupon = None
+        return dict(
+            tax_zip=self.tax_zip,
+            tax_rate=self.tax_rate.total_rate,
+            customer_id=self.customer.id if self.customer else None,
+            override_subtotal=self.override_subtotal,
+            promotion=(self.promotion.amount, self.promotion.percent) if self.promotion else None,
+            coupon=(coupon.amount, coupon.percent) if coupon else None,
+            customer_discount_pct=self.customer.discount_pct if self.customer else None,
+            military_discount_pct=settings.MILITARY_DISCOUNT_PCT if self.is_military else None,
+            one_time_discount_pct=self.one_time_discount_pct,
+        )
 
     def get_price_data(self) -> dict:
         raise NotImplementedError
@@ -198,7 +294,7 @@ class PriceCalculator(ABC):
 
 class RentalPriceCalculator(PriceCalculator):
     """
-    Price is calculated as follows:
+    Price is calculated as follows (see sales.pricing.get_rental_price_data):
     - Calculator is inited with:
         - vehicle
         - # days
@@ -216,115 +312,34 @@ class RentalPriceCalculator(PriceCalculator):
     - Add extra miles surcharge
     - If subtotal override is provided, it takes the place of the subtotal here
     - Add sales tax
-
-    Interim subtotals (e.g. post_multi_day_discount_subtotal) are for forensics and to return
-    in price_data if necessary
     """
     service_type = ServiceType.RENTAL
 
     vehicle_marketing: VehicleMarketing = None
-
     num_days: int = None
-    multi_day_discount: float = None
-    post_multi_day_discount_subtotal: float = None
-
-    specific_discount: float = None
-    post_specific_discount_subtotal: float = None
-
     extra_miles: int = None
-    extra_miles_surcharge: float = None
-    post_extra_miles_surcharge_subtotal: float = None
 
     def __init__(self, vehicle_marketing: VehicleMarketing, num_days: int, extra_miles: int, **kwargs):
-        # Initialize objects handled by superclass
         super().__init__(**kwargs)
-
-        # initialize objects specific to this calculator class
         self.vehicle_marketing = vehicle_marketing
         self.num_days = num_days
         self.extra_miles = int(extra_miles)
 
-        # Start by calculating the base price
-        self.subtotal = self.base_price
-
-        # Multi-day discount
-        self.multi_day_discount = self.get_multi_day_discount(value=self.subtotal)
-        self.subtotal = self.apply_discount(value=self.multi_day_discount)
-        self.post_multi_day_discount_subtotal = self.subtotal
-
-        # Find and apply greatest specific discount available
-        self.calculate_specific_discount(value=self.subtotal)
-        self.subtotal = self.apply_discount(value=self.specific_discount)
-        self.post_specific_discount_subtotal = self.subtotal
-
-        # Extra miles surcharge
-        self.extra_miles_surcharge = self.get_extra_miles_cost()
-        self.subtotal = self.apply_surcharge(value=self.extra_miles_surcharge)
-        self.post_extra_miles_surcharge_subtotal = self.subtotal
-
-        # Superclass handles sales tax and total from here
-
-    @property
-    def base_price(self) -> float:
-        return float(self.vehicle_marketing.price_per_day * self.num_days)
-
-    @property
-    def multi_day_discount_pct(self) -> int:
-        if self.num_days >= 7:
-            return self.vehicle_marketing.discount_7_day
-        elif self.num_days >= 3:
-            return self.vehicle_marketing.discount_3_day
-        elif self.num_days >= 2:
-            return self.vehicle_marketing.discount_2_day
-        return 0
-
-    def get_multi_day_discount(self, value: float = None) -> float:
-        if value is None:
-            raise ValueError('No base value provided.')
-        return value * self.multi_day_discount_pct / 100
-
-    def get_extra_miles_cost(self) -> float:
-        try:
-            return settings.EXTRA_MILES_PRICES.get(self.extra_miles)['cost']
-        except TypeError:
-            return 0
-
-    @property
-    def reservation_deposit(self) -> float:
-        return self.total_with_tax / 2
-
     def get_price_data(self) -> dict:
-        return dict(
-            vehicle_price_per_day=quantize_currency(self.vehicle_marketing.price_per_day),
+        return get_rental_price_data(
+            price_per_day=self.vehicle_marketing.price_per_day,
             num_days=self.num_days,
-            tax_zip=self.tax_zip,
-            tax_rate=self.tax_rate.total_rate,
-            tax_rate_as_percent=self.tax_rate.total_rate * 100,
-            customer_id=self.customer.id if self.customer else None,
-            base_price=quantize_currency(self.base_price),
-            multi_day_discount=quantize_currency(self.multi_day_discount),
-            multi_day_discount_pct=self.multi_day_discount_pct,
-            post_multi_day_discount_subtotal=quantize_currency(self.post_multi_day_discount_subtotal),
-            promotion_discount=quantize_currency(self.promotion_discount),
-            coupon_discount=quantize_currency(self.coupon_discount),
-            customer_discount=quantize_currency(self.customer_discount),
-            military_discount=quantize_currency(self.military_discount),
-            one_time_discount=quantize_currency(self.one_time_discount),
-            specific_discount=quantize_currency(self.specific_discount),
-            specific_discount_label=self.specific_discount_label,
             extra_miles=self.extra_miles,
-            extra_miles_cost=quantize_currency(self.extra_miles_surcharge),
-            subtotal=quantize_currency(self.pre_tax_subtotal),
-            computed_subtotal=quantize_currency(self.computed_subtotal),
-            total_with_tax=quantize_currency(self.total_with_tax),
-            reservation_deposit=quantize_currency(self.reservation_deposit),
-            tax_amount=quantize_currency(self.get_tax_amount()),
+            discount_2_day=self.vehicle_marketing.discount_2_day,
+            discount_3_day=self.vehicle_marketing.discount_3_day,
+            discount_7_day=self.vehicle_marketing.discount_7_day,
+            **self.get_pricing_kwargs(),
         )
 
 
 class PerformanceExperiencePriceCalculator(PriceCalculator):
     """
-    Price is calculated as follows:
+    Price is calculated as follows (see sales.pricing.get_performance_experience_price_data):
     - Calculator is inited with # drivers, # passengers, coupon code, email, and tax zip
     - Base price is predefined per number of drivers up to 4, above which per-driver rate * number of drivers,
       + per-passenger rate * number of passengers
@@ -339,69 +354,17 @@ class PerformanceExperiencePriceCalculator(PriceCalculator):
         self.num_passengers = num_passengers
         super().__init__(**kwargs)
 
-        # Start by calculating the base price
-        self.subtotal = self.base_price
-
-        # Find and apply greatest specific discount available
-        self.calculate_specific_discount(value=self.subtotal)
-        self.subtotal = self.apply_discount(value=self.specific_discount)
-        self.post_specific_discount_subtotal = self.subtotal
-
-    @property
-    def driver_cost(self) -> float:
-        if not self.num_drivers:
-            return 0
-        if self.num_drivers == 1:
-            return settings.PERFORMANCE_EXPERIENCE_PRICES['1_drv']
-        if self.num_drivers == 2:
-            return settings.PERFORMANCE_EXPERIENCE_PRICES['2_drv']
-        if self.num_drivers == 3:
-            return settings.PERFORMANCE_EXPERIENCE_PRICES['3_drv']
-        if self.num_drivers == 4:
-            return settings.PERFORMANCE_EXPERIENCE_PRICES['4_drv']
-        return settings.PERFORMANCE_EXPERIENCE_PRICES['cost_per_drv_gt_4'] * self.num_drivers
-
-    @property
-    def passenger_cost(self) -> float:
-        if not self.num_passengers:
-            return 0
-        return settings.PERFORMANCE_EXPERIENCE_PRICES['cost_per_pax'] * self.num_passengers
-
-    @property
-    def base_price(self) -> float:
-        return self.driver_cost + self.passenger_cost
-
     def get_price_data(self) -> dict:
-        return dict(
+        return get_performance_experience_price_data(
             num_drivers=self.num_drivers,
             num_passengers=self.num_passengers,
-            driver_cost=self.driver_cost,
-            passenger_cost=self.passenger_cost,
-
-            tax_zip=self.tax_zip,
-            tax_rate=self.tax_rate.total_rate,
-            tax_rate_as_percent=self.tax_rate.total_rate * 100,
-            customer_id=self.customer.id if self.customer else None,
-            base_price=quantize_currency(self.base_price),
-
-            promotion_discount=quantize_currency(self.promotion_discount),
-            coupon_discount=quantize_currency(self.coupon_discount),
-            customer_discount=quantize_currency(self.customer_discount),
-            military_discount=quantize_currency(self.military_discount),
-            one_time_discount=quantize_currency(self.one_time_discount),
-            specific_discount=quantize_currency(self.specific_discount),
-            specific_discount_label=self.specific_discount_label,
-
-            subtotal=quantize_currency(self.pre_tax_subtotal),
-            computed_subtotal=quantize_currency(self.computed_subtotal),
-            total_with_tax=quantize_currency(self.total_with_tax),
-            tax_amount=quantize_currency(self.get_tax_amount()),
+            **self.get_pricing_kwargs(),
         )
 
 
 class JoyRidePriceCalculator(PriceCalculator):
     """
-    Price is calculated as follows:
+    Price is calculated as follows (see sales.pricing.get_joy_ride_price_data):
     - Calculator is inited with # passengers, coupon code, email, and tax zip
     - Base price is predefined per number of passengers up to 4, above which per-passenger rate * number of passengers
     - Subtract largest of (coupon discount, customer discount, promotional discount, military discount, one-time discount)
@@ -413,55 +376,8 @@ class JoyRidePriceCalculator(PriceCalculator):
         self.num_passengers = num_passengers
         super().__init__(**kwargs)
 
-        # Start by calculating the base price
-        self.subtotal = self.base_price
-
-        # Find and apply greatest specific discount available
-        self.calculate_specific_discount(value=self.subtotal)
-        self.subtotal = self.apply_discount(value=self.specific_discount)
-        self.post_specific_discount_subtotal = self.subtotal
-
-    @property
-    def passenger_cost(self) -> float:
-        if not self.num_passengers:
-            return 0
-        if self.num_passengers == 1:
-            return settings.JOY_RIDE_PRICES['1_pax']
-        if self.num_passengers == 2:
-            return settings.JOY_RIDE_PRICES['2_pax']
-        if self.num_passengers == 3:
-            return settings.JOY_RIDE_PRICES['3_pax']
-        if self.num_passengers == 4:
-            return settings.JOY_RIDE_PRICES['4_pax']
-        return settings.JOY_RIDE_PRICES['cost_per_pax_gt_4'] * self.num_passengers
-
-    @property
-    def base_price(self) -> float:
-        return self.passenger_cost
-
     def get_price_data(self) -> dict:
-        return dict(
-            num_drivers=0,
+        return get_joy_ride_price_data(
             num_passengers=self.num_passengers,
-            driver_cost=0,
-            passenger_cost=self.passenger_cost,
-
-            tax_zip=self.tax_zip,
-            tax_rate=self.tax_rate.total_rate,
-            tax_rate_as_percent=self.tax_rate.total_rate * 100,
-            customer_id=self.customer.id if self.customer else None,
-            base_price=quantize_currency(self.base_price),
-
-            promotion_discount=quantize_currency(self.promotion_discount),
-            coupon_discount=quantize_currency(self.coupon_discount),
-            customer_discount=quantize_currency(self.customer_discount),
-            military_discount=quantize_currency(self.military_discount),
-            one_time_discount=quantize_currency(self.one_time_discount),
-            specific_discount=quantize_currency(self.specific_discount),
-            specific_discount_label=self.specific_discount_label,
-
-            subtotal=quantize_currency(self.pre_tax_subtotal),
-            computed_subtotal=quantize_currency(self.computed_subtotal),
-            total_with_tax=quantize_currency(self.total_with_tax),
-            tax_amount=quantize_currency(self.get_tax_amount()),
+            **self.get_pricing_kwargs(),
         )
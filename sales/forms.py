@@ -17,10 +17,15 @@ from django.contrib.auth import password_validation
 from fleet.models import Vehicle, VehicleMarketing, VehicleStatus
 from sales.models import Reservation, Coupon, PerformanceExperience, JoyRide, GiftCertificate, AdHocPayment
 from users.models import Customer
-from sales.calculators import RentalPriceCalculator, PerformanceExperiencePriceCalculator, JoyRidePriceCalculator
+from sales.calculators import (
+    PricingContext, RentalPriceCalculator, PerformanceExperiencePriceCalculator, JoyRidePriceCalculator,
+    get_cached_price_data,
+)
+from sales.availability import availability_index, BLOCKING_KINDS
 from sales.enums import get_service_hours, TRUE_FALSE_CHOICES, get_exp_year_choices, get_exp_month_choices, get_numeric_choices
 from sales.constants import BANK_PHONE_HELP_TEXT
 from backoffice.forms import CSSClassMixin
+from pri.outbound import RECAPTCHA, http_request
 
 logger = logging.getLogger(__name__)
 
@@ -46,7 +51,7 @@ class ReCAPTCHAFormMixin(forms.Form):
             'secret': settings.RECAPTCHA_SECRET_KEY,
             'response': recaptcha_response,
         }
-        return requests.post(settings.RECAPTCHA_VERIFY_URL, data=payload)
+        return http_request(RECAPTCHA, 'POST', settings.RECAPTCHA_VERIFY_URL, data=payload)
 
     def clean(self):
         response = super().clean()
@@ -54,8 +59,11 @@ class ReCAPTCHAFormMixin(forms.Form):
         if settings.RECAPTCHA_ENABLED:
             recaptcha_response = self.data.get('g-recaptcha-response')
             if recaptcha_response:
-                recaptcha_verify_response = self.verify_recaptcha(recaptcha_response)
-                recaptcha_result = recaptcha_verify_response.json()
+                try:
+                    recaptcha_result = self.verify_recaptcha(recaptcha_response).json()
+                except (requests.RequestException, ValueError):
+                    # Unreachable or not answering properly; the visitor can try again
+                    recaptcha_result = {'success': False}
             else:
                 recaptcha_result = {'success': False}
             if not recaptcha_result['success']:
@@ -119,11 +127,42 @@ class FormErrorMixin:
         return f'{list(self.errors.keys())[0]}: {list(self.errors.values())[0][0]}'
 
 
+# Memoizes the price quote for a bound details form. The calculator runs once, and again only if one of the pricing
+# inputs in cleaned_data changes, so views and templates can read form.price_data as often as they like.
+# Promotion/coupon/customer/tax lookups go through a PricingContext, which can be passed in to share it with other
+# forms or calculators in the same request.
+class PriceQuoteMixin:
+    price_input_fields = ()
+
+    _price_quote = None
+    _price_quote_key = None
+
+    def __init__(self, *args, pricing_context=None, **kwargs):
+        self.pricing_context = pricing_context or PricingContext()
+        super().__init__(*args, **kwargs)
+
+    def get_price_quote_key(self):
+        return tuple(self.cleaned_data.get(field) for field in self.price_input_fields)
+
+    def get_price_data(self):
+        raise NotImplementedError
+
+    @property
+    def price_data(self):
+        if not self.is_bound:
+            return None
+        price_quote_key = self.get_price_quote_key()
+        if self._price_quote is None or price_quote_key != self._price_quote_key:
+            self._price_quote = self.get_price_data()
+            self._price_quote_key = price_quote_key
+        return self._price_quote
+
+
 # Rental forms
 
 # 1st phase: Rental Details
 
-class ReservationRentalDetailsForm(FormErrorMixin, forms.ModelForm):
+class ReservationRentalDetailsForm(PriceQuoteMixin, FormErrorMixin, forms.ModelForm):
     error_css_class = 'field-error'
     DRIVERS_CHOICES = (
         (1, '1'),
@@ -135,6 +174,10 @@ class ReservationRentalDetailsForm(FormErrorMixin, forms.ModelForm):
         (1, _('I would like the vehicle to be delivered to me')),
     )
     DATETIME_FORMAT = '%m/%d/%Y %H:%M'
+    price_input_fields = (
+        'vehicle_marketing', 'out_at', 'back_at', 'out_date', 'extra_miles', 'coupon_code', 'email', 'delivery_zip',
+        'is_military',
+    )
     discount = None
     customer = None
     vehicle = None
@@ -242,16 +285,24 @@ class ReservationRentalDetailsForm(FormErrorMixin, forms.ModelForm):
         return self.cleaned_data['delivery_zip']
 
     def clean(self):
-        # TODO: Handle KeyError better
-        try:
-            self.customer = Customer.objects.get(user__email=self.cleaned_data['email'])
-        except (Customer.DoesNotExist, KeyError):
-            pass
+        self.customer = self.pricing_context.get_customer(self.cleaned_data.get('email'))
 
         if not 'vehicle_marketing' in self.cleaned_data:
             raise forms.ValidationError('Invalid vehicle specified.')
 
-        self.vehicle = Vehicle.objects.filter(vehicle_marketing_id=self.cleaned_data['vehicle_marketing'].id).first()
+        # Of the Vehicles behind this VehicleMarketing, book the first one that is free for the selected dates
+        vehicles = Vehicle.objects.filter(vehicle_marketing_id=self.cleaned_data['vehicle_marketing'].id).order_by('pk')
+        out_at = self.cleaned_data.get('out_at')
+        back_at = self.cleaned_data.get('back_at')
+        if out_at and back_at:
+            self.vehicle = next((
+                vehicle for vehicle in vehicles
+                if availability_index.is_available(vehicle.id, out_at, back_at, kinds=BLOCKING_KINDS, confirm=True)
+            ), None)
+            if not self.vehicle:
+                raise forms.ValidationError(_('Sorry, this vehicle is not available for the dates you\'ve selected.'))
+        else:
+            self.vehicle = vehicles.first()
 
         vehicle_marketing = self.vehicle.vehicle_marketing
         self.cleaned_data['miles_included'] = vehicle_marketing.miles_included
@@ -263,13 +314,14 @@ class ReservationRentalDetailsForm(FormErrorMixin, forms.ModelForm):
     def tax_zip(self):
         return self.cleaned_data.get('delivery_zip') or settings.DEFAULT_TAX_ZIP
 
-    @property
-    def price_data(self):
-        if not self.is_bound:
-            return None
+    def get_price_quote_key(self):
+        return super().get_price_quote_key() + (self.vehicle,)
+
+    def get_price_data(self):
         if not self.vehicle:
             return {}
-        price_calculator = RentalPriceCalculator(
+        return get_cached_price_data(
+            RentalPriceCalculator,
             vehicle_marketing=self.cleaned_data.get('vehicle_marketing'),
             num_days=self.instance.num_days,
             extra_miles=self.cleaned_data.get('extra_miles') or 0,
@@ -278,8 +330,8 @@ class ReservationRentalDetailsForm(FormErrorMixin, forms.ModelForm):
             tax_zip=self.tax_zip,
             effective_date=self.cleaned_data.get('out_date'),
             is_military=self.cleaned_data.get('is_military'),
+            pricing_context=self.pricing_context,
         )
-        return price_calculator.get_price_data()
 
     class Meta:
         model = Reservation
@@ -302,9 +354,10 @@ class ReservationRentalLoginForm(ReservationRentalDetailsForm):
 
 # GuidedDrive 1st-phase form; used for both Joy Ride and Performance Experience (both are subclassed below)
 
-class GuidedDriveBaseDetailsForm(forms.Form):
+class GuidedDriveBaseDetailsForm(PriceQuoteMixin, forms.Form):
 
     error_css_class = 'field-error'
+    price_input_fields = ('num_passengers', 'coupon_code', 'email',)
     discount = None
     customer = None
 
@@ -340,11 +393,7 @@ class GuidedDriveBaseDetailsForm(forms.Form):
     def clean(self):
         logger.debug('cleaned:')
         logger.debug(self.cleaned_data)
-        # TODO: Handle KeyError better
-        try:
-            self.customer = Customer.objects.get(user__email=self.cleaned_data['email'])
-        except (Customer.DoesNotExist, KeyError):
-            pass
+        self.customer = self.pricing_context.get_customer(self.cleaned_data.get('email'))
 
         if not any((
                 self.cleaned_data.get('vehicle_choice_1'),
@@ -362,10 +411,6 @@ class GuidedDriveBaseDetailsForm(forms.Form):
     def tax_zip(self):
         return settings.DEFAULT_TAX_ZIP
 
-    @property
-    def price_data(self):
-        raise NotImplementedError
-
 
 # Joy Ride
 
@@ -374,19 +419,17 @@ class JoyRideDetailsForm(GuidedDriveBaseDetailsForm, forms.ModelForm):
 
     num_minors = forms.TypedChoiceField(coerce=lambda x: int(x), choices=get_numeric_choices(min_val=0, max_val=4))
 
-    @property
-    def price_data(self):
-        if not self.is_bound:
-            return None
-        price_calculator = JoyRidePriceCalculator(
+    def get_price_data(self):
+        return get_cached_price_data(
+            JoyRidePriceCalculator,
             num_passengers=self.cleaned_data.get('num_passengers'),
             coupon_code=self.cleaned_data.get('coupon_code'),
             email=self.cleaned_data.get('email'),
             tax_zip=self.tax_zip,
             effective_date=self.cleaned_data.get('out_date'),
             is_military=self.cleaned_data.get('is_military'),
+            pricing_context=self.pricing_context,
         )
-        return price_calculator.get_price_data()
 
     class Meta:
         model = JoyRide
@@ -428,11 +471,11 @@ class PerformanceExperienceDetailsForm(GuidedDriveBaseDetailsForm, forms.ModelFo
     num_drivers = forms.TypedChoiceField(coerce=lambda x: int(x), choices=DRIVERS_CHOICES)
     num_passengers = forms.TypedChoiceField(coerce=lambda x: int(x), choices=PASSENGERS_CHOICES)
 
-    @property
-    def price_data(self):
-        if not self.is_bound:
-            return None
-        price_calculator = PerformanceExperiencePriceCalculator(
+    price_input_fields = GuidedDriveBaseDetailsForm.price_input_fields + ('num_drivers',)
+
+    def get_price_data(self):
+        return get_cached_price_data(
+            PerformanceExperiencePriceCalculator,
             num_drivers=self.cleaned_data.get('num_drivers'),
             num_passengers=self.cleaned_data.get('num_passengers'),
             coupon_code=self.cleaned_data.get('coupon_code'),
@@ -440,8 +483,8 @@ class PerformanceExperienceDetailsForm(GuidedDriveBaseDetailsForm, forms.ModelFo
             tax_zip=self.tax_zip,
             effective_date=self.cleaned_data.get('out_date'),
             is_military=self.cleaned_data.get('is_military'),
+            pricing_context=self.pricing_context,
         )
-        return price_calculator.get_price_data()
 
     class Meta:
         model = PerformanceExperience
@@ -0,0 +1,104 @@
+# Ban checks for reservation requests, answered from IPBanMatcher, an in-memory copy of the active IPBan rows, rather
+# than by loading and testing every ban per request.
+
+import bisect
+import ipaddress
+import logging
+from typing import Union
+
+from django.utils.timezone import now
+
+from sales.cache import get_version, bump_version
+from sales.models import IPBan
+
+logger = logging.getLogger(__name__)
+
+IP_BAN_VERSION_CACHE_KEY = 'ip_ban_version'
+
+
+def bump_ip_ban_version() -> None:
+    bump_version(IP_BAN_VERSION_CACHE_KEY)
+
+
+class IPBanMatcher:
+    """
+    Every active ban as a range of integer addresses, held per IP version as sorted lists of range starts and ends with
+    overlapping and adjacent ranges merged, so checking an address is a bisect whatever the number of bans. Loaded on
+    first use with a single query and rebuilt whenever the IP ban version changes (sales.signals bumps it when an IPBan
+    is saved or deleted) or the earliest of the loaded bans expires. The global kill switch (a ban of 0.0.0.0/0) is
+    kept as a flag.
+    """
+    def __init__(self):
+        self.version = None
+        self.valid_until = None
+        self.kill_switch = False
+        self.ranges = {4: ([], []), 6: ([], [])}
+
+    def invalidate(self) -> None:
+        self.version = None
+
+    def ensure_loaded(self) -> None:
+        # Read the version before loading, so a bump made while loading is picked up on the next lookup
+        version = get_version(IP_BAN_VERSION_CACHE_KEY)
+        if self.version != version or (self.valid_until and self.valid_until <= now()):
+            self.load()
+            self.version = version
+
+    def load(self) -> None:
+        intervals = {4: [], 6: []}
+        kill_switch, valid_until = False, None
+        for ip_address, prefix_bits, expires_at in IPBan.objects.active().values_list(
+            'ip_address', 'prefix_bits', 'expires_at',
+        ):
+            try:
+                network = ipaddress.ip_network(f'{ip_address}/{prefix_bits}', strict=False)
+            except ValueError:
+                logger.warning(f'Ignoring invalid IP ban {ip_address}/{prefix_bits}')
+                continue
+            intervals[network.version].append((int(network.network_address), int(network.broadcast_address)))
+            if ip_address == '0.0.0.0' and prefix_bits == 0:
+                kill_switch = True
+            if expires_at and (valid_until is None or expires_at < valid_until):
+                valid_until = expires_at
+        self.ranges = {ip_version: self.merge(ranges) for ip_version, ranges in intervals.items()}
+        self.kill_switch, self.valid_until = kill_switch, valid_until
+
+    @staticmethod
+    def merge(intervals: list) -> tuple:
+        starts, ends = [], []
+        for start, end in sorted(intervals):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def __len__(self):
+        # Number of disjoint banned ranges
+        self.ensure_loaded()
+        return sum(len(starts) for starts, ends in self.ranges.values())
+
+    @property
+    def global_kill_switch(self) -> bool:
+        self.ensure_loaded()
+        return self.kill_switch
+
+    def is_banned(self, ip_addr: Union[str, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+        if not ip_addr:
+            return False
+        if isinstance(ip_addr, str):
+            try:
+                ip_addr = ipaddress.ip_address(ip_addr)
+            except ValueError:
+                return False
+        if ip_addr.version == 6 and ip_addr.ipv4_mapped:
+            ip_addr = ip_addr.ipv4_mapped
+        self.ensure_loaded()
+        starts, ends = self.ranges[ip_addr.version]
+        address = int(ip_addr)
+        index = bisect.bisect_right(starts, address) - 1
+        return index >= 0 and address <= ends[index]
+
+
+ip_ban_matcher = IPBanMatcher()
@@ -0,0 +1,48 @@
+# Generated by Django 4.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0071_alter_taxrate_postal_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basereservation',
+            name='final_gross_revenue',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='basereservation',
+            name='final_subtotal',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='joyride',
+            name='final_subtotal',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='performanceexperience',
+            name='final_subtotal',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=9, null=True),
+        ),
+        migrations.AlterField(
+            model_name='joyride',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Confirmed/Billed'), (2, 'Complete'), (3, 'Cancelled')], db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='performanceexperience',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Confirmed/Billed'), (2, 'Complete'), (3, 'Cancelled')], db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='rental',
+            name='status',
+            field=models.IntegerField(blank=True, choices=[(0, 'Incomplete'), (1, 'Confirmed/Billed'), (2, 'In Progress'), (3, 'Complete'), (4, 'Cancelled')], db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0073_rollup_columns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ipban',
+            name='prefix_bits',
+            field=models.IntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(128)]),
+        ),
+    ]
@@ -12,7 +12,7 @@ from typing import Union
 
 from localflavor.us.models import USStateField, USZipCodeField
 from avalara import AvataxClient
-from requests import HTTPError
+from requests import RequestException
 from encrypted_fields import fields
 from phonenumber_field.modelfields import PhoneNumberField
 from django_countries.fields import CountryField
@@ -23,6 +23,7 @@ from django.db import models, IntegrityError
 from django.utils.timezone import now
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from sales.enums import SERVICE_TYPE_CODE_MAP, ServiceType
@@ -30,6 +31,7 @@ from sales.utils import EncryptedUSSocialSecurityNumberField, format_cc_number
 from sales.tasks import send_email
 from sales.constants import BANK_PHONE_HELP_TEXT
 from pri.cipher import AESCipher
+from pri.outbound import AVALARA, outbound_call
 
 logger = logging.getLogger(__name__)
 
@@ -92,6 +94,84 @@ class EmailConfirmationMixin:
         )
 
 
+# Tracks the fields which feed into final_price_data so that save() only reruns the price calculator when one of them
+# changed, rather than on every write to notes, status, mileage etc. Values are remembered as loaded from the DB (and
+# after each save); instances which were never loaded or have no final_price_data yet are always priced.
+# Changes to inputs held on other models (promotions, coupons, customer discounts, tax rates, vehicle rates) are not
+# picked up on save; call reprice() or use the reprice management command for those.
+# Amounts in final_price_data which revenue reports total up are also copied to the decimal columns in revenue_fields
+# (column: price data key, or a tuple of keys to add up) whenever the instance is saved or repriced, so they can be
+# summed in SQL; rows priced before the columns existed are filled in by the backfill_revenue management command.
+
+class PricingInputsMixin:
+    pricing_fields = ()
+    revenue_fields = {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_pricing_inputs()
+        return instance
+
+    def get_pricing_inputs(self):
+        # Read from __dict__ so that deferred fields are not fetched just to be compared
+        return tuple(self.__dict__.get(field) for field in self.pricing_fields)
+
+    def remember_pricing_inputs(self, update_fields=None):
+        # After a partial save only the fields written are remembered, so unsaved changes to the others still count as
+        # changes on the next full save
+        loaded_inputs = getattr(self, '_loaded_pricing_inputs', None)
+        if update_fields is None:
+            self._loaded_pricing_inputs = self.get_pricing_inputs()
+        elif loaded_inputs is not None:
+            saved_fields = {self._meta.get_field(field).attname for field in update_fields}
+            self._loaded_pricing_inputs = tuple(
+                value if field in saved_fields else loaded_value
+                for field, value, loaded_value in zip(self.pricing_fields, self.get_pricing_inputs(), loaded_inputs)
+            )
+
+    @property
+    def pricing_inputs_changed(self):
+        return getattr(self, '_loaded_pricing_inputs', None) != self.get_pricing_inputs()
+
+    def needs_repricing(self, update_fields=None):
+        if update_fields is not None and 'final_price_data' not in update_fields:
+            return False
+        return self.final_price_data is None or self.pricing_inputs_changed
+
+    def reprice(self, pricing_context=None, commit=True):
+        self.final_price_data = json.loads(
+            json.dumps(self.get_price_data(pricing_context=pricing_context), cls=DjangoJSONEncoder)
+        )
+        self.set_revenue_fields()
+        if commit:
+            self.save(update_fields=['final_price_data'])
+        return self.final_price_data
+
+    def set_revenue_fields(self):
+        # Copies the amounts from final_price_data to their columns
+        price_data = self.final_price_data or {}
+        for field, keys in self.revenue_fields.items():
+            keys = (keys,) if isinstance(keys, str) else keys
+            values = [price_data[key] for key in keys if price_data.get(key) is not None]
+            value = None
+            if values:
+                value = sum(decimal.Decimal(str(value)) for value in values).quantize(decimal.Decimal('0.01'))
+            setattr(self, field, value)
+
+    def get_update_fields(self, update_fields=None):
+        # For a partial save, adds the revenue columns (if final_price_data is being saved) and updated_at, which the
+        # revenue rollups use to find changed rows
+        if update_fields is None:
+            return None
+        update_fields = list(update_fields)
+        if 'final_price_data' in update_fields:
+            update_fields += [field for field in self.revenue_fields if field not in update_fields]
+        if 'updated_at' not in update_fields:
+            update_fields.append('updated_at')
+        return update_fields
+
+
 class AllCountries(Countries):
     only = []
     first = ['US', 'CA']
@@ -160,11 +240,20 @@ class Coupon(Promotion):
 # Concrete base model class which is used to supply common fields to both the Reservation and Rental model classes.
 # Don't want to use an abstract model class because we want to be able to query both tables simultaneously in a union
 
-class BaseReservation(ConfirmationCodeMixin, EmailConfirmationMixin, models.Model):
+class BaseReservation(ConfirmationCodeMixin, EmailConfirmationMixin, PricingInputsMixin, models.Model):
     service_type = ServiceType.RENTAL.value
     email_subject = 'PRI Reservation Confirmation'
     email_text_template = 'email/reservation_confirm.txt'
     email_html_template = 'email/reservation_confirm.html'
+    pricing_fields = (
+        'vehicle_id', 'customer_id', 'out_at', 'back_at', 'back_at_orig', 'extra_miles', 'coupon_code', 'is_military',
+        'override_subtotal', 'delivery_zip',
+    )
+    revenue_fields = {
+        'final_subtotal': 'subtotal',
+        'final_gross_revenue': 'post_multi_day_discount_subtotal',
+        'final_discount': ('multi_day_discount', 'specific_discount'),
+    }
 
     class AppChannel(models.TextChoices):
         WEB = ('web', 'Web')
@@ -195,6 +284,10 @@ class BaseReservation(ConfirmationCodeMixin, EmailConfirmationMixin, models.Mode
     delivery_zip = USZipCodeField(blank=True)
     override_subtotal = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True)
     final_price_data = models.JSONField(null=True, blank=True)
+    final_subtotal = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True, editable=False)
+    final_gross_revenue = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True, editable=False)
+    final_discount = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     @property
     def is_reservation(self):
@@ -269,28 +362,33 @@ class BaseReservation(ConfirmationCodeMixin, EmailConfirmationMixin, models.Mode
 
     @property
     def coupon(self):
+        # TODO: Refactor sales.models classes to avoid this nested import
+        from sales.calculators import promotion_index
         if self.coupon_code and self.out_date:
-            return Coupon.objects.filter(models.Q(end_date__isnull=True) | models.Q(end_date__gte=self.out_date), code=self.coupon_code).first()
+            return promotion_index.get_unexpired_coupon(self.coupon_code, self.out_date)
         return None
 
     @property
     def transaction_time(self):
         return self.out_at
 
-    def get_price_data(self):
+    def get_price_data(self, pricing_context=None):
         # TODO: Refactor sales.models classes to avoid this nested import
-        from sales.calculators import RentalPriceCalculator
+        from sales.calculators import RentalPriceCalculator, PricingContext
+        pricing_context = pricing_context or PricingContext()
+        pricing_context.add_customer(self.customer)
         price_calculator = RentalPriceCalculator(
             coupon_code=self.coupon_code,
             email=self.customer.email,
             tax_zip=self.delivery_zip or settings.DEFAULT_TAX_ZIP,
             effective_date=self.out_date,
             is_military=self.is_military,
-            vehicle_marketing=self.vehicle.vehicle_marketing,
+            vehicle_marketing=pricing_context.get_vehicle_marketing(self.vehicle),
             num_days=self.num_days,
             extra_miles=self.extra_miles,
             override_subtotal=self.override_subtotal,
             one_time_discount_pct=getattr(self, 'rental_discount_pct', None),
+            pricing_context=pricing_context,
         )
         return price_calculator.get_price_data()
 
@@ -298,9 +396,12 @@ class BaseReservation(ConfirmationCodeMixin, EmailConfirmationMixin, models.Mode
         self.coupon_code = self.coupon_code.upper()
         if self.back_at and not self.back_at_orig:
             self.back_at_orig = self.back_at
-        if self.id and self.customer:
-            self.final_price_data = json.loads(json.dumps(self.get_price_data(), cls=DjangoJSONEncoder))
+        if self.id and self.customer and self.needs_repricing(kwargs.get('update_fields')):
+            self.reprice(commit=False)
+        self.set_revenue_fields()
+        kwargs['update_fields'] = self.get_update_fields(kwargs.get('update_fields'))
         super().save(*args, **kwargs)
+        self.remember_pricing_inputs(kwargs['update_fields'])
 
     class Meta:
         abstract = False
@@ -325,7 +426,7 @@ class Rental(BaseReservation):
         COMPLETE = (3, 'Complete')
         CANCELLED = (4, 'Cancelled')
 
-    status = models.IntegerField(choices=Status.choices, default=Status.INCOMPLETE, blank=True)
+    status = models.IntegerField(choices=Status.choices, default=Status.INCOMPLETE, blank=True, db_index=True)
     background_check = models.BooleanField(default=False)
     mileage_out = models.IntegerField(null=True, blank=True)
     mileage_back = models.IntegerField(null=True, blank=True)
@@ -339,6 +440,8 @@ class Rental(BaseReservation):
     rental_discount_pct = models.IntegerField(null=True, blank=True)
     extended_days = models.IntegerField(null=True, blank=True, default=0)
 
+    pricing_fields = BaseReservation.pricing_fields + ('rental_discount_pct',)
+
     @property
     def extended_days_amount(self):
         return self.extended_days * self.vehicle.vehicle_marketing.price_per_day
@@ -357,11 +460,11 @@ class Rental(BaseReservation):
 
     @property
     def needs_insurance_verified(self):
-        return bool(self.is_incomplete and not self.customer.coverage_verified)
+        return bool(self.is_incomplete and self.customer and not self.customer.coverage_verified)
 
     @property
     def needs_background_check(self):
-        return bool(self.is_incomplete and not self.customer.license_history)
+        return bool(self.is_incomplete and self.customer and not self.customer.license_history)
 
     @property
     def todo_item_count(self):
@@ -378,7 +481,14 @@ class Rental(BaseReservation):
     # net revenues". Legacy calculation is num_days * rate_per_day - multi_day_discount
     @property
     def gross_revenue(self):
-        return self.final_price_data['post_multi_day_discount_subtotal']
+        if self.final_gross_revenue is not None:
+            return self.final_gross_revenue
+        return decimal.Decimal(str(self.final_price_data['post_multi_day_discount_subtotal']))
+
+    @property
+    def is_rental(self):
+        # Saves BaseReservation.is_rental's query for the rental row when listing rentals
+        return True
 
 
 class Driver(models.Model):
@@ -390,7 +500,9 @@ class Driver(models.Model):
         ordering = ('-is_primary',)
 
 
-class GuidedDrive(ConfirmationCodeMixin, models.Model):
+class GuidedDrive(ConfirmationCodeMixin, PricingInputsMixin, models.Model):
+    pricing_fields = ('customer_id', 'requested_date', 'coupon_code', 'num_passengers', 'override_subtotal')
+    revenue_fields = {'final_subtotal': 'subtotal', 'final_discount': 'specific_discount'}
 
     class EventType(models.IntegerChoices):
         JOY_RIDE = (1, 'Joy Ride')
@@ -402,7 +514,7 @@ class GuidedDrive(ConfirmationCodeMixin, models.Model):
         COMPLETE = (2, 'Complete')
         CANCELLED = (3, 'Cancelled')
 
-    status = models.IntegerField(choices=Status.choices, default=Status.PENDING)
+    status = models.IntegerField(choices=Status.choices, default=Status.PENDING, db_index=True)
     customer = models.ForeignKey('users.Customer', null=True, blank=True, on_delete=models.SET_NULL)
     created_at = models.DateTimeField(auto_now_add=True)
     vehicle_choice_1 = models.ForeignKey('fleet.Vehicle', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
@@ -420,6 +532,9 @@ class GuidedDrive(ConfirmationCodeMixin, models.Model):
     confirmation_code = models.CharField(max_length=10, blank=True, unique=True, db_index=True)
     override_subtotal = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True)
     final_price_data = models.JSONField(null=True, blank=True)
+    final_subtotal = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True, editable=False)
+    final_discount = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     @property
     def vehicle_list(self):
@@ -439,15 +554,20 @@ class GuidedDrive(ConfirmationCodeMixin, models.Model):
 
     @property
     def coupon(self):
+        # TODO: Refactor sales.models classes to avoid this nested import
+        from sales.calculators import promotion_index
         if self.coupon_code and self.requested_date:
-            return Coupon.objects.filter(models.Q(end_date__isnull=True) | models.Q(end_date__gte=self.requested_date), code=self.coupon_code).first()
+            return promotion_index.get_unexpired_coupon(self.coupon_code, self.requested_date)
         return None
 
     def save(self, *args, **kwargs):
         self.coupon_code = self.coupon_code.upper()
-        if self.id:
-            self.final_price_data = json.loads(json.dumps(self.get_price_data(), cls=DjangoJSONEncoder))
+        if self.id and self.needs_repricing(kwargs.get('update_fields')):
+            self.reprice(commit=False)
+        self.set_revenue_fields()
+        kwargs['update_fields'] = self.get_update_fields(kwargs.get('update_fields'))
         super().save(*args, **kwargs)
+        self.remember_pricing_inputs(kwargs['update_fields'])
 
     class Meta:
         abstract = True
@@ -459,9 +579,11 @@ class JoyRide(EmailConfirmationMixin, GuidedDrive):
     email_text_template = 'email/joyride_confirm.txt'
     email_html_template = 'email/joyride_confirm.html'
 
-    def get_price_data(self):
+    def get_price_data(self, pricing_context=None):
         # TODO: Refactor sales.models classes to avoid this nested import
-        from sales.calculators import JoyRidePriceCalculator
+        from sales.calculators import JoyRidePriceCalculator, PricingContext
+        pricing_context = pricing_context or PricingContext()
+        pricing_context.add_customer(self.customer)
         price_calculator = JoyRidePriceCalculator(
             coupon_code=self.coupon_code,
             email=self.customer.email,
@@ -470,6 +592,7 @@ class JoyRide(EmailConfirmationMixin, GuidedDrive):
             is_military=False,
             num_passengers=self.num_passengers,
             override_subtotal=self.override_subtotal,
+            pricing_context=pricing_context,
         )
         return price_calculator.get_price_data()
 
@@ -487,9 +610,13 @@ class PerformanceExperience(EmailConfirmationMixin, GuidedDrive):
 
     num_drivers = models.IntegerField(null=True, blank=True)
 
-    def get_price_data(self):
+    pricing_fields = GuidedDrive.pricing_fields + ('num_drivers',)
+
+    def get_price_data(self, pricing_context=None):
         # TODO: Refactor sales.models classes to avoid this nested import
-        from sales.calculators import PerformanceExperiencePriceCalculator
+        from sales.calculators import PerformanceExperiencePriceCalculator, PricingContext
+        pricing_context = pricing_context or PricingContext()
+        pricing_context.add_customer(self.customer)
         price_calculator = PerformanceExperiencePriceCalculator(
             coupon_code=self.coupon_code,
             email=self.customer.email,
@@ -499,6 +626,7 @@ class PerformanceExperience(EmailConfirmationMixin, GuidedDrive):
             num_drivers=self.num_drivers,
             num_passengers=self.num_passengers,
             override_subtotal=self.override_subtotal,
+            pricing_context=pricing_context,
         )
         return price_calculator.get_price_data()
 
@@ -599,29 +727,55 @@ class TaxRate(models.Model):
             return self.total_rate * 100
         return 0
 
-    def update(self):
+    @property
+    def is_stale(self):
+        if self.total_rate is None or not self.date_updated:
+            return True
+        return (now() - self.date_updated).total_seconds() / 86400 > self.MAX_AGE_DAYS
+
+    @staticmethod
+    def get_avatax_client():
         client = AvataxClient(
             settings.AVALARA_APP_NAME,
             settings.AVALARA_APP_VERSION,
             settings.AVALARA_MACHINE_NAME,
             settings.AVALARA_ENVIRONMENT,
+            timeout_limit=settings.AVALARA_TIMEOUT_SECS,
         )
         client.add_credentials(settings.AVALARA_ACCOUNT_ID, settings.AVALARA_LICENSE_KEY)
+        return client
+
+    def update(self, client=None):
+        # Pass a client to reuse it across many updates. Returns whether Avalara returned a rate
+        client = client or self.get_avatax_client()
+        is_successful = False
         try:
-            response = client.tax_rates_by_postal_code(include={'country': self.country, 'postalCode': self.postal_code})
-            response.raise_for_status()
+            with outbound_call(AVALARA):
+                response = client.tax_rates_by_postal_code(
+                    include={'country': self.country, 'postalCode': self.postal_code},
+                )
+                response.raise_for_status()
             result = response.json()
-            self.total_rate = result['totalRate']
+            # A float from the API; stored as the field does, so the instance compares equal once reloaded
+            self.total_rate = decimal.Decimal(str(result['totalRate'])).quantize(decimal.Decimal('0.00001'))
             self.detail = result
             self.date_updated = now()
-        except HTTPError:
-            self.total_rate = decimal.Decimal(settings.DEFAULT_TAX_RATE)
-        self.save()
-
-    def save(self, *args, **kwargs):
+            is_successful = True
+        except RequestException:
+            # Keep serving the last known rate if there is one
+            if self.total_rate is None:
+                self.total_rate = decimal.Decimal(settings.DEFAULT_TAX_RATE)
+        self.save(refresh_if_stale=False)
+        return is_successful
+
+    def save(self, *args, refresh_if_stale=True, **kwargs):
         super().save(*args, **kwargs)
-        if not self.total_rate or (now() - self.date_updated).total_seconds() / 86400 > self.MAX_AGE_DAYS:
-            self.update()
+        # Missing or stale rates are fetched from Avalara in the background (see sales.tax_rates), so nothing saving a
+        # TaxRate has to wait on the API
+        if refresh_if_stale and self.is_stale:
+            # TODO: Refactor sales.models classes to avoid this nested import
+            from sales.tax_rates import tax_rate_refresh_queue
+            tax_rate_refresh_queue.enqueue(self.postal_code)
 
 
 class RedFlag(models.Model):
@@ -648,13 +802,20 @@ class IPBanManager(models.Manager):
 
 class IPBan(models.Model):
     ip_address = models.GenericIPAddressField()
-    prefix_bits = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(32)])
+    prefix_bits = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(128)])
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey('users.User', null=True, blank=True, on_delete=models.SET_NULL)
     expires_at = models.DateTimeField(null=True, blank=True)
 
     objects = IPBanManager()
 
+    def clean(self):
+        super().clean()
+        if not self.ip_address or not self.prefix_bits:
+            return
+        if self.prefix_bits > ipaddress.ip_address(self.ip_address).max_prefixlen:
+            raise ValidationError({'prefix_bits': 'Too many prefix bits for this IP address.'})
+
     @property
     def cidr_address(self):
         return ipaddress.ip_network(f'{self.ip_address}/{self.prefix_bits}', strict=False)
@@ -664,18 +825,9 @@ class IPBan(models.Model):
         return self.cidr_address.network_address
 
     @classmethod
-    def ip_is_banned(cls, ip_addr: Union[str, ipaddress.IPv4Address]) -> bool:
-        if not ip_addr:
-            return False
-        if isinstance(ip_addr, str):
-            try:
-                ip_addr = ipaddress.IPv4Address(ip_addr)
-            except ipaddress.AddressValueError:
-                return False
-        for ip_ban in cls.objects.active():
-            if ip_addr in ip_ban.cidr_address:
-                return True
-        return False
+    def ip_is_banned(cls, ip_addr: Union[str, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+        from sales.ip_bans import ip_ban_matcher
+        return ip_ban_matcher.is_banned(ip_addr)
 
     @classmethod
     @property
@@ -685,11 +837,12 @@ class IPBan(models.Model):
     @classmethod
     @property
     def global_kill_switch(cls):
-        return cls.global_ban_objects.exists()
+        from sales.ip_bans import ip_ban_matcher
+        return ip_ban_matcher.global_kill_switch
 
     @classmethod
     def toggle_global_kill_switch(cls):
-        if cls.global_kill_switch:
+        if cls.global_ban_objects.exists():
             cls.global_ban_objects.delete()
         else:
             cls.objects.create(ip_address='0.0.0.0', prefix_bits=0)
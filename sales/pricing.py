@@ -0,0 +1,246 @@
+# Pure pricing functions. Everything here works on plain values (prices, discount percentages, tax rates) and never
+# touches the ORM, so quotes can be computed in bulk (reports, repricing jobs, tests) without any queries.
+# The calculators in sales.calculators resolve their inputs from the database and delegate the arithmetic to these
+# functions. Discount sources which may be either a flat amount or a percentage (promotions and coupons) are passed as
+# (amount, percent) pairs, following Promotion.get_discount_value.
+
+import decimal
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+
+DiscountRule = Tuple[Optional[decimal.Decimal], Optional[decimal.Decimal]]
+
+SPECIFIC_DISCOUNT_LABELS = (
+    ('promotion_discount', 'Promotional discount'),
+    ('coupon_discount', 'Coupon discount'),
+    ('customer_discount', 'Customer discount'),
+    ('military_discount', 'Military discount'),
+    ('one_time_discount', 'One-time discount'),
+)
+
+
+def quantize_currency(value) -> decimal.Decimal:
+    cents = decimal.Decimal('0.01')
+    return decimal.Decimal(value).quantize(cents, decimal.ROUND_HALF_UP)
+
+
+def get_rule_discount(value: float, rule: Optional[DiscountRule]) -> float:
+    if not rule:
+        return 0
+    amount, percent = rule
+    if amount:
+        return amount
+    elif percent:
+        return value * float(percent) / 100
+    return 0
+
+
+def get_pct_discount(value: float, discount_pct) -> float:
+    if discount_pct:
+        return value * discount_pct / 100
+    return 0
+
+
+def get_specific_discounts(
+        value: float,
+        promotion: DiscountRule = None,
+        coupon: DiscountRule = None,
+        customer_discount_pct: int = None,
+        military_discount_pct: int = None,
+        one_time_discount_pct: int = None,
+) -> dict:
+    """
+    Computes each of the mutually exclusive discounts on value and picks the greatest one. Ties go to the discount
+    listed first in SPECIFIC_DISCOUNT_LABELS.
+    """
+    discounts = dict(
+        promotion_discount=get_rule_discount(value, promotion),
+        coupon_discount=get_rule_discount(value, coupon),
+        customer_discount=get_pct_discount(value, customer_discount_pct),
+        military_discount=get_pct_discount(value, military_discount_pct),
+        one_time_discount=get_pct_discount(value, one_time_discount_pct),
+    )
+    ranked_keys = sorted((key for key, label in SPECIFIC_DISCOUNT_LABELS), key=discounts.get, reverse=True)
+    specific_discount = discounts[ranked_keys[0]]
+    specific_discount_label = dict(SPECIFIC_DISCOUNT_LABELS)[ranked_keys[0]] if specific_discount else ''
+    discounts.update(specific_discount=specific_discount, specific_discount_label=specific_discount_label)
+    return discounts
+
+
+def get_multi_day_discount_pct(num_days: int, discount_2_day: int, discount_3_day: int, discount_7_day: int) -> int:
+    if num_days >= 7:
+        return discount_7_day
+    elif num_days >= 3:
+        return discount_3_day
+    elif num_days >= 2:
+        return discount_2_day
+    return 0
+
+
+def get_extra_miles_cost(extra_miles: int, extra_miles_prices: dict = None) -> float:
+    extra_miles_prices = settings.EXTRA_MILES_PRICES if extra_miles_prices is None else extra_miles_prices
+    try:
+        return extra_miles_prices.get(extra_miles)['cost']
+    except TypeError:
+        return 0
+
+
+def get_performance_experience_driver_cost(num_drivers: int, prices: dict = None) -> float:
+    prices = settings.PERFORMANCE_EXPERIENCE_PRICES if prices is None else prices
+    if not num_drivers:
+        return 0
+    if num_drivers in (1, 2, 3, 4):
+        return prices[f'{num_drivers}_drv']
+    return prices['cost_per_drv_gt_4'] * num_drivers
+
+
+def get_performance_experience_passenger_cost(num_passengers: int, prices: dict = None) -> float:
+    prices = settings.PERFORMANCE_EXPERIENCE_PRICES if prices is None else prices
+    if not num_passengers:
+        return 0
+    return prices['cost_per_pax'] * num_passengers
+
+
+def get_joy_ride_passenger_cost(num_passengers: int, prices: dict = None) -> float:
+    prices = settings.JOY_RIDE_PRICES if prices is None else prices
+    if not num_passengers:
+        return 0
+    if num_passengers in (1, 2, 3, 4):
+        return prices[f'{num_passengers}_pax']
+    return prices['cost_per_pax_gt_4'] * num_passengers
+
+
+def get_totals(computed_subtotal: float, tax_rate, override_subtotal=None) -> dict:
+    # The override, if given, takes the place of the computed subtotal before tax
+    pre_tax_subtotal = (float(override_subtotal) if override_subtotal else None) or computed_subtotal
+    tax_amount = float(tax_rate) * pre_tax_subtotal
+    return dict(
+        pre_tax_subtotal=pre_tax_subtotal,
+        tax_amount=tax_amount,
+        total_with_tax=pre_tax_subtotal + tax_amount,
+    )
+
+
+def get_common_price_data(discounts: dict, totals: dict, computed_subtotal: float, tax_zip: str, tax_rate,
+                          customer_id: int = None) -> dict:
+    return dict(
+        tax_zip=tax_zip,
+        tax_rate=tax_rate,
+        tax_rate_as_percent=tax_rate * 100,
+        customer_id=customer_id,
+        promotion_discount=quantize_currency(discounts['promotion_discount']),
+        coupon_discount=quantize_currency(discounts['coupon_discount']),
+        customer_discount=quantize_currency(discounts['customer_discount']),
+        military_discount=quantize_currency(discounts['military_discount']),
+        one_time_discount=quantize_currency(discounts['one_time_discount']),
+        specific_discount=quantize_currency(discounts['specific_discount']),
+        specific_discount_label=discounts['specific_discount_label'],
+        subtotal=quantize_currency(totals['pre_tax_subtotal']),
+        computed_subtotal=quantize_currency(computed_subtotal),
+        total_with_tax=quantize_currency(totals['total_with_tax']),
+        tax_amount=quantize_currency(totals['tax_amount']),
+    )
+
+
+def get_rental_price_data(
+        price_per_day: decimal.Decimal,
+        num_days: int,
+        extra_miles: int,
+        discount_2_day: int,
+        discount_3_day: int,
+        discount_7_day: int,
+        tax_zip: str,
+        tax_rate,
+        customer_id: int = None,
+        override_subtotal=None,
+        extra_miles_prices: dict = None,
+        **discount_kwargs,
+) -> dict:
+    """
+    Base price is daily rate * number of days, less the multi-day discount, less the greatest specific discount
+    (see get_specific_discounts() for discount_kwargs), plus the extra miles surcharge, plus tax.
+    """
+    extra_miles = int(extra_miles)
+    base_price = float(price_per_day * num_days)
+
+    multi_day_discount_pct = get_multi_day_discount_pct(num_days, discount_2_day, discount_3_day, discount_7_day)
+    multi_day_discount = base_price * multi_day_discount_pct / 100
+    post_multi_day_discount_subtotal = base_price - float(multi_day_discount)
+
+    discounts = get_specific_discounts(post_multi_day_discount_subtotal, **discount_kwargs)
+    post_specific_discount_subtotal = post_multi_day_discount_subtotal - float(discounts['specific_discount'])
+
+    extra_miles_cost = get_extra_miles_cost(extra_miles, extra_miles_prices)
+    computed_subtotal = post_specific_discount_subtotal + float(extra_miles_cost)
+
+    totals = get_totals(computed_subtotal, tax_rate, override_subtotal)
+    price_data = dict(
+        vehicle_price_per_day=quantize_currency(price_per_day),
+        num_days=num_days,
+        base_price=quantize_currency(base_price),
+        multi_day_discount=quantize_currency(multi_day_discount),
+        multi_day_discount_pct=multi_day_discount_pct,
+        post_multi_day_discount_subtotal=quantize_currency(post_multi_day_discount_subtotal),
+        extra_miles=extra_miles,
+        extra_miles_cost=quantize_currency(extra_miles_cost),
+        reservation_deposit=quantize_currency(totals['total_with_tax'] / 2),
+    )
+    price_data.update(get_common_price_data(discounts, totals, computed_subtotal, tax_zip, tax_rate, customer_id))
+    return price_data
+
+
+def get_guided_drive_price_data(
+        driver_cost: float,
+        passenger_cost: float,
+        num_drivers: int,
+        num_passengers: int,
+        tax_zip: str,
+        tax_rate,
+        customer_id: int = None,
+        override_subtotal=None,
+        **discount_kwargs,
+) -> dict:
+    base_price = driver_cost + passenger_cost
+    discounts = get_specific_discounts(base_price, **discount_kwargs)
+    computed_subtotal = base_price - float(discounts['specific_discount'])
+
+    totals = get_totals(computed_subtotal, tax_rate, override_subtotal)
+    price_data = dict(
+        num_drivers=num_drivers,
+        num_passengers=num_passengers,
+        driver_cost=driver_cost,
+        passenger_cost=passenger_cost,
+        base_price=quantize_currency(base_price),
+    )
+    price_data.update(get_common_price_data(discounts, totals, computed_subtotal, tax_zip, tax_rate, customer_id))
+    return price_data
+
+
+def get_performance_experience_price_data(num_drivers: int, num_passengers: int, prices: dict = None, **kwargs) -> dict:
+    """
+    Base price is predefined per number of drivers up to 4, above which per-driver rate * number of drivers,
+    + per-passenger rate * number of passengers; less the greatest specific discount, plus tax.
+    """
+    return get_guided_drive_price_data(
+        driver_cost=get_performance_experience_driver_cost(num_drivers, prices),
+        passenger_cost=get_performance_experience_passenger_cost(num_passengers, prices),
+        num_drivers=num_drivers,
+        num_passengers=num_passengers,
+        **kwargs,
+    )
+
+
+def get_joy_ride_price_data(num_passengers: int, prices: dict = None, **kwargs) -> dict:
+    """
+    Base price is predefined per number of passengers up to 4, above which per-passenger rate * number of passengers;
+    less the greatest specific discount, plus tax.
+    """
+    return get_guided_drive_price_data(
+        driver_cost=0,
+        passenger_cost=get_joy_ride_passenger_cost(num_passengers, prices),
+        num_drivers=0,
+        num_passengers=num_passengers,
+        **kwargs,
+    )
@@ -0,0 +1,119 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from consignment.models import ConsignmentReservation
+from fleet.models import VehicleMarketing
+from sales.models import Promotion, Coupon, TaxRate, Reservation, Rental, IPBan
+from sales.availability import availability_index
+from sales.calculators import bump_pricing_version, promotion_index
+from sales.ip_bans import bump_ip_ban_version, ip_ban_matcher
+from sales.tax_rates import bump_tax_rate_version, bump_tax_rate_values_version, tax_rate_table
+from users.models import Customer
+
+
+VEHICLE_MARKETING_PRICE_FIELDS = ('price_per_day', 'discount_2_day', 'discount_3_day', 'discount_7_day')
+
+
+# Any change to a promotion or coupon can change a quote
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Promotion)
+@receiver(post_delete, sender=Coupon)
+def promotion_changed(sender, instance, **kwargs):
+    # Other processes notice the version bump; this one can drop its index straight away
+    promotion_index.invalidate()
+    bump_pricing_version()
+
+
+# Every TaxRate save reloads the rate table, which tracks when each rate was refreshed, but cached quotes (keyed on the
+# tax rate values version) are only dropped when a rate changes; the background refresh mostly saves unchanged rates
+
+def get_total_rate(instance):
+    # As a Decimal, since a rate just fetched from Avalara is a float
+    return TaxRate._meta.get_field('total_rate').to_python(instance.total_rate)
+
+
+@receiver(post_init, sender=TaxRate)
+def remember_tax_rate(sender, instance, **kwargs):
+    instance._loaded_total_rate = get_total_rate(instance)
+
+
+@receiver(post_save, sender=TaxRate)
+def tax_rate_saved(sender, instance, created, **kwargs):
+    tax_rate_table.invalidate()
+    bump_tax_rate_version()
+    total_rate = get_total_rate(instance)
+    if created or total_rate != instance._loaded_total_rate:
+        bump_tax_rate_values_version()
+    instance._loaded_total_rate = total_rate
+
+
+@receiver(post_delete, sender=TaxRate)
+def tax_rate_deleted(sender, instance, **kwargs):
+    tax_rate_table.invalidate()
+    bump_tax_rate_version()
+    bump_tax_rate_values_version()
+
+
+@receiver(post_save, sender=IPBan)
+@receiver(post_delete, sender=IPBan)
+def ip_ban_changed(sender, instance, **kwargs):
+    ip_ban_matcher.invalidate()
+    bump_ip_ban_version()
+
+
+# Customers and vehicles are saved far more often than their pricing fields change, so remember the values as loaded
+# and only bump the version if one of them is different on save
+
+@receiver(post_init, sender=Customer)
+def remember_customer_pricing_fields(sender, instance, **kwargs):
+    instance._loaded_discount_pct = instance.discount_pct
+
+
+@receiver(post_save, sender=Customer)
+def customer_saved(sender, instance, created, **kwargs):
+    # A new customer changes the customer_id returned for quotes made with that email
+    if created or instance.discount_pct != instance._loaded_discount_pct:
+        bump_pricing_version()
+    instance._loaded_discount_pct = instance.discount_pct
+
+
+@receiver(post_init, sender=VehicleMarketing)
+def remember_vehicle_marketing_price_fields(sender, instance, **kwargs):
+    instance._loaded_price_fields = tuple(getattr(instance, field) for field in VEHICLE_MARKETING_PRICE_FIELDS)
+
+
+@receiver(post_save, sender=VehicleMarketing)
+def vehicle_marketing_saved(sender, instance, created, **kwargs):
+    price_fields = tuple(getattr(instance, field) for field in VEHICLE_MARKETING_PRICE_FIELDS)
+    if created or price_fields != instance._loaded_price_fields:
+        bump_pricing_version()
+    instance._loaded_price_fields = price_fields
+
+
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=VehicleMarketing)
+def customer_or_vehicle_marketing_deleted(sender, instance, **kwargs):
+    bump_pricing_version()
+
+
+# Bookings are applied to the availability index once committed, so an index never holds a booking that was rolled back.
+# The booking and its interval are read now, as a deleted instance has lost its pk by the time the transaction commits.
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_save, sender=Rental)
+@receiver(post_save, sender=ConsignmentReservation)
+def booking_saved(sender, instance, **kwargs):
+    booking = availability_index.get_booking(instance)
+    interval = availability_index.get_interval(instance)
+    transaction.on_commit(lambda: availability_index.record(booking, interval))
+
+
+@receiver(post_delete, sender=Reservation)
+@receiver(post_delete, sender=Rental)
+@receiver(post_delete, sender=ConsignmentReservation)
+def booking_deleted(sender, instance, **kwargs):
+    booking = availability_index.get_booking(instance)
+    transaction.on_commit(lambda: availability_index.record(booking, None))
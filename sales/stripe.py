@@ -1,15 +1,32 @@
 import stripe
+import stripe.http_client
 import logging
 from typing import Optional
 
 from django.conf import settings
 from django.utils import timezone
 
+from pri.outbound import STRIPE, get_timeout, outbound_call
 from sales.models import Card
 
 logger = logging.getLogger(__name__)
 
 
+class TimedStripeClient(stripe.http_client.RequestsClient):
+    # Every Stripe API request, including those made with the stripe module directly, timed as an outbound call
+
+    def request(self, method, url, headers, post_data=None):
+        with outbound_call(STRIPE) as call:
+            content, status_code, response_headers = super().request(method, url, headers, post_data=post_data)
+            if status_code >= 500:
+                call.error = f'HTTP {status_code}'
+        return content, status_code, response_headers
+
+
+# Installed once for the process: the client holds a connection pool, shared by every thread making Stripe calls
+stripe.default_http_client = TimedStripeClient(timeout=get_timeout(STRIPE))
+
+
 class Stripe:
 
     current_year = None
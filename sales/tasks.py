@@ -10,6 +10,8 @@ from django.core import mail
 from django.template import Context
 from django.template.loader import get_template
 
+from pri.outbound import SMTP, get_timeout, outbound_call
+
 # from celery import shared_task
 # from celery.utils.log import get_task_logger
 
@@ -37,18 +39,24 @@ def send_email(
 
     plaintext = get_template(text_template)
     htmly = get_template(html_template)
-    connection = mail.get_connection()
-    connection.open()
-    for recipient in recipients:
-        text_content = plaintext.render(context)
-        html_content = htmly.render(context)
-        msg = mail.EmailMultiAlternatives(subject, text_content, from_address, [recipient], bcc=bcc)
-        msg.attach_alternative(html_content, "text/html")
-        if attachments:
-            for attachment in attachments:
-                msg.attach(**attachment)
-
-        msg.send()
-        logger.info('Sending email "{0}" to {1}...'.format(subject, recipient))
-
-    connection.close()
+    # One connection for all the messages, with its own timeout
+    connection = mail.get_connection(timeout=get_timeout(SMTP))
+    with outbound_call(SMTP):
+        connection.open()
+    try:
+        for recipient in recipients:
+            text_content = plaintext.render(context)
+            html_content = htmly.render(context)
+            msg = mail.EmailMultiAlternatives(
+                subject, text_content, from_address, [recipient], bcc=bcc, connection=connection,
+            )
+            msg.attach_alternative(html_content, "text/html")
+            if attachments:
+                for attachment in attachments:
+                    msg.attach(**attachment)
+
+            with outbound_call(SMTP):
+                msg.send()
+            logger.info('Sending email "{0}" to {1}...'.format(subject, recipient))
+    finally:
+        connection.close()
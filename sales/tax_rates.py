@@ -0,0 +1,159 @@
+# Tax rate lookups for quotes, which never wait on Avalara. Rates are served from TaxRateTable, an in-memory copy of the
+# TaxRate table; a ZIP whose rate is missing or older than TaxRate.MAX_AGE_DAYS is quoted at DEFAULT_TAX_RATE (if it has
+# no rate at all) and queued for a refresh, which a background thread fetches and stores for subsequent quotes.
+# The table itself can be bulk loaded offline with the import_tax_rates command.
+
+import bisect
+import datetime
+import decimal
+import logging
+import queue
+import threading
+from array import array
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from sales.cache import get_version, bump_version
+from sales.models import TaxRate
+
+logger = logging.getLogger(__name__)
+
+TAX_RATE_VERSION_CACHE_KEY = 'tax_rate_version'
+# Bumped only when a rate itself changes (not on a refresh confirming it), so cached quotes survive stale-ZIP sweeps
+TAX_RATE_VALUES_VERSION_CACHE_KEY = 'tax_rate_values_version'
+
+
+def bump_tax_rate_version() -> None:
+    bump_version(TAX_RATE_VERSION_CACHE_KEY)
+
+
+def get_tax_rate_values_version() -> int:
+    return get_version(TAX_RATE_VALUES_VERSION_CACHE_KEY)
+
+
+def bump_tax_rate_values_version() -> None:
+    bump_version(TAX_RATE_VALUES_VERSION_CACHE_KEY)
+
+
+class TaxRateTable:
+    """
+    Every stored ZIP and rate, held as a sorted list of ZIPs with parallel arrays of rates (as integer hundred-
+    thousandths, the precision of TaxRate.total_rate) and update times (epoch seconds), so a lookup is a bisect.
+    Loaded on first use with a single query and rebuilt whenever the tax rate version changes (sales.signals bumps it
+    when a TaxRate is saved or deleted, and import_tax_rates after a bulk load).
+    """
+    RATE_SCALE = 5
+
+    def __init__(self):
+        self.version = None
+        self.postal_codes = []
+        self.rates = array('q')
+        self.updated = array('q')
+
+    def invalidate(self) -> None:
+        self.version = None
+
+    def ensure_loaded(self) -> None:
+        # Read the version before loading, so a bump made while loading is picked up on the next lookup
+        version = get_version(TAX_RATE_VERSION_CACHE_KEY)
+        if self.version != version:
+            self.load()
+            self.version = version
+
+    def load(self) -> None:
+        postal_codes, rates, updated = [], array('q'), array('q')
+        tax_rates = TaxRate.objects.filter(total_rate__isnull=False).exclude(postal_code='').order_by('postal_code')
+        for postal_code, total_rate, date_updated in tax_rates.values_list('postal_code', 'total_rate', 'date_updated'):
+            postal_codes.append(postal_code)
+            rates.append(int(total_rate.scaleb(self.RATE_SCALE)))
+            updated.append(int(date_updated.timestamp()))
+        self.postal_codes, self.rates, self.updated = postal_codes, rates, updated
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self.postal_codes)
+
+    def get(self, tax_zip: str) -> Optional[TaxRate]:
+        # Returns an unsaved TaxRate (without detail) for tax_zip, or None if there is no rate for it
+        self.ensure_loaded()
+        index = bisect.bisect_left(self.postal_codes, tax_zip)
+        if index == len(self.postal_codes) or self.postal_codes[index] != tax_zip:
+            return None
+        return TaxRate(
+            postal_code=tax_zip,
+            total_rate=decimal.Decimal(self.rates[index]).scaleb(-self.RATE_SCALE),
+            date_updated=datetime.datetime.fromtimestamp(self.updated[index], tz=datetime.timezone.utc),
+        )
+
+
+tax_rate_table = TaxRateTable()
+
+
+def get_default_tax_rate(tax_zip: str) -> TaxRate:
+    # Unsaved stand-in for a ZIP we have no rate for yet
+    return TaxRate(postal_code=tax_zip, total_rate=decimal.Decimal(settings.DEFAULT_TAX_RATE))
+
+
+def get_tax_rate(tax_zip: str) -> TaxRate:
+    tax_rate = tax_rate_table.get(tax_zip)
+    if tax_rate is None or tax_rate.is_stale:
+        tax_rate_refresh_queue.enqueue(tax_zip)
+    return tax_rate or get_default_tax_rate(tax_zip)
+
+
+def refresh_tax_rate(tax_zip: str, client=None, force: bool = False) -> TaxRate:
+    """
+    Fetches the rate for tax_zip from Avalara and stores it, unless the stored rate is still fresh (or force is given).
+    Pass a client to reuse it across many refreshes.
+    """
+    tax_rate = TaxRate.objects.filter(postal_code=tax_zip).first() or TaxRate(postal_code=tax_zip)
+    if force or tax_rate.is_stale:
+        tax_rate.update(client=client)
+    return tax_rate
+
+
+class TaxRateRefreshQueue:
+    """
+    Process-local queue of ZIPs waiting for a refresh, worked by a single daemon thread which is started on first use
+    and reuses one Avalara client. A ZIP is only queued once until its refresh is done.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def enqueue(self, tax_zip: str) -> None:
+        if not tax_zip or not settings.TAX_RATE_BACKGROUND_REFRESH:
+            return
+        # Wait for the surrounding transaction (if any) to commit, so the worker sees the row that was saved
+        transaction.on_commit(lambda: self.put(tax_zip))
+
+    def put(self, tax_zip: str) -> None:
+        with self.lock:
+            if tax_zip in self.pending:
+                return
+            self.pending.add(tax_zip)
+            if not self.worker or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, name='tax-rate-refresh', daemon=True)
+                self.worker.start()
+        self.queue.put(tax_zip)
+
+    def work(self) -> None:
+        client = TaxRate.get_avatax_client()
+        while True:
+            tax_zip = self.queue.get()
+            try:
+                refresh_tax_rate(tax_zip, client=client)
+            except Exception:
+                logger.exception(f'Failed to refresh tax rate for {tax_zip}')
+            finally:
+                with self.lock:
+                    self.pending.discard(tax_zip)
+                close_old_connections()
+                self.queue.task_done()
+
+
+tax_rate_refresh_queue = TaxRateRefreshQueue()
@@ -0,0 +1,319 @@
+import itertools
+import random
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from django.conf import settings
+
+from fleet.models import VehicleMarketing
+from users.models import Customer
+from sales.models import TaxRate, Coupon, Promotion
+from sales.enums import ServiceType
+from sales.calculators import (
+    PricingContext, RentalPriceCalculator, PerformanceExperiencePriceCalculator, JoyRidePriceCalculator,
+)
+from sales.pricing import (
+    quantize_currency, get_rental_price_data, get_performance_experience_price_data, get_joy_ride_price_data,
+)
+
+
+# Reference implementation: the calculator arithmetic as it was before it moved into sales.pricing, with the ORM
+# lookups replaced by objects passed in directly. The pricing functions and the calculator adapters must reproduce
+# its price_data exactly.
+
+class LegacyPriceCalculator:
+
+    def __init__(self, promotion, coupon, customer, tax_rate, tax_zip, effective_date=None, is_military=False,
+                 override_subtotal=None, one_time_discount_pct=None):
+        self.promotion = promotion
+        self.coupon = coupon
+        self.customer = customer
+        self.tax_rate = tax_rate
+        self.tax_zip = tax_zip
+        self.effective_date = effective_date
+        self.is_military = is_military
+        self.override_subtotal = float(override_subtotal) if override_subtotal else None
+        self.one_time_discount_pct = one_time_discount_pct
+        self.subtotal = 0.0
+
+    def calculate_specific_discount(self, value):
+        self.promotion_discount = self.promotion.get_discount_value(value) if self.promotion else 0
+        if not self.coupon or self.coupon.is_expired_on(self.effective_date):
+            self.coupon_discount = 0
+        else:
+            self.coupon_discount = self.coupon.get_discount_value(value)
+        if self.customer and self.customer.discount_pct:
+            self.customer_discount = value * self.customer.discount_pct / 100
+        else:
+            self.customer_discount = 0
+        self.military_discount = value * settings.MILITARY_DISCOUNT_PCT / 100 if self.is_military else 0
+        self.one_time_discount = value * self.one_time_discount_pct / 100 if self.one_time_discount_pct else 0
+        specific_discounts = sorted([
+            dict(discount=self.promotion_discount, label='Promotional discount'),
+            dict(discount=self.coupon_discount, label='Coupon discount'),
+            dict(discount=self.customer_discount, label='Customer discount'),
+            dict(discount=self.military_discount, label='Military discount'),
+            dict(discount=self.one_time_discount, label='One-time discount'),
+        ], key=lambda x: x['discount'], reverse=True)
+        self.specific_discount = specific_discounts[0]['discount']
+        self.specific_discount_label = specific_discounts[0]['label'] if self.specific_discount else ''
+
+    @property
+    def pre_tax_subtotal(self):
+        return self.override_subtotal or self.subtotal
+
+    def get_tax_amount(self):
+        return float(self.tax_rate.total_rate) * self.pre_tax_subtotal
+
+    @property
+    def total_with_tax(self):
+        return self.pre_tax_subtotal + self.get_tax_amount()
+
+    def get_common_price_data(self):
+        return dict(
+            tax_zip=self.tax_zip,
+            tax_rate=self.tax_rate.total_rate,
+            tax_rate_as_percent=self.tax_rate.total_rate * 100,
+            customer_id=self.customer.id if self.customer else None,
+            promotion_discount=quantize_currency(self.promotion_discount),
+            coupon_discount=quantize_currency(self.coupon_discount),
+            customer_discount=quantize_currency(self.customer_discount),
+            military_discount=quantize_currency(self.military_discount),
+            one_time_discount=quantize_currency(self.one_time_discount),
+            specific_discount=quantize_currency(self.specific_discount),
+            specific_discount_label=self.specific_discount_label,
+            subtotal=quantize_currency(self.pre_tax_subtotal),
+            computed_subtotal=quantize_currency(self.subtotal),
+            total_with_tax=quantize_currency(self.total_with_tax),
+            tax_amount=quantize_currency(self.get_tax_amount()),
+        )
+
+
+class LegacyRentalPriceCalculator(LegacyPriceCalculator):
+
+    def __init__(self, vehicle_marketing, num_days, extra_miles, **kwargs):
+        super().__init__(**kwargs)
+        self.vehicle_marketing = vehicle_marketing
+        self.num_days = num_days
+        self.extra_miles = int(extra_miles)
+
+        self.base_price = float(vehicle_marketing.price_per_day * num_days)
+        if num_days >= 7:
+            self.multi_day_discount_pct = vehicle_marketing.discount_7_day
+        elif num_days >= 3:
+            self.multi_day_discount_pct = vehicle_marketing.discount_3_day
+        elif num_days >= 2:
+            self.multi_day_discount_pct = vehicle_marketing.discount_2_day
+        else:
+            self.multi_day_discount_pct = 0
+        self.subtotal = self.base_price
+        self.multi_day_discount = self.subtotal * self.multi_day_discount_pct / 100
+        self.subtotal = self.subtotal - float(self.multi_day_discount)
+        self.post_multi_day_discount_subtotal = self.subtotal
+        self.calculate_specific_discount(self.subtotal)
+        self.subtotal = self.subtotal - float(self.specific_discount)
+        try:
+            self.extra_miles_surcharge = settings.EXTRA_MILES_PRICES.get(self.extra_miles)['cost']
+        except TypeError:
+            self.extra_miles_surcharge = 0
+        self.subtotal = self.subtotal + float(self.extra_miles_surcharge)
+
+    def get_price_data(self):
+        price_data = dict(
+            vehicle_price_per_day=quantize_currency(self.vehicle_marketing.price_per_day),
+            num_days=self.num_days,
+            base_price=quantize_currency(self.base_price),
+            multi_day_discount=quantize_currency(self.multi_day_discount),
+            multi_day_discount_pct=self.multi_day_discount_pct,
+            post_multi_day_discount_subtotal=quantize_currency(self.post_multi_day_discount_subtotal),
+            extra_miles=self.extra_miles,
+            extra_miles_cost=quantize_currency(self.extra_miles_surcharge),
+            reservation_deposit=quantize_currency(self.total_with_tax / 2),
+        )
+        price_data.update(self.get_common_price_data())
+        return price_data
+
+
+class LegacyGuidedDrivePriceCalculator(LegacyPriceCalculator):
+
+    def __init__(self, num_drivers, num_passengers, driver_cost, passenger_cost, **kwargs):
+        super().__init__(**kwargs)
+        self.num_drivers = num_drivers
+        self.num_passengers = num_passengers
+        self.driver_cost = driver_cost
+        self.passenger_cost = passenger_cost
+        self.base_price = driver_cost + passenger_cost
+        self.subtotal = self.base_price
+        self.calculate_specific_discount(self.subtotal)
+        self.subtotal = self.subtotal - float(self.specific_discount)
+
+    def get_price_data(self):
+        price_data = dict(
+            num_drivers=self.num_drivers,
+            num_passengers=self.num_passengers,
+            driver_cost=self.driver_cost,
+            passenger_cost=self.passenger_cost,
+            base_price=quantize_currency(self.base_price),
+        )
+        price_data.update(self.get_common_price_data())
+        return price_data
+
+
+def legacy_performance_experience_costs(num_drivers, num_passengers):
+    prices = settings.PERFORMANCE_EXPERIENCE_PRICES
+    if not num_drivers:
+        driver_cost = 0
+    elif num_drivers in (1, 2, 3, 4):
+        driver_cost = prices[f'{num_drivers}_drv']
+    else:
+        driver_cost = prices['cost_per_drv_gt_4'] * num_drivers
+    passenger_cost = prices['cost_per_pax'] * num_passengers if num_passengers else 0
+    return driver_cost, passenger_cost
+
+
+def legacy_joy_ride_passenger_cost(num_passengers):
+    prices = settings.JOY_RIDE_PRICES
+    if not num_passengers:
+        return 0
+    if num_passengers in (1, 2, 3, 4):
+        return prices[f'{num_passengers}_pax']
+    return prices['cost_per_pax_gt_4'] * num_passengers
+
+
+EFFECTIVE_DATE = date(2022, 6, 12)
+EMAIL = 'email@test.com'
+TAX_ZIP = '07430'
+
+VEHICLES = [
+    VehicleMarketing(id=1, price_per_day=Decimal('500.00'), discount_2_day=10, discount_3_day=20, discount_7_day=40),
+    VehicleMarketing(id=2, price_per_day=Decimal('1249.99'), discount_2_day=0, discount_3_day=15, discount_7_day=33),
+    VehicleMarketing(id=3, price_per_day=Decimal('333.33'), discount_2_day=5, discount_3_day=5, discount_7_day=5),
+]
+PROMOTIONS = [
+    None,
+    Promotion(percent=Decimal('20.00'), end_date=date(2022, 6, 30)),
+    Promotion(amount=Decimal('50.00'), end_date=date(2022, 6, 30)),
+]
+COUPONS = [
+    None,
+    Coupon(code='FLAT15', amount=Decimal('15.00')),
+    Coupon(code='PCT12', percent=Decimal('12.50')),
+    Coupon(code='EXPIRED', amount=Decimal('500.00'), end_date=date(2021, 12, 31)),
+]
+CUSTOMERS = [
+    None,
+    Customer(id=7, discount_pct=10),
+    Customer(id=8, discount_pct=None),
+]
+TAX_RATES = [
+    TaxRate(postal_code=TAX_ZIP, total_rate=Decimal('0.06625')),
+    TaxRate(postal_code=TAX_ZIP, total_rate=0.07),
+]
+COMMON_GRID = list(itertools.product(
+    PROMOTIONS, COUPONS, CUSTOMERS, TAX_RATES,
+    (False, True),  # is_military
+    (None, 15),  # one_time_discount_pct
+    (None, Decimal('1400.00')),  # override_subtotal
+))
+
+
+def get_pricing_context(service_type, promotion, coupon, customer, tax_rate):
+    # Seed every lookup so the calculators never query; these tests have no database access
+    pricing_context = PricingContext()
+    pricing_context.promotions[(EFFECTIVE_DATE, service_type)] = promotion
+    pricing_context.coupons['TEST'] = coupon
+    pricing_context.customers[EMAIL] = customer
+    pricing_context.tax_rates[TAX_ZIP] = tax_rate
+    return pricing_context
+
+
+def get_common_kwargs(promotion, coupon, customer, tax_rate, is_military, one_time_discount_pct, override_subtotal):
+    legacy_kwargs = dict(
+        promotion=promotion, coupon=coupon, customer=customer, tax_rate=tax_rate, tax_zip=TAX_ZIP,
+        effective_date=EFFECTIVE_DATE, is_military=is_military, override_subtotal=override_subtotal,
+        one_time_discount_pct=one_time_discount_pct,
+    )
+    adapter_kwargs = dict(
+        coupon_code='test', email=EMAIL, tax_zip=TAX_ZIP, effective_date=EFFECTIVE_DATE, is_military=is_military,
+        override_subtotal=override_subtotal, one_time_discount_pct=one_time_discount_pct,
+    )
+    return legacy_kwargs, adapter_kwargs
+
+
+def test_rental_price_data_equivalence():
+    cases = list(itertools.product(VEHICLES, range(1, 15), (0, 100, 250, 999), COMMON_GRID))
+    for vehicle, num_days, extra_miles, common in random.Random(0).sample(cases, 3000):
+        promotion, coupon, customer, tax_rate = common[:4]
+        legacy_kwargs, adapter_kwargs = get_common_kwargs(*common)
+        expected = LegacyRentalPriceCalculator(vehicle, num_days, extra_miles, **legacy_kwargs).get_price_data()
+
+        pricing_context = get_pricing_context(ServiceType.RENTAL, promotion, coupon, customer, tax_rate)
+        calculator = RentalPriceCalculator(vehicle, num_days, extra_miles, pricing_context=pricing_context, **adapter_kwargs)
+        assert calculator.get_price_data() == expected
+
+        assert get_rental_price_data(
+            price_per_day=vehicle.price_per_day,
+            num_days=num_days,
+            extra_miles=extra_miles,
+            discount_2_day=vehicle.discount_2_day,
+            discount_3_day=vehicle.discount_3_day,
+            discount_7_day=vehicle.discount_7_day,
+            tax_zip=TAX_ZIP,
+            tax_rate=tax_rate.total_rate,
+            customer_id=customer.id if customer else None,
+            override_subtotal=legacy_kwargs['override_subtotal'],
+            promotion=(promotion.amount, promotion.percent) if promotion else None,
+            coupon=(coupon.amount, coupon.percent) if coupon and not coupon.is_expired_on(EFFECTIVE_DATE) else None,
+            customer_discount_pct=customer.discount_pct if customer else None,
+            military_discount_pct=settings.MILITARY_DISCOUNT_PCT if legacy_kwargs['is_military'] else None,
+            one_time_discount_pct=legacy_kwargs['one_time_discount_pct'],
+        ) == expected
+
+
+@pytest.mark.parametrize('num_drivers', [0, 1, 2, 3, 4, 5, 8])
+@pytest.mark.parametrize('num_passengers', [0, 1, 3, 5])
+def test_performance_experience_price_data_equivalence(num_drivers, num_passengers):
+    driver_cost, passenger_cost = legacy_performance_experience_costs(num_drivers, num_passengers)
+    for common in COMMON_GRID:
+        promotion, coupon, customer, tax_rate = common[:4]
+        legacy_kwargs, adapter_kwargs = get_common_kwargs(*common)
+        expected = LegacyGuidedDrivePriceCalculator(
+            num_drivers, num_passengers, driver_cost, passenger_cost, **legacy_kwargs
+        ).get_price_data()
+
+        pricing_context = get_pricing_context(None, promotion, coupon, customer, tax_rate)
+        calculator = PerformanceExperiencePriceCalculator(
+            num_drivers, num_passengers, pricing_context=pricing_context, **adapter_kwargs
+        )
+        assert calculator.get_price_data() == expected
+
+
+@pytest.mark.parametrize('num_passengers', [0, 1, 2, 3, 4, 5, 9])
+def test_joy_ride_price_data_equivalence(num_passengers):
+    passenger_cost = legacy_joy_ride_passenger_cost(num_passengers)
+    for common in COMMON_GRID:
+        promotion, coupon, customer, tax_rate = common[:4]
+        legacy_kwargs, adapter_kwargs = get_common_kwargs(*common)
+        expected = LegacyGuidedDrivePriceCalculator(0, num_passengers, 0, passenger_cost, **legacy_kwargs).get_price_data()
+
+        pricing_context = get_pricing_context(None, promotion, coupon, customer, tax_rate)
+        calculator = JoyRidePriceCalculator(num_passengers, pricing_context=pricing_context, **adapter_kwargs)
+        assert calculator.get_price_data() == expected
+
+
+def test_bulk_quotes_without_queries():
+    # Pure functions only; any ORM access would fail here since the test has no database access
+    quotes = [
+        get_joy_ride_price_data(num_passengers=num_passengers, tax_zip=TAX_ZIP, tax_rate=Decimal('0.05'))
+        for num_passengers in range(1, 5)
+    ] + [
+        get_performance_experience_price_data(
+            num_drivers=2, num_passengers=1, tax_zip=TAX_ZIP, tax_rate=Decimal('0.05'),
+            promotion=(Decimal('25.00'), None),
+        )
+    ]
+    assert [quote['total_with_tax'] for quote in quotes] == [
+        Decimal('262.50'), Decimal('472.50'), Decimal('708.75'), Decimal('945.00'), Decimal('892.50'),
+    ]
@@ -1,16 +1,58 @@
+import contextlib
+import ipaddress
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from decimal import Decimal
-from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from datetime import date, datetime
 from freezegun import freeze_time
 
-from django.test import TestCase
+import requests
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
+from api.views import AvailableVehiclesView, BatchRentalQuoteView, ValidateRentalDetailsView
 from fleet.models import Vehicle, VehicleMarketing, VehicleStatus
 from users.models import Customer, User
-from sales.models import TaxRate, Coupon, Promotion
-from sales.calculators import RentalPriceCalculator
+from sales.models import TaxRate, Coupon, Promotion, Reservation, Rental, JoyRide, IPBan
+from consignment.models import ConsignmentReservation
+from sales.cache import check_version_cache
+from sales.enums import ServiceType
+from sales.calculators import (
+    PricingContext, RentalPriceCalculator, get_cached_price_data, get_pricing_version, promotion_index,
+)
+from sales.forms import ReCAPTCHAFormMixin, ReservationRentalDetailsForm
+from sales.tax_rates import get_tax_rate, refresh_tax_rate, tax_rate_table
+from sales.ip_bans import ip_ban_matcher
+from sales.stripe import TimedStripeClient
+from sales.tasks import send_email
+from pri.metrics import request_metrics
+from pri.middleware import RequestMetricsMiddleware
+from pri.outbound import RECAPTCHA, http_request
+from pri.pdf import html_to_pdf
+from sales.availability import (
+    availability_index, get_free_vehicle_ids, Booking, BLOCKING_KINDS, CONSIGNMENT, RENTAL, RESERVATION,
+)
 
 
 class RentalPriceCalculatorTestCase(TestCase):
@@ -51,15 +93,6 @@ class RentalPriceCalculatorTestCase(TestCase):
             end_date=date(2022, 6, 11),
         )
 
-    def test_get_tax_rate_from_avalara_api(self):
-        """
-        Make live query to Avalara API and check that a valid response is returned
-        """
-        tax_rate = TaxRate.objects.create(
-            postal_code='34210'
-        )
-        assert tax_rate.total_rate == 0.07
-
     def test_get_rental_price_data(self):
         """
         2-day rental, 200 extra miles, no coupon, no customer discount
@@ -245,6 +278,122 @@ class RentalPriceCalculatorTestCase(TestCase):
         self.assertEqual(price_data['subtotal'], Decimal('1400.00'))
         self.assertEqual(price_data['total_with_tax'], Decimal('1492.75'))
 
+    def test_shared_pricing_context(self):
+        """
+        Calculators sharing a PricingContext resolve customer and tax rate only once; promotion and coupon come from the
+        promotion index, loaded with one query
+        """
+        pricing_context = PricingContext()
+        calculator_kwargs = dict(
+            coupon_code='test',
+            email='email@test.com',
+            tax_zip='07430',
+            effective_date=date(2022, 6, 12),
+            pricing_context=pricing_context,
+        )
+        with self.assertNumQueries(3):
+            price_data = RentalPriceCalculator(self.vehicle_1, 2, 200, **calculator_kwargs).get_price_data()
+        with self.assertNumQueries(0):
+            for num_days in range(1, 8):
+                RentalPriceCalculator(self.vehicle_1, num_days, 200, **calculator_kwargs).get_price_data()
+
+        self.assertEqual(price_data['customer_id'], self.customer_1.id)
+        self.assertEqual(price_data['specific_discount_label'], 'Customer discount')
+        self.assertEqual(pricing_context.get_coupon('TEST'), self.coupon_1)
+
+
+class PriceDataCacheTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.vehicle_1 = VehicleMarketing.objects.create(
+            price_per_day=500,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+            security_deposit=5000.00,
+        )
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code='07430',
+            total_rate=0.06625,
+        )
+        self.user_1 = User.objects.create_user(
+            email='email@test.com',
+        )
+        self.customer_1 = Customer.objects.create(
+            user=self.user_1,
+            discount_pct=1,
+        )
+        self.coupon_1 = Coupon.objects.create(
+            amount=15.00,
+            code='TEST',
+        )
+        self.quote_kwargs = dict(
+            vehicle_marketing=self.vehicle_1,
+            num_days=2,
+            extra_miles=200,
+            coupon_code='test',
+            email='email@test.com',
+            tax_zip='07430',
+            effective_date=date(2022, 6, 12),
+        )
+
+    def get_price_data(self):
+        return get_cached_price_data(RentalPriceCalculator, pricing_context=PricingContext(), **self.quote_kwargs)
+
+    def test_local_cache_refused(self):
+        # The version keys only reach other processes through a shared cache
+        with override_settings(DEBUG=False):
+            with self.assertRaises(ImproperlyConfigured):
+                check_version_cache()
+            with override_settings(VERSION_LOCAL_CACHE_ALLOWED=True):
+                check_version_cache()
+
+    def test_repeated_quote_is_cached(self):
+        price_data = self.get_price_data()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_price_data(), price_data)
+        self.quote_kwargs['coupon_code'] = 'TEST'
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_price_data(), price_data)
+
+    def test_pricing_changes_invalidate_cache(self):
+        self.assertEqual(self.get_price_data()['total_with_tax'], Decimal('1295.49'))
+
+        pricing_version = get_pricing_version()
+        self.customer_1.save()
+        self.vehicle_1.security_deposit = 2500
+        self.vehicle_1.save()
+        self.assertEqual(get_pricing_version(), pricing_version)
+
+        self.coupon_1.amount = 20.00
+        self.coupon_1.save()
+        self.assertEqual(self.get_price_data()['total_with_tax'], Decimal('1290.16'))
+
+        self.customer_1.discount_pct = 10
+        self.customer_1.save()
+        self.assertEqual(self.get_price_data()['specific_discount_label'], 'Customer discount')
+
+        self.vehicle_1.price_per_day = 600
+        self.vehicle_1.save()
+        self.assertEqual(self.get_price_data()['base_price'], Decimal('1200.00'))
+
+    def test_tax_rate_changes_invalidate_cache(self):
+        price_data = self.get_price_data()
+        pricing_version = get_pricing_version()
+
+        # A refresh confirming the stored rate (as a float, the way Avalara returns it) keeps cached quotes
+        self.tax_rate_1.total_rate = 0.06625
+        self.tax_rate_1.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_price_data(), price_data)
+
+        self.tax_rate_1.total_rate = 0.07
+        self.tax_rate_1.save()
+        self.assertNotEqual(self.get_price_data()['total_with_tax'], price_data['total_with_tax'])
+        self.assertEqual(get_pricing_version(), pricing_version)
+
 
 class RentalTestCase(TestCase):
 
@@ -391,6 +540,206 @@ class RentalTestCase(TestCase):
         self.assertIn('Invalid vehicle specified.', result['errors']['__all__'])
 
 
+class RentalQuoteQueryCountTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.client = Client()
+        self.vehiclemarketing_1 = VehicleMarketing.objects.create(
+            id=1,
+            slug='test-vehicle',
+            status=VehicleStatus.READY,
+            price_per_day=500,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+            security_deposit=5000.00,
+        )
+        self.vehicle_1 = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_1.id)
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code=settings.DEFAULT_TAX_ZIP,
+            total_rate=0.06625,
+        )
+        self.post_data = dict(
+            vehicle_marketing=1,
+            out_date='04/25/2023',
+            out_time='17:00',
+            back_date='04/27/2023',
+            back_time='17:00',
+            drivers='1',
+            delivery_required='0',
+            delivery_zip='',
+            extra_miles='100',
+            email='test@test.com',
+            coupon_code='',
+            is_military=False,
+        )
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_price_data_is_memoized(self):
+        form = ReservationRentalDetailsForm(self.post_data)
+        self.assertTrue(form.is_valid())
+        price_data = form.price_data
+        with self.assertNumQueries(0):
+            for _ in range(15):
+                self.assertIs(form.price_data, price_data)
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_price_data_recomputed_when_cleaned_data_changes(self):
+        form = ReservationRentalDetailsForm(self.post_data)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.price_data['extra_miles'], 100)
+        form.cleaned_data['extra_miles'] = 200
+        self.assertEqual(form.price_data['extra_miles'], 200)
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_legacy_rental_details_single_pricing_evaluation(self):
+        post_data = dict(
+            method='validateRentalIdentity',
+            email='test@test.com',
+            vehicleid=1,
+            dateout='04/25/2023',
+            dateouttime='17:00',
+            dateback='04/27/2023',
+            datebacktime='17:00',
+            delivery='0',
+            deliveryzip='',
+            extramiles='100',
+            drivers='1',
+        )
+        with mock.patch.object(
+            RentalPriceCalculator, 'get_price_data', autospec=True, side_effect=RentalPriceCalculator.get_price_data,
+        ) as get_price_data:
+            response = self.client.post(reverse('legacy-post'), post_data)
+        result = response.json()
+        self.assertTrue(result['success'])
+        self.assertEqual(get_price_data.call_count, 1)
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_legacy_rental_details_query_count(self):
+        payload = dict(self.post_data, coupon_code=None)
+        form = ReservationRentalDetailsForm(payload)
+        self.assertTrue(form.is_valid())
+        price_data = form.price_data
+        request = RequestFactory().post(reverse('legacy-post'))
+
+        # Starting cold, each index is loaded once, however often the form validates and prices the rental
+        indexes = (availability_index, promotion_index, tax_rate_table)
+        cache.clear()
+        for index in indexes:
+            index.invalidate()
+        with contextlib.ExitStack() as stack:
+            loads = [stack.enter_context(mock.patch.object(index, 'load', wraps=index.load)) for index in indexes]
+            response = ValidateRentalDetailsView().post_legacy(request, payload)
+        self.assertTrue(response.data['success'])
+        self.assertEqual([load.call_count for load in loads], [1, 1, 1])
+
+        # Once loaded, with the price cached: the customer, the vehicle, and confirming the vehicle is free (one query
+        # per booking table)
+        with self.assertNumQueries(4):
+            response = ValidateRentalDetailsView().post_legacy(request, payload)
+        self.assertTrue(response.data['success'])
+        self.assertEqual(response.data['price_data'], price_data)
+
+
+class BatchRentalQuoteTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.client = Client()
+        self.vehiclemarketing_1 = VehicleMarketing.objects.create(
+            status=VehicleStatus.READY,
+            price_per_day=500,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+        )
+        self.vehiclemarketing_2 = VehicleMarketing.objects.create(
+            status=VehicleStatus.READY,
+            price_per_day=1000,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+        )
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code='07430',
+            total_rate=0.06625,
+        )
+        self.coupon_1 = Coupon.objects.create(
+            amount=15.00,
+            code='TEST',
+        )
+
+    @staticmethod
+    def post_quotes(data):
+        # Straight to the view, so only the queries made by the quoting itself are counted (not the session's)
+        request = RequestFactory().post(reverse('batch-rental-quote'), json.dumps(data), content_type='application/json')
+        return BatchRentalQuoteView.as_view()(request).render()
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_batch_quote(self):
+        quotes = []
+        for vehicle_marketing in (self.vehiclemarketing_1, self.vehiclemarketing_2):
+            for day in range(1, 11):
+                quotes.append(dict(
+                    vehicle_marketing=vehicle_marketing.id,
+                    out_at=f'2023-05-{day:02d}T10:00:00-04:00',
+                    back_at=f'2023-05-{day + 2:02d}T10:00:00-04:00',
+                    extra_miles=200,
+                    coupon_code='test',
+                ))
+        quotes.append(dict(vehicle_marketing=9999, out_at='2023-05-01T10:00:00-04:00', back_at='2023-05-02T10:00:00-04:00'))
+
+        with CaptureQueriesContext(connections['default']) as captured:
+            response = self.post_quotes(dict(quotes=quotes, delivery_zip='07430'))
+        result = json.loads(response.content)
+        self.assertTrue(result['success'])
+        self.assertEqual(len(result['quotes']), 21)
+        self.assertEqual(result['quotes'][0]['price_data']['num_days'], 2)
+        self.assertEqual(result['quotes'][0]['price_data']['coupon_discount'], 15.0)
+        self.assertEqual(result['quotes'][0]['price_data']['total_with_tax'], 1295.49)
+        self.assertFalse(result['quotes'][-1]['success'])
+        # The promotion index and the tax rate are each loaded once for the whole batch
+        self.assertEqual(len(captured.captured_queries), 2)
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_batch_quote_limit(self):
+        quote = dict(
+            vehicle_marketing=self.vehiclemarketing_1.id,
+            out_at='2023-05-01T10:00:00-04:00',
+            back_at='2023-05-03T10:00:00-04:00',
+        )
+        response = self.client.post(
+            reverse('batch-rental-quote'),
+            dict(quotes=[quote] * (settings.BATCH_QUOTE_MAX_ITEMS + 1)),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+
+    @freeze_time('2023-05-02 15:00:00')
+    def test_batch_quote_past_date(self):
+        # Reported for the quote, like an invalid vehicle, rather than failing the batch
+        quotes = [dict(
+            vehicle_marketing=self.vehiclemarketing_1.id,
+            out_at=f'2023-05-{day:02d}T10:00:00-04:00',
+            back_at=f'2023-05-{day + 2:02d}T10:00:00-04:00',
+        ) for day in (1, 3)]
+        response = self.client.post(
+            reverse('batch-rental-quote'),
+            dict(quotes=quotes),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertTrue(result['success'])
+        self.assertFalse(result['quotes'][0]['success'])
+        self.assertEqual(result['quotes'][0]['error'], "You've specified a rental date in the past.")
+        self.assertTrue(result['quotes'][1]['success'])
+
+
 class PerformanceExperienceTestCase(TestCase):
 
     databases = ('default', 'front',)
@@ -431,3 +780,936 @@ class PerformanceExperienceTestCase(TestCase):
         self.assertIn('big_and_tall', errors)
         self.assertIn('email', errors)
         self.assertEqual(list(errors.keys())[0], 'num_passengers')
+
+
+class RepricingTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        self.vehiclemarketing_1 = VehicleMarketing.objects.create(
+            price_per_day=500,
+            discount_2_day=10,
+            discount_3_day=20,
+            discount_7_day=40,
+        )
+        self.vehicle_1 = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_1.id)
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code=settings.DEFAULT_TAX_ZIP,
+            total_rate=0.05,
+        )
+        self.user_1 = User.objects.create_user(
+            email='email@test.com',
+        )
+        self.customer_1 = Customer.objects.create(
+            user=self.user_1,
+            discount_pct=10,
+        )
+        self.rental_1 = Rental.objects.create(
+            vehicle=self.vehicle_1,
+            customer=self.customer_1,
+            out_at=timezone.make_aware(datetime(2022, 7, 1, 10)),
+            back_at=timezone.make_aware(datetime(2022, 7, 3, 10)),
+            extra_miles=0,
+        )
+        # The first save has no id yet, so final_price_data is only computed on the second
+        self.rental_1.save()
+        # Change the price without going through save(), as a pricing rule change would
+        VehicleMarketing.objects.filter(pk=self.vehiclemarketing_1.id).update(price_per_day=600)
+
+    def test_dry_run(self):
+        call_command('reprice', dry_run=True, stdout=StringIO())
+        self.rental_1.refresh_from_db()
+        self.assertEqual(self.rental_1.final_price_data['subtotal'], '810.00')
+
+    def test_reprice(self):
+        """
+        2 days at $600 less 10% multi-day discount = $1080, less 10% customer discount = $972
+        """
+        stdout = StringIO()
+        call_command('reprice', stdout=stdout)
+        self.rental_1.refresh_from_db()
+        self.assertEqual(self.rental_1.final_price_data['subtotal'], '972.00')
+        self.assertEqual(self.rental_1.final_price_data['total_with_tax'], '1020.60')
+        self.assertIn('1 scanned, 1 changed, 0 skipped', stdout.getvalue())
+
+        # Nothing left to change
+        stdout = StringIO()
+        call_command('reprice', stdout=stdout)
+        self.assertIn('1 scanned, 0 changed, 0 skipped', stdout.getvalue())
+
+    def test_partial_save_keeps_unsaved_changes(self):
+        """
+        3 days at $600 less 20% multi-day discount = $1440, less 10% customer discount = $1296
+        """
+        # The booked return date, which the price follows (back_at alone moves on an extension)
+        self.rental_1.back_at = self.rental_1.back_at_orig = timezone.make_aware(datetime(2022, 7, 4, 10))
+        self.rental_1.reprice()
+        # The dates were not written by reprice(), so they still count as changed
+        self.assertTrue(self.rental_1.pricing_inputs_changed)
+        self.rental_1.save()
+        self.assertFalse(self.rental_1.pricing_inputs_changed)
+        self.rental_1.refresh_from_db()
+        self.assertEqual(self.rental_1.back_at_orig, timezone.make_aware(datetime(2022, 7, 4, 10)))
+        self.assertEqual(self.rental_1.final_price_data['subtotal'], '1296.00')
+
+    def test_date_range(self):
+        call_command('reprice', start_date='2022-07-02', stdout=StringIO())
+        self.rental_1.refresh_from_db()
+        self.assertEqual(self.rental_1.final_price_data['subtotal'], '810.00')
+        call_command('reprice', start_date='2022-07-01', end_date='2022-07-01', stdout=StringIO())
+        self.rental_1.refresh_from_db()
+        self.assertEqual(self.rental_1.final_price_data['subtotal'], '972.00')
+
+    def test_save_without_pricing_changes(self):
+        rental = Rental.objects.get(pk=self.rental_1.id)
+        rental.customer_notes = 'Notes'
+        rental.mileage_out = 1000
+        rental.save()
+        rental.refresh_from_db()
+        self.assertEqual(rental.final_price_data['subtotal'], '810.00')
+
+    def test_save_with_pricing_changes(self):
+        """
+        Changing extra_miles reprices with the current vehicle rate: $972 + $330 for 200 extra miles
+        """
+        rental = Rental.objects.get(pk=self.rental_1.id)
+        rental.extra_miles = 200
+        rental.save()
+        rental.refresh_from_db()
+        self.assertEqual(rental.final_price_data['subtotal'], '1302.00')
+
+    def test_forced_reprice(self):
+        rental = Rental.objects.get(pk=self.rental_1.id)
+        rental.reprice()
+        rental.refresh_from_db()
+        self.assertEqual(rental.final_price_data['subtotal'], '972.00')
+
+
+class PromotionIndexTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.promotion_1 = Promotion.objects.create(
+            percent=20,
+            name='Summer',
+            start_date=date(2022, 6, 1),
+            end_date=date(2022, 8, 31),
+        )
+        self.promotion_2 = Promotion.objects.create(
+            percent=10,
+            name='July 4th',
+            start_date=date(2022, 7, 1),
+            end_date=date(2022, 7, 10),
+            service_type=ServiceType.JOY_RIDE.value,
+        )
+        self.promotion_3 = Promotion.objects.create(
+            percent=15,
+            name='Open-ended start',
+            end_date=date(2022, 5, 15),
+        )
+        self.coupon_1 = Coupon.objects.create(
+            amount=15.00,
+            code='test',
+        )
+        self.coupon_2 = Coupon.objects.create(
+            amount=15.00,
+            code='EXPIRED',
+            end_date=date(2021, 12, 31),
+        )
+
+    def test_promotion_lookup(self):
+        promotion_index.get_promotion(date(2022, 1, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(promotion_index.get_promotion(date(2022, 1, 1)), self.promotion_3)
+            self.assertEqual(promotion_index.get_promotion(date(2022, 5, 15)), self.promotion_3)
+            self.assertIsNone(promotion_index.get_promotion(date(2022, 5, 16)))
+            self.assertEqual(promotion_index.get_promotion(date(2022, 6, 1)), self.promotion_1)
+            # Overlapping promotions resolve to the first by id
+            self.assertEqual(promotion_index.get_promotion(date(2022, 7, 4)), self.promotion_1)
+            self.assertEqual(promotion_index.get_promotion(date(2022, 8, 31)), self.promotion_1)
+            self.assertIsNone(promotion_index.get_promotion(date(2022, 9, 1)))
+            self.assertIsNone(promotion_index.get_promotion(None))
+
+    def test_service_type(self):
+        Promotion.objects.filter(pk=self.promotion_1.pk).update(service_type=ServiceType.RENTAL.value)
+        promotion_index.invalidate()
+        self.assertEqual(
+            promotion_index.get_promotion(date(2022, 7, 4), service_type=ServiceType.RENTAL), self.promotion_1
+        )
+        self.assertEqual(
+            promotion_index.get_promotion(date(2022, 7, 4), service_type=ServiceType.JOY_RIDE), self.promotion_2
+        )
+        self.assertIsNone(
+            promotion_index.get_promotion(date(2022, 7, 11), service_type=ServiceType.PERFORMANCE_EXPERIENCE)
+        )
+
+    def test_coupon_lookup(self):
+        self.assertEqual(promotion_index.get_coupon('Test'), self.coupon_1)
+        self.assertEqual(promotion_index.get_coupon('expired'), self.coupon_2)
+        self.assertIsNone(promotion_index.get_coupon('missing'))
+        self.assertEqual(promotion_index.get_unexpired_coupon('TEST', date(2022, 1, 1)), self.coupon_1)
+        self.assertEqual(promotion_index.get_unexpired_coupon('EXPIRED', date(2021, 12, 31)), self.coupon_2)
+        self.assertIsNone(promotion_index.get_unexpired_coupon('EXPIRED', date(2022, 1, 1)))
+
+    def test_invalidated_on_save(self):
+        self.assertIsNone(promotion_index.get_promotion(date(2022, 9, 1)))
+        promotion = Promotion.objects.create(percent=5, name='Fall', end_date=date(2022, 11, 30))
+        self.assertEqual(promotion_index.get_promotion(date(2022, 9, 1)), promotion)
+        coupon = Coupon.objects.create(amount=5, code='NEW')
+        self.assertEqual(promotion_index.get_coupon('new'), coupon)
+        coupon.delete()
+        self.assertIsNone(promotion_index.get_coupon('new'))
+
+
+# Local stand-in for the Avalara tax rates API. Answers every ZIP with a rate of 0.0XYZ derived from the ZIP, except
+# FAKE_AVALARA_ERROR_ZIP, which gets a 500.
+
+FAKE_AVALARA_ERROR_ZIP = '99999'
+
+
+class FakeAvalaraHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        postal_code = parse_qs(urlparse(self.path).query).get('postalCode', [''])[0]
+        self.server.requested_zips.append(postal_code)
+        if postal_code == FAKE_AVALARA_ERROR_ZIP:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps({'totalRate': get_fake_avalara_rate(postal_code), 'rates': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_fake_avalara_rate(postal_code):
+    return float(f'0.0{postal_code[-3:]}')
+
+
+class FakeAvalaraMixin:
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.avalara_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAvalaraHandler)
+        cls.avalara_server.requested_zips = []
+        threading.Thread(target=cls.avalara_server.serve_forever, daemon=True).start()
+        cls.avalara_settings = override_settings(
+            AVALARA_ENVIRONMENT=f'http://127.0.0.1:{cls.avalara_server.server_port}',
+            AVALARA_ACCOUNT_ID='1234',
+            AVALARA_LICENSE_KEY='test',
+        )
+        cls.avalara_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.avalara_settings.disable()
+        cls.avalara_server.shutdown()
+        cls.avalara_server.server_close()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        self.avalara_server.requested_zips.clear()
+
+
+class TaxRateServiceTestCase(FakeAvalaraMixin, TestCase):
+
+    def test_unknown_zip(self):
+        """
+        A ZIP with no stored rate is answered at the default rate without calling Avalara, and queued for a refresh
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            tax_rate = get_tax_rate('10001')
+        self.assertEqual(tax_rate.total_rate, Decimal(settings.DEFAULT_TAX_RATE))
+        self.assertIsNone(tax_rate.pk)
+        self.assertFalse(TaxRate.objects.filter(postal_code='10001').exists())
+        self.assertEqual(self.avalara_server.requested_zips, [])
+        self.assertEqual(len(callbacks), 1)
+
+    def test_fresh_zip(self):
+        TaxRate.objects.create(postal_code='07430', total_rate=0.06625)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(get_tax_rate('07430').total_rate, Decimal('0.06625'))
+            with self.assertNumQueries(0):
+                self.assertEqual(get_tax_rate('07430').total_rate, Decimal('0.06625'))
+        self.assertEqual(len(callbacks), 0)
+
+    def test_stale_zip(self):
+        """
+        A stale rate is still served while it is queued for a refresh
+        """
+        with freeze_time('2022-01-01'):
+            TaxRate.objects.create(postal_code='07430', total_rate=0.06625)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(get_tax_rate('07430').total_rate, Decimal('0.06625'))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_refresh(self):
+        tax_rate = refresh_tax_rate('34210')
+        self.assertEqual(tax_rate.total_rate, Decimal('0.02100'))
+        self.assertEqual(self.avalara_server.requested_zips, ['34210'])
+        self.assertEqual(get_tax_rate('34210').total_rate, Decimal('0.02100'))
+        # Fresh rates are left alone unless forced
+        refresh_tax_rate('34210')
+        self.assertEqual(self.avalara_server.requested_zips, ['34210'])
+
+    def test_refresh_failure_keeps_last_rate(self):
+        with freeze_time('2022-01-01'):
+            TaxRate.objects.create(postal_code=FAKE_AVALARA_ERROR_ZIP, total_rate=0.05)
+        tax_rate = refresh_tax_rate(FAKE_AVALARA_ERROR_ZIP)
+        self.assertEqual(tax_rate.total_rate, Decimal('0.05'))
+        tax_rate = refresh_tax_rate('99998')
+        self.assertEqual(tax_rate.total_rate, Decimal('0.09980'))
+
+    def test_zero_rate(self):
+        """
+        A ZIP with no sales tax is a rate like any other: not stale while fresh, and kept if a refresh fails
+        """
+        TaxRate.objects.create(postal_code='97201', total_rate=0)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(get_tax_rate('97201').total_rate, Decimal('0'))
+        self.assertEqual(len(callbacks), 0)
+
+        with freeze_time('2022-01-01'):
+            TaxRate.objects.create(postal_code=FAKE_AVALARA_ERROR_ZIP, total_rate=0)
+        tax_rate = refresh_tax_rate(FAKE_AVALARA_ERROR_ZIP)
+        self.assertEqual(tax_rate.total_rate, Decimal('0'))
+
+
+# SQLite (as used for tests) does not take concurrent writes from the pool threads well, so these run with one worker
+
+@override_settings(TAX_RATE_BACKGROUND_REFRESH=False)
+class RefreshTaxRatesCommandTestCase(FakeAvalaraMixin, TransactionTestCase):
+
+    def test_refresh_stale(self):
+        with freeze_time('2022-01-01'):
+            for postal_code in ('07430', '07456', '10001', FAKE_AVALARA_ERROR_ZIP):
+                TaxRate.objects.create(postal_code=postal_code, total_rate=0.05)
+        TaxRate.objects.create(postal_code='34210', total_rate=0.07)
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('refresh_tax_rates', workers=1, stdout=stdout, stderr=stderr)
+        self.assertIn('3 tax rates refreshed, 1 failed.', stdout.getvalue())
+        self.assertEqual(
+            sorted(self.avalara_server.requested_zips), ['07430', '07456', '10001', FAKE_AVALARA_ERROR_ZIP]
+        )
+        for postal_code in ('07430', '07456', '10001'):
+            tax_rate = TaxRate.objects.get(postal_code=postal_code)
+            self.assertAlmostEqual(float(tax_rate.total_rate), get_fake_avalara_rate(postal_code))
+            self.assertFalse(tax_rate.is_stale)
+        self.assertEqual(TaxRate.objects.get(postal_code=FAKE_AVALARA_ERROR_ZIP).total_rate, Decimal('0.05'))
+
+    def test_refresh_given_zips(self):
+        call_command('refresh_tax_rates', '34210', '34211', workers=1, stdout=StringIO())
+        self.assertEqual(TaxRate.objects.get(postal_code='34211').total_rate, Decimal('0.02110'))
+
+
+class ImportTaxRatesCommandTestCase(TestCase):
+
+    def setUp(self) -> None:
+        TaxRate.objects.create(postal_code='07430', total_rate=0.06625)
+        TaxRate.objects.create(postal_code='07456', total_rate=0.06625)
+
+    def import_file(self, suffix, content, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        stdout = StringIO()
+        call_command('import_tax_rates', f.name, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_import_csv(self):
+        output = self.import_file('.csv', (
+            'State,ZipCode,TaxRegionName,EstimatedCombinedRate\n'
+            'NJ,7430,MAHWAH,0.066250\n'
+            'NJ,07456,RINGWOOD,0.070000\n'
+            'NY,10001,NEW YORK CITY,0.088750\n'
+        ))
+        self.assertIn('3 ZIPs read: 1 new, 1 changed, 1 unchanged.', output)
+        self.assertEqual(TaxRate.objects.get(postal_code='07456').total_rate, Decimal('0.07'))
+        with self.assertNumQueries(1):
+            self.assertEqual(tax_rate_table.get('10001').total_rate, Decimal('0.08875'))
+            self.assertEqual(tax_rate_table.get('07430').total_rate, Decimal('0.06625'))
+            self.assertIsNone(tax_rate_table.get('10002'))
+            self.assertIsNone(tax_rate_table.get('99999'))
+            self.assertEqual(len(tax_rate_table), 3)
+        with self.captureOnCommitCallbacks() as callbacks:
+            get_tax_rate('10001')
+        self.assertEqual(len(callbacks), 0)
+
+    def test_import_json(self):
+        self.import_file('.json', json.dumps([
+            {'postal_code': '10001', 'total_rate': 0.08875},
+            {'postal_code': '34210', 'total_rate': 0.07},
+        ]))
+        self.assertEqual(get_tax_rate('34210').total_rate, Decimal('0.07'))
+        self.import_file('.json', json.dumps({'34210': 0.065}))
+        self.assertEqual(get_tax_rate('34210').total_rate, Decimal('0.065'))
+
+    def test_dry_run_and_validation(self):
+        output = self.import_file('.json', json.dumps({'10001': 0.08875}), dry_run=True)
+        self.assertIn('1 new', output)
+        self.assertFalse(TaxRate.objects.filter(postal_code='10001').exists())
+        with self.assertRaises(CommandError):
+            self.import_file('.json', json.dumps({'10001': 8.875}))
+        with self.assertRaises(CommandError):
+            self.import_file('.csv', 'zip,rate\nABCDE,0.07\n')
+
+
+@freeze_time('2023-06-01')
+class AvailabilityIndexTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        availability_index.invalidate()
+        self.addCleanup(availability_index.invalidate)
+        self.vehicle_1 = Vehicle.objects.create()
+        self.vehicle_2 = Vehicle.objects.create()
+        self.rental_1 = Rental.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(6, 10),
+            back_at=self.at(6, 12),
+        )
+        self.rental_2 = Rental.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(6, 11),
+            back_at=self.at(6, 15),
+        )
+        self.reservation_1 = Reservation.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(6, 13),
+            back_at=self.at(6, 14),
+        )
+        self.cancelled_rental = Rental.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(6, 20),
+            back_at=self.at(6, 22),
+            status=Rental.Status.CANCELLED,
+        )
+        self.consignment_reservation_1 = ConsignmentReservation.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(6, 25),
+            back_at=self.at(6, 27),
+        )
+        self.rental_3 = Rental.objects.create(
+            vehicle=self.vehicle_2,
+            out_at=self.at(6, 1),
+            back_at=self.at(6, 30),
+        )
+        # Before the index's window, so only found by querying the database
+        self.old_rental = Rental.objects.create(
+            vehicle=self.vehicle_1,
+            out_at=self.at(1, 5),
+            back_at=self.at(1, 8),
+        )
+
+    @staticmethod
+    def at(month, day):
+        return timezone.make_aware(datetime(2023, month, day, 10))
+
+    def get_bookings(self, vehicle, out_at, back_at, **kwargs):
+        return [conflict.booking for conflict in availability_index.get_conflicts(vehicle.id, out_at, back_at, **kwargs)]
+
+    def test_conflicts(self):
+        # Bookings ending or starting exactly at the boundaries count as conflicts
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 12), self.at(6, 13)), [
+            Booking(RENTAL, self.rental_1.id),
+            Booking(RENTAL, self.rental_2.id),
+            Booking(RESERVATION, self.reservation_1.id),
+        ])
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 13), self.at(6, 14), kinds=BLOCKING_KINDS), [
+            Booking(RENTAL, self.rental_2.id),
+        ])
+        self.assertEqual(self.get_bookings(
+            self.vehicle_1, self.at(6, 9), self.at(6, 16), exclude=[Booking(RENTAL, self.rental_2.id)],
+        ), [
+            Booking(RENTAL, self.rental_1.id),
+            Booking(RESERVATION, self.reservation_1.id),
+        ])
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 20), self.at(6, 22)), [])
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 26), self.at(6, 29)), [
+            Booking(CONSIGNMENT, self.consignment_reservation_1.id),
+        ])
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(1, 1), self.at(1, 6)), [
+            Booking(RENTAL, self.old_rental.id),
+        ])
+
+    def test_is_available(self):
+        for day in range(1, 30):
+            out_at, back_at = self.at(6, day), self.at(6, day + 1)
+            for vehicle in (self.vehicle_1, self.vehicle_2):
+                for kinds in ((RENTAL,), BLOCKING_KINDS, (RESERVATION, RENTAL, CONSIGNMENT)):
+                    self.assertEqual(
+                        availability_index.is_available(vehicle.id, out_at, back_at, kinds=kinds),
+                        not self.get_bookings(vehicle, out_at, back_at, kinds=kinds),
+                    )
+        self.assertFalse(availability_index.is_available(self.vehicle_2.id, self.at(6, 29), self.at(7, 2)))
+        self.assertTrue(availability_index.is_available(self.vehicle_2.id, self.at(7, 1), self.at(7, 2)))
+
+    def test_confirm(self):
+        availability_index.ensure_loaded()
+        # Not yet committed, so not applied to the index: as if saved by another process whose version bump this one
+        # hasn't seen yet
+        rental = Rental.objects.create(vehicle=self.vehicle_2, out_at=self.at(7, 5), back_at=self.at(7, 8))
+        self.assertTrue(availability_index.is_available(self.vehicle_2.id, self.at(7, 6), self.at(7, 7)))
+        with self.assertNumQueries(2):
+            self.assertFalse(availability_index.is_available(
+                self.vehicle_2.id, self.at(7, 6), self.at(7, 7), confirm=True,
+            ))
+        self.assertEqual(
+            self.get_bookings(self.vehicle_2, self.at(7, 6), self.at(7, 7), confirm=True), [Booking(RENTAL, rental.id)],
+        )
+        # A conflict found in the index needs no query
+        with self.assertNumQueries(0):
+            self.assertFalse(availability_index.is_available(
+                self.vehicle_2.id, self.at(6, 6), self.at(6, 7), confirm=True,
+            ))
+
+    def test_queries(self):
+        # One query per table to load, and none after that
+        with self.assertNumQueries(2):
+            availability_index.ensure_loaded()
+        with self.assertNumQueries(0):
+            availability_index.is_available(self.vehicle_1.id, self.at(6, 1), self.at(6, 30))
+            availability_index.get_conflicts(self.vehicle_1.id, self.at(6, 1), self.at(6, 30))
+
+    def test_signals(self):
+        availability_index.ensure_loaded()
+        with self.captureOnCommitCallbacks(execute=True):
+            consignment_reservation_2 = ConsignmentReservation.objects.create(
+                vehicle=self.vehicle_1,
+                out_at=self.at(7, 1),
+                back_at=self.at(7, 4),
+            )
+            self.rental_2.delete()
+            self.rental_1.status = Rental.Status.CANCELLED
+            self.rental_1.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 10), self.at(7, 2)), [
+                Booking(RESERVATION, self.reservation_1.id),
+                Booking(CONSIGNMENT, self.consignment_reservation_1.id),
+                Booking(CONSIGNMENT, consignment_reservation_2.id),
+            ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reservation_1.vehicle = self.vehicle_2
+            self.reservation_1.save()
+        self.assertEqual(self.get_bookings(self.vehicle_2, self.at(6, 13), self.at(6, 13)), [
+            Booking(RENTAL, self.rental_3.id),
+            Booking(RESERVATION, self.reservation_1.id),
+        ])
+        self.assertEqual(self.get_bookings(self.vehicle_1, self.at(6, 13), self.at(6, 13)), [])
+
+        # A change in another process is picked up by reloading
+        availability_index.version -= 1
+        with self.assertNumQueries(2):
+            availability_index.ensure_loaded()
+
+
+@freeze_time('2023-05-01')
+class AvailableVehiclesTestCase(TestCase):
+
+    databases = ('default', 'front',)
+
+    def setUp(self) -> None:
+        availability_index.invalidate()
+        self.addCleanup(availability_index.invalidate)
+        self.client = Client()
+        self.vehiclemarketing_1, self.vehiclemarketing_2, self.vehiclemarketing_3 = (
+            VehicleMarketing.objects.create(
+                status=VehicleStatus.READY,
+                price_per_day=price_per_day,
+                discount_2_day=10,
+                discount_3_day=20,
+                discount_7_day=40,
+            ) for price_per_day in (500, 1000, 1500)
+        )
+        self.vehiclemarketing_4 = VehicleMarketing.objects.create(status=VehicleStatus.DOWN, price_per_day=500)
+        # Two of vehicle 1, one of which is rented
+        self.vehicle_1a = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_1.id)
+        self.vehicle_1b = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_1.id)
+        self.vehicle_2 = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_2.id)
+        self.vehicle_3 = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_3.id)
+        self.vehicle_4 = Vehicle.objects.create(vehicle_marketing_id=self.vehiclemarketing_4.id)
+        for vehicle in (self.vehicle_1a, self.vehicle_2):
+            Rental.objects.create(
+                vehicle=vehicle,
+                out_at=timezone.make_aware(datetime(2023, 5, 9, 10)),
+                back_at=timezone.make_aware(datetime(2023, 5, 12, 10)),
+            )
+        ConsignmentReservation.objects.create(
+            vehicle=self.vehicle_3,
+            out_at=timezone.make_aware(datetime(2023, 5, 11, 10)),
+            back_at=timezone.make_aware(datetime(2023, 5, 13, 10)),
+        )
+        # An unconfirmed reservation doesn't make a vehicle unavailable
+        Reservation.objects.create(
+            vehicle=self.vehicle_1b,
+            out_at=timezone.make_aware(datetime(2023, 5, 9, 10)),
+            back_at=timezone.make_aware(datetime(2023, 5, 12, 10)),
+        )
+        self.tax_rate_1 = TaxRate.objects.create(
+            postal_code='07430',
+            total_rate=0.06625,
+        )
+
+    def get_available_vehicles(self, out_at, back_at):
+        return self.client.get(reverse('get-available-vehicles'), dict(
+            out_at=out_at, back_at=back_at, delivery_zip='07430',
+        ))
+
+    def test_free_vehicle_ids(self):
+        vehicle_marketing_ids = [self.vehiclemarketing_1.id, self.vehiclemarketing_2.id, self.vehiclemarketing_3.id]
+        self.assertEqual(get_free_vehicle_ids(
+            vehicle_marketing_ids,
+            timezone.make_aware(datetime(2023, 5, 10, 10)),
+            timezone.make_aware(datetime(2023, 5, 11, 9)),
+        ), {
+            self.vehiclemarketing_1.id: self.vehicle_1b.id,
+            self.vehiclemarketing_3.id: self.vehicle_3.id,
+        })
+        # Overlap is inclusive, so returning just as the consigner's block starts is a clash
+        self.assertEqual(get_free_vehicle_ids(
+            vehicle_marketing_ids,
+            timezone.make_aware(datetime(2023, 5, 10, 10)),
+            timezone.make_aware(datetime(2023, 5, 11, 10)),
+        ), {
+            self.vehiclemarketing_1.id: self.vehicle_1b.id,
+        })
+        self.assertEqual(get_free_vehicle_ids(
+            vehicle_marketing_ids,
+            timezone.make_aware(datetime(2023, 5, 13, 11)),
+            timezone.make_aware(datetime(2023, 5, 15, 10)),
+        ), {
+            self.vehiclemarketing_1.id: self.vehicle_1a.id,
+            self.vehiclemarketing_2.id: self.vehicle_2.id,
+            self.vehiclemarketing_3.id: self.vehicle_3.id,
+        })
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_available_vehicles(self):
+        response = self.get_available_vehicles('2023-05-11T10:00:00-04:00', '2023-05-13T10:00:00-04:00')
+        result = response.json()
+        self.assertTrue(result['success'])
+        self.assertEqual(result['num_days'], 2)
+        self.assertEqual([vehicle['id'] for vehicle in result['vehicles']], [self.vehiclemarketing_1.id])
+        # 2 days at $500 less 10% multi-day discount, plus tax
+        self.assertEqual(result['vehicles'][0]['price_data']['subtotal'], 900.0)
+        self.assertEqual(result['vehicles'][0]['price_data']['total_with_tax'], 959.63)
+
+        response = self.get_available_vehicles('2023-05-20T10:00:00-04:00', '2023-05-22T10:00:00-04:00')
+        self.assertEqual([vehicle['id'] for vehicle in response.json()['vehicles']], [
+            self.vehiclemarketing_1.id, self.vehiclemarketing_2.id, self.vehiclemarketing_3.id,
+        ])
+
+        # One query for the ready vehicles and one for their Vehicles, however many there are. The view is called
+        # directly so the session middleware's queries aren't counted
+        request = RequestFactory().get(reverse('get-available-vehicles'), dict(
+            out_at='2023-05-20T10:00:00-04:00', back_at='2023-05-22T10:00:00-04:00', delivery_zip='07430',
+        ))
+        with CaptureQueriesContext(connections['front']) as front_queries:
+            with CaptureQueriesContext(connections['default']) as default_queries:
+                AvailableVehiclesView.as_view()(request)
+        self.assertEqual(len(front_queries.captured_queries), 1)
+        self.assertEqual(len(default_queries.captured_queries), 1)
+
+    @freeze_time('2023-02-01 15:00:00')
+    def test_invalid_dates(self):
+        response = self.get_available_vehicles('2023-05-13T10:00:00-04:00', '2023-05-11T10:00:00-04:00')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+
+    @freeze_time('2023-05-12 15:00:00')
+    def test_past_dates(self):
+        response = self.get_available_vehicles('2023-05-11T10:00:00-04:00', '2023-05-13T10:00:00-04:00')
+        self.assertEqual(response.status_code, 400)
+        result = response.json()
+        self.assertFalse(result['success'])
+        self.assertEqual(result['errors']['out_at'], ["You've specified a rental date in the past."])
+
+
+class RevenueColumnsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.vehicle = Vehicle.objects.create()
+        self.rental = Rental.objects.create(
+            vehicle=self.vehicle,
+            status=Rental.Status.COMPLETE,
+            final_price_data={'subtotal': '500.00', 'post_multi_day_discount_subtotal': 450.5},
+        )
+        self.joy_ride = JoyRide.objects.create(
+            status=JoyRide.Status.COMPLETE,
+            final_price_data={'subtotal': '125.00'},
+        )
+
+    def test_columns_set_on_save(self):
+        self.rental.refresh_from_db()
+        self.assertEqual(self.rental.final_subtotal, Decimal('500.00'))
+        self.assertEqual(self.rental.final_gross_revenue, Decimal('450.50'))
+        self.assertEqual(self.rental.gross_revenue, Decimal('450.50'))
+        self.joy_ride.refresh_from_db()
+        self.assertEqual(self.joy_ride.final_subtotal, Decimal('125.00'))
+
+        # Saving only final_price_data writes the columns too
+        self.rental.final_price_data = {'subtotal': '600.00', 'post_multi_day_discount_subtotal': '550.00'}
+        self.rental.save(update_fields=['final_price_data'])
+        self.rental.refresh_from_db()
+        self.assertEqual(self.rental.final_subtotal, Decimal('600.00'))
+        self.assertEqual(self.rental.final_gross_revenue, Decimal('550.00'))
+
+    def test_backfill(self):
+        Rental.objects.update(final_subtotal=None, final_gross_revenue=None)
+        JoyRide.objects.update(final_subtotal=None)
+        out = StringIO()
+        call_command('backfill_revenue', '--dry_run', stdout=out)
+        self.assertIn('base reservations: 1 scanned, 1 changed', out.getvalue())
+        self.assertIsNone(Rental.objects.get().final_subtotal)
+
+        call_command('backfill_revenue', stdout=StringIO())
+        rental = Rental.objects.get()
+        self.assertEqual(rental.final_subtotal, Decimal('500.00'))
+        self.assertEqual(rental.final_gross_revenue, Decimal('450.50'))
+        self.assertEqual(JoyRide.objects.get().final_subtotal, Decimal('125.00'))
+
+        out = StringIO()
+        call_command('backfill_revenue', stdout=out)
+        self.assertIn('base reservations: 1 scanned, 0 changed', out.getvalue())
+
+
+class IPBanMatcherTestCase(TestCase):
+
+    def setUp(self) -> None:
+        ip_ban_matcher.invalidate()
+        IPBan.objects.create(ip_address='10.1.0.0', prefix_bits=16)
+        IPBan.objects.create(ip_address='10.1.200.7', prefix_bits=32)
+        IPBan.objects.create(ip_address='192.168.5.9', prefix_bits=32)
+        IPBan.objects.create(ip_address='2001:db8::', prefix_bits=32)
+        IPBan.objects.create(
+            ip_address='172.16.0.0', prefix_bits=12, expires_at=timezone.make_aware(datetime(2023, 6, 2)),
+        )
+        IPBan.objects.create(
+            ip_address='203.0.113.0', prefix_bits=24, expires_at=timezone.make_aware(datetime(2023, 5, 1)),
+        )
+
+    @freeze_time('2023-06-01 12:00:00')
+    def test_is_banned(self):
+        IPBan.ip_is_banned('1.1.1.1')
+        with self.assertNumQueries(0):
+            self.assertTrue(IPBan.ip_is_banned('10.1.0.0'))
+            self.assertTrue(IPBan.ip_is_banned('10.1.255.255'))
+            self.assertFalse(IPBan.ip_is_banned('10.2.0.0'))
+            self.assertTrue(IPBan.ip_is_banned(ipaddress.IPv4Address('192.168.5.9')))
+            self.assertFalse(IPBan.ip_is_banned('192.168.5.10'))
+            self.assertTrue(IPBan.ip_is_banned('172.31.0.1'))
+            # Expired
+            self.assertFalse(IPBan.ip_is_banned('203.0.113.5'))
+            self.assertTrue(IPBan.ip_is_banned('2001:db8:ffff::1'))
+            self.assertFalse(IPBan.ip_is_banned('2001:db9::1'))
+            # IPv4-mapped IPv6 addresses are checked as IPv4
+            self.assertTrue(IPBan.ip_is_banned('::ffff:192.168.5.9'))
+            self.assertFalse(IPBan.ip_is_banned('not an address'))
+            self.assertFalse(IPBan.ip_is_banned(None))
+            self.assertFalse(IPBan.global_kill_switch)
+        # The 10.1.200.7 ban falls inside 10.1.0.0/16
+        self.assertEqual(len(ip_ban_matcher), 4)
+
+        # Rebuilt when the earliest loaded ban expires, at midnight Eastern (04:00 UTC)
+        with freeze_time('2023-06-02 03:59:59'):
+            self.assertTrue(IPBan.ip_is_banned('172.31.0.1'))
+        with freeze_time('2023-06-02 04:00:01'):
+            self.assertFalse(IPBan.ip_is_banned('172.31.0.1'))
+
+    def test_rebuilt_on_change(self):
+        self.assertFalse(IPBan.ip_is_banned('198.51.100.1'))
+        ip_ban = IPBan.objects.create(ip_address='198.51.100.0', prefix_bits=24)
+        self.assertTrue(IPBan.ip_is_banned('198.51.100.1'))
+        ip_ban.delete()
+        self.assertFalse(IPBan.ip_is_banned('198.51.100.1'))
+
+        IPBan.toggle_global_kill_switch()
+        self.assertTrue(IPBan.global_kill_switch)
+        self.assertTrue(IPBan.ip_is_banned('198.51.100.1'))
+        IPBan.toggle_global_kill_switch()
+        self.assertFalse(IPBan.global_kill_switch)
+
+    def test_prefix_bits_validated(self):
+        IPBan(ip_address='2001:db8::', prefix_bits=64).full_clean()
+        with self.assertRaises(ValidationError):
+            IPBan(ip_address='10.0.0.0', prefix_bits=64).full_clean()
+
+
+class IPBanMatcherBenchmarkTestCase(TestCase):
+    NUM_BANS = 10000
+    NUM_LOOKUPS = 10000
+    # Generous, to stay reliable on slow machines
+    TIME_LIMIT_SECS = 1.0
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(1)
+        ip_bans = [
+            IPBan(ip_address=str(ipaddress.IPv4Address(rng.getrandbits(32))), prefix_bits=rng.choice((24, 28, 32)))
+            for _ in range(cls.NUM_BANS // 2)
+        ] + [
+            IPBan(ip_address=str(ipaddress.IPv6Address(rng.getrandbits(128))), prefix_bits=rng.choice((48, 64, 128)))
+            for _ in range(cls.NUM_BANS // 2)
+        ]
+        IPBan.objects.bulk_create(ip_bans)
+        cls.addresses = [str(ip_ban.ip_address) for ip_ban in ip_bans[::2]] + [
+            str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(cls.NUM_LOOKUPS // 2)
+        ]
+
+    def test_benchmark(self):
+        ip_ban_matcher.invalidate()
+        self.assertTrue(ip_ban_matcher.is_banned(self.addresses[0]))
+        timings = []
+        for _ in range(5):
+            started_at = time.perf_counter()
+            banned = sum(ip_ban_matcher.is_banned(address) for address in self.addresses)
+            timings.append(time.perf_counter() - started_at)
+        self.assertGreaterEqual(banned, self.NUM_LOOKUPS // 2)
+        self.assertLess(min(timings), self.TIME_LIMIT_SECS)
+
+
+# Local stand-in for the third-party HTTP APIs: answers /slow after FAKE_SERVICE_DELAY_SECS, /error with a 503 and
+# anything else with a JSON success
+
+FAKE_SERVICE_DELAY_SECS = 1.0
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+
+    def respond(self):
+        if self.path == '/slow':
+            time.sleep(FAKE_SERVICE_DELAY_SECS)
+        if self.path == '/error':
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'success': True, 'country': 'United States'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = respond
+    do_POST = respond
+
+    def handle(self):
+        # The client has timed out and gone by the time /slow is answered
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Stand-ins for wkhtmltopdf: one echoing the HTML given to it, one hanging
+
+FAKE_WKHTMLTOPDF = 'import sys; sys.stdout.write(sys.stdin.read())'
+HANGING_WKHTMLTOPDF = 'import time; time.sleep(10)'
+
+
+@override_settings(OUTBOUND_TIMEOUT_SECS={
+    'stripe': 0.5, 'recaptcha': 0.5, 'smtp': 0.5, 'wkhtmltopdf': 0.5, 'ip_api': 0.5,
+})
+class OutboundCallTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeServiceHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.server_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        request_metrics.clear()
+
+    def get_service(self, service):
+        return request_metrics.snapshot()['services'][service]
+
+    def make_wkhtmltopdf(self, script):
+        wkhtmltopdf = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+        wkhtmltopdf.write(f'#!{sys.executable}\n{script}\n')
+        wkhtmltopdf.close()
+        os.chmod(wkhtmltopdf.name, 0o755)
+        self.addCleanup(os.remove, wkhtmltopdf.name)
+        return wkhtmltopdf.name
+
+    def test_http_request(self):
+        with self.settings(RECAPTCHA_VERIFY_URL=f'{self.server_url}/siteverify'):
+            self.assertTrue(ReCAPTCHAFormMixin.verify_recaptcha('token').json()['success'])
+        self.assertEqual(http_request(RECAPTCHA, 'GET', f'{self.server_url}/error').status_code, 503)
+        with self.assertRaises(requests.Timeout):
+            http_request(RECAPTCHA, 'GET', f'{self.server_url}/slow')
+
+        recaptcha = self.get_service(RECAPTCHA)
+        self.assertEqual(sum(recaptcha['duration'][0]), 3)
+        self.assertEqual(recaptcha['errors'], {'HTTP 503': 1, 'ReadTimeout': 1})
+
+    def test_ip_country(self):
+        # ip-api itself is swapped for the fake, by path
+        def fake_ip_api(path):
+            return lambda service, method, url: http_request(service, method, f'{self.server_url}{path}')
+
+        customer = Customer(registration_ip='192.0.2.1')
+        with mock.patch('users.models.http_request', fake_ip_api('/')):
+            self.assertEqual(customer.ip_country, 'United States')
+        with mock.patch('users.models.http_request', fake_ip_api('/slow')):
+            self.assertIsNone(customer.ip_country)
+        self.assertEqual(self.get_service('ip_api')['errors'], {'ReadTimeout': 1})
+
+    def test_stripe(self):
+        client = TimedStripeClient(timeout=0.5)
+        content, status_code, headers = client.request('get', f'{self.server_url}/v1/charges', {})
+        self.assertEqual(status_code, 200)
+        client.request('get', f'{self.server_url}/error', {})
+        stripe_metrics = self.get_service('stripe')
+        self.assertEqual(sum(stripe_metrics['duration'][0]), 2)
+        self.assertEqual(stripe_metrics['errors'], {'HTTP 503': 1})
+
+    def test_smtp(self):
+        send_email(
+            ['one@test.com', 'two@test.com'], 'Test', {},
+            text_template='email/adhoc_payment_complete.txt', html_template='email/adhoc_payment_complete.html',
+        )
+        self.assertEqual(len(mail.outbox), 2)
+        # Opening the connection and sending each message
+        self.assertEqual(sum(self.get_service('smtp')['duration'][0]), 3)
+
+    def test_wkhtmltopdf(self):
+        with mock.patch.dict(os.environ, {'WKHTMLTOPDF_BIN': self.make_wkhtmltopdf(FAKE_WKHTMLTOPDF)}):
+            self.assertEqual(html_to_pdf('<p>Test</p>'), b'<p>Test</p>')
+        with mock.patch.dict(os.environ, {'WKHTMLTOPDF_BIN': self.make_wkhtmltopdf(HANGING_WKHTMLTOPDF)}):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                html_to_pdf('<p>Test</p>')
+        self.assertEqual(self.get_service('wkhtmltopdf')['errors'], {'TimeoutExpired': 1})
+
+    @override_settings(SLOW_REQUEST_SECS=0)
+    def test_request_summary(self):
+        def view(request):
+            http_request(RECAPTCHA, 'GET', f'{self.server_url}/')
+            http_request(RECAPTCHA, 'GET', f'{self.server_url}/')
+
+        with self.assertLogs('pri.middleware', 'WARNING') as logs:
+            RequestMetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertIn('recaptcha', logs.output[0])
+        self.assertIn('(2 calls)', logs.output[0])
+        counts, total = request_metrics.snapshot()['routes']['unresolved']['histograms']['request_outbound_seconds']
+        self.assertEqual(sum(counts), 1)
+        self.assertGreater(total, 0)
@@ -1,4 +1,5 @@
 import datetime
+import ipaddress
 import logging
 from stripe.error import CardError
 
@@ -10,6 +11,7 @@ from django.db import IntegrityError
 from django.contrib.auth import authenticate, login, logout
 from django import forms
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
@@ -22,6 +24,7 @@ from sales.forms import (
     GiftCertificateForm, AdHocPaymentForm
 )
 from sales.models import GiftCertificate, AdHocPayment, IPBan, generate_code
+from sales.calculators import PricingContext
 from sales.enums import ServiceType
 from sales.constants import GIFT_CERTIFICATE_TEXT
 from marketing.views import NavMenuMixin
@@ -38,8 +41,18 @@ logger = logging.getLogger(__name__)
 
 # All 2-part forms (where the first phase collects the reservation details, and the second phase is either a login form
 # or a payment details/new user creation form depending on the email address given in the first phase) use this mixin.
+# All three forms share one PricingContext so pricing lookups are resolved once per request.
 class PaymentLoginFormMixin:
 
+    @cached_property
+    def pricing_context(self):
+        return PricingContext()
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['pricing_context'] = self.pricing_context
+        return kwargs
+
     def get_payment_form_class(self):
         return self.payment_form_class
 
@@ -143,7 +156,10 @@ class ReservationMixin:
             )
             check_customers = Customer.objects.filter(created_at__gt=ten_minutes_ago, registration_ip=request.remote_ip)
             if check_customers.count() > settings.REGISTRATION_FROM_SAME_IP_COUNT - 1:
-                IPBan.objects.create(ip_address=request.remote_ip, prefix_bits=32)
+                IPBan.objects.create(
+                    ip_address=request.remote_ip,
+                    prefix_bits=ipaddress.ip_address(request.remote_ip).max_prefixlen,
+                )
 
         # IP-based block list will send client to the honeypot success page and short-circuit all further processing.
         # Can be set globally (in settings.py or env.yaml) or by creating an IPBan, or by using the "global kill switch"
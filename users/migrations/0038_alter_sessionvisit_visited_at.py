@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0037_customer_card_1_status_customer_card_2_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sessionvisit',
+            name='visited_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -19,6 +19,7 @@ from users.enums import AdminIdleTimeCSSClass
 from sales.utils import EncryptedUSSocialSecurityNumberField, format_cc_number
 from sales.stripe import Stripe
 from pri.cipher import AESCipher
+from pri.outbound import IP_API, http_request
 from sales.tasks import send_email
 from sales.constants import BANK_PHONE_HELP_TEXT
 
@@ -388,8 +389,10 @@ class Customer(models.Model):
     @property
     def ip_country(self):
         url = f'http://ip-api.com/json/{self.registration_ip}'
-        response = requests.get(url)
-        result = response.json()
+        try:
+            result = http_request(IP_API, 'GET', url).json()
+        except (requests.RequestException, ValueError):
+            return None
         return result.get('country')
 
     @property
@@ -559,4 +562,5 @@ class MusicGenre(models.Model):
 
 class SessionVisit(models.Model):
     session = models.ForeignKey(Session, on_delete=models.CASCADE)
-    visited_at = models.DateTimeField(auto_now_add=True)
+    # Set when the visit happened, rather than when the buffered visit was written (see users.visits)
+    visited_at = models.DateTimeField(default=timezone.now, editable=False)
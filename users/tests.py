@@ -1,3 +1,315 @@
-from django.test import TestCase
+import io
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from freezegun import freeze_time
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends import db
+from django.contrib.sessions.backends.base import UpdateError
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.utils import timezone
+
+from pri import middleware, sessions
+from pri.middleware import RemoteHostMiddleware, ResolveURLMiddleware, LoginRequiredMiddleware, PermissionsMiddleware
+from users.models import SessionVisit, User
+from users.visits import session_visit_buffer
+
+
+@override_settings(SESSION_VISIT_BACKGROUND_WRITE=False, SESSION_VISIT_BUFFER_SIZE=3)
+class SessionVisitTestCase(TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        session_visit_buffer.visits = []
+        self.middleware = RemoteHostMiddleware(lambda request: None)
+        self.session = SessionStore()
+        self.session.create()
+
+    def get_request(self, session_key=None, remote_addr='192.0.2.1'):
+        request = RequestFactory().get('/', REMOTE_ADDR=remote_addr, HTTP_USER_AGENT='Test')
+        request.session = SessionStore(session_key=session_key or self.session.session_key)
+        self.middleware.process_request(request)
+        if request.session.modified:
+            request.session.save()
+        return request
+
+    def test_session_only_written_on_change(self):
+        request = self.get_request()
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session['remote_ip'], '192.0.2.1')
+        self.assertIn('last_access', request.session)
+
+        with self.assertNumQueries(1):
+            request = self.get_request()
+        self.assertFalse(request.session.modified)
+
+        request = self.get_request(remote_addr='192.0.2.2')
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session['remote_ip'], '192.0.2.2')
+
+    def test_visits_buffered(self):
+        self.get_request()
+        self.get_request()
+        self.assertEqual(len(session_visit_buffer.visits), 1)
+        self.assertFalse(SessionVisit.objects.exists())
+
+        # A visit an hour later, once the cache marker has expired
+        with freeze_time(timezone.now() + timedelta(hours=1, seconds=1)):
+            cache.delete(f'session_visit:{self.session.session_key}')
+            self.get_request()
+        self.assertEqual(session_visit_buffer.flush(), 2)
+        self.assertEqual(SessionVisit.objects.filter(session_id=self.session.session_key).count(), 2)
+
+        # Visits of sessions deleted before the flush are dropped
+        other_session = SessionStore()
+        other_session.create()
+        self.get_request(session_key=other_session.session_key)
+        other_session.delete()
+        self.assertEqual(session_visit_buffer.flush(), 0)
+
+    def test_full_buffer_flushed(self):
+        for _ in range(3):
+            session = SessionStore()
+            session.create()
+            self.get_request(session_key=session.session_key)
+        self.assertEqual(session_visit_buffer.visits, [])
+        self.assertEqual(SessionVisit.objects.count(), 3)
+
+
+def run_in_thread(function, *args):
+    # Runs function in a thread of its own, as another app process would, with its own cache and database connections
+    result = {}
+
+    def run():
+        try:
+            result['value'] = function(*args)
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result.get('value')
+
+
+# The local memory cache stands in for a shared one; its instances (one per thread) share the data of a LOCATION
+
+@override_settings(SESSION_LOCAL_CACHE_ALLOWED=True)
+class CachedSessionTestCase(TestCase):
+
+    def setUp(self) -> None:
+        caches['sessions'].clear()
+        sessions.session_write_buffer.flush()
+        self.session = sessions.SessionStore()
+        self.session['cart'] = [1]
+        self.session.save()
+
+    def test_load_from_cache(self):
+        self.assertTrue(Session.objects.filter(session_key=self.session.session_key).exists())
+        with self.assertNumQueries(0):
+            session = sessions.SessionStore(self.session.session_key)
+            self.assertEqual(session['cart'], [1])
+            self.assertTrue(session.exists(self.session.session_key))
+
+        # Falls back to the database once out of the cache
+        caches['sessions'].clear()
+        session = sessions.SessionStore(self.session.session_key)
+        self.assertEqual(session['cart'], [1])
+        with self.assertNumQueries(0):
+            self.assertEqual(sessions.SessionStore(self.session.session_key)['cart'], [1])
+
+    def test_writes_coalesced(self):
+        session = sessions.SessionStore(self.session.session_key)
+        session['last_access'] = timezone.now().isoformat()
+        with self.assertNumQueries(0):
+            session.save()
+        self.assertIsNone(sessions.session_write_buffer.get(session.session_key))
+        self.assertIn('last_access', sessions.SessionStore(self.session.session_key).load())
+
+        session['cart'] = [1, 2]
+        session.save()
+        session['cart'] = [1, 2, 3]
+        session.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(sessions.SessionStore(self.session.session_key)['cart'], [1, 2, 3])
+        self.assertEqual(sessions.session_write_buffer.flush(), 1)
+        self.assertEqual(db.SessionStore(self.session.session_key)['cart'], [1, 2, 3])
+
+        # Timestamp-only changes are written once the database copy is old enough
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            session = sessions.SessionStore(self.session.session_key)
+            session['last_access'] = timezone.now().isoformat()
+            session.save()
+            self.assertIsNotNone(sessions.session_write_buffer.get(session.session_key))
+
+    def test_delete(self):
+        self.session['cart'] = [1, 2]
+        self.session.save()
+        self.session.delete()
+        self.assertIsNone(sessions.session_write_buffer.get(self.session.session_key))
+        self.assertFalse(Session.objects.exists())
+        self.assertEqual(sessions.SessionStore(self.session.session_key).load(), {})
+
+    def test_local_cache_refused(self):
+        with self.settings(SESSION_LOCAL_CACHE_ALLOWED=False, DEBUG=False):
+            with self.assertRaises(ImproperlyConfigured):
+                sessions.SessionStore(self.session.session_key)
+
+    @override_settings(SESSION_CLEANUP_BATCH_SIZE=2)
+    def test_clear_expired(self):
+        now = timezone.now()
+        Session.objects.bulk_create([
+            Session(session_key=f'expired{index}', session_data='', expire_date=now - timedelta(hours=1))
+            for index in range(5)
+        ] + [Session(session_key='recently-expired', session_data='', expire_date=now - timedelta(minutes=1))])
+        sessions.SessionStore.clear_expired()
+        self.assertEqual(
+            set(Session.objects.values_list('session_key', flat=True)),
+            {self.session.session_key, 'recently-expired'},
+        )
+
+
+# Threads stand in for app processes, so these need committed data
+
+@override_settings(SESSION_LOCAL_CACHE_ALLOWED=True)
+class SharedSessionCacheTestCase(TransactionTestCase):
+
+    def setUp(self) -> None:
+        caches['sessions'].clear()
+
+    def test_logout_seen_by_other_process(self):
+        session = sessions.SessionStore()
+        session['_auth_user_id'] = '1'
+        session.save()
+        session_key = session.session_key
+
+        def load():
+            return sessions.SessionStore(session_key).load()
+
+        # Loaded, and so cached, by the other process before logging out here
+        self.assertEqual(run_in_thread(load), {'_auth_user_id': '1'})
+        sessions.SessionStore(session_key).flush()
+        self.assertEqual(run_in_thread(load), {})
+        self.assertFalse(run_in_thread(lambda: sessions.SessionStore().exists(session_key)))
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+
+
+@override_settings(SESSION_LOCAL_CACHE_ALLOWED=True)
+class SessionEngineBenchmarkTestCase(TransactionTestCase):
+    NUM_SESSIONS = 50
+    NUM_THREADS = 8
+    REQUESTS_PER_THREAD = 250
+
+    def handle_request(self, session_store_class, session_key, index):
+        # Front-site traffic: every request reads its session, one in ten updates a timestamp and one in fifty changes
+        # the session's data
+        session = session_store_class(session_key)
+        session.get('remote_ip')
+        if index % 10 == 0:
+            session['last_access'] = timezone.now().isoformat()
+        if index % 50 == 0:
+            session['cart'] = index
+        if session.modified:
+            session.save()
+        if sessions.session_write_buffer.is_due():
+            sessions.session_write_buffer.flush()
+
+    def run_thread(self, session_store_class, session_keys, thread_index, errors):
+        try:
+            for index in range(self.REQUESTS_PER_THREAD):
+                session_key = session_keys[(thread_index + index) % len(session_keys)]
+                # SQLite (as used for tests) turns away writes while another connection holds a table lock, where
+                # MySQL would wait; such requests are retried. The db engine reports a failed update as UpdateError
+                while True:
+                    try:
+                        self.handle_request(session_store_class, session_key, index)
+                        break
+                    except (OperationalError, UpdateError):
+                        time.sleep(0.001)
+        except Exception as e:
+            # Collected for run_requests to fail on, as a thread which died would otherwise only time less work
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    def run_requests(self, session_store_class):
+        # Seconds per request, with NUM_THREADS threads handling requests for the same sessions at once
+        session_keys = []
+        for _ in range(self.NUM_SESSIONS):
+            session = session_store_class()
+            session['remote_ip'] = '192.0.2.1'
+            session.save()
+            session_keys.append(session.session_key)
+        errors = []
+        threads = [
+            threading.Thread(target=self.run_thread, args=(session_store_class, session_keys, thread_index, errors))
+            for thread_index in range(self.NUM_THREADS)
+        ]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+        if errors:
+            raise AssertionError(f'{len(errors)} of {self.NUM_THREADS} threads failed') from errors[0]
+        sessions.session_write_buffer.flush()
+        return elapsed / (self.NUM_THREADS * self.REQUESTS_PER_THREAD)
+
+    def test_benchmark(self):
+        db_latency = min(self.run_requests(db.SessionStore) for _ in range(3))
+        cached_latency = min(self.run_requests(sessions.SessionStore) for _ in range(3))
+        self.assertLess(cached_latency, db_latency)
+        # Every buffered change to the sessions' data made it to the database
+        for session_key in Session.objects.values_list('session_key', flat=True):
+            self.assertEqual(
+                db.SessionStore(session_key).load().get('cart'), sessions.SessionStore(session_key).load().get('cart'),
+            )
+
+
+class RouteMiddlewareTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(email='staff@test.com')
+
+    def get_response(self, path, user=None):
+        # Runs a request through ResolveURLMiddleware and the two guards, returning what the guards let through to
+        request = RequestFactory().get(path)
+        request.user = user or AnonymousUser()
+        guards = LoginRequiredMiddleware(PermissionsMiddleware(lambda request: 'view'))
+        return ResolveURLMiddleware(guards)(request)
+
+    def test_url_resolved_once(self):
+        with mock.patch('pri.middleware.resolve', wraps=middleware.resolve) as resolve:
+            response = self.get_response('/backoffice/')
+        self.assertEqual(resolve.call_count, 1)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/backoffice/login/')
+
+    def test_guards(self):
+        self.assertEqual(self.get_response('/'), 'view')
+        self.assertEqual(self.get_response('/backoffice/login/'), 'view')
+        self.assertEqual(self.get_response('/no-such-page/'), 'view')
+        with self.assertRaises(PermissionDenied):
+            self.get_response('/backoffice/', user=self.user)
+        self.user.is_backoffice = True
+        self.assertEqual(self.get_response('/backoffice/', user=self.user), 'view')
+        with self.assertRaises(PermissionDenied):
+            self.get_response('/special/', user=self.user)
+
+    # The page is rendered without collectstatic having been run, so there is no manifest to look its static files up in
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_middleware', requests=2, runs=1, stdout=out)
+        for layer in settings.MIDDLEWARE:
+            self.assertIn(layer, out.getvalue())
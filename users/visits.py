@@ -0,0 +1,83 @@
+# Session visit tracking for RemoteHostMiddleware. A session's visit is recorded at most once per
+# SESSION_VISIT_INTERVAL_SECS, guarded by a marker in the cache rather than a query, and recorded visits wait in a
+# process-local buffer to be written in batches.
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from users.models import SessionVisit
+
+logger = logging.getLogger(__name__)
+
+
+def get_visit_cache_key(session_key: str) -> str:
+    return f'session_visit:{session_key}'
+
+
+def start_visit(session_key: str) -> bool:
+    # True if the session hasn't had a visit recorded within the interval, marking it as having one now. With more than
+    # one app process, CACHES must point at a shared backend or each process records its own visits.
+    return cache.add(get_visit_cache_key(session_key), True, settings.SESSION_VISIT_INTERVAL_SECS)
+
+
+class SessionVisitBuffer:
+    """
+    Process-local buffer of visits waiting to be written, flushed with a single bulk_create by a daemon thread every
+    SESSION_VISIT_FLUSH_SECS, or as soon as SESSION_VISIT_BUFFER_SIZE visits are waiting, and at exit. Without
+    SESSION_VISIT_BACKGROUND_WRITE a full buffer is flushed in the adding thread instead. Visits whose session has gone
+    by the time they are flushed are dropped.
+    """
+    def __init__(self):
+        self.visits = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+
+    def add(self, session_key: str, visited_at) -> None:
+        with self.lock:
+            self.visits.append((session_key, visited_at))
+            is_full = len(self.visits) >= settings.SESSION_VISIT_BUFFER_SIZE
+            if settings.SESSION_VISIT_BACKGROUND_WRITE:
+                if not self.worker or not self.worker.is_alive():
+                    self.worker = threading.Thread(target=self.work, name='session-visit-writer', daemon=True)
+                    self.worker.start()
+                if is_full:
+                    self.wakeup.set()
+        if is_full and not settings.SESSION_VISIT_BACKGROUND_WRITE:
+            self.flush()
+
+    def flush(self) -> int:
+        # Writes the waiting visits, returning the number written
+        with self.lock:
+            visits, self.visits = self.visits, []
+        if not visits:
+            return 0
+        session_keys = set(Session.objects.filter(
+            session_key__in={session_key for session_key, visited_at in visits},
+        ).values_list('session_key', flat=True))
+        session_visits = SessionVisit.objects.bulk_create([
+            SessionVisit(session_id=session_key, visited_at=visited_at)
+            for session_key, visited_at in visits if session_key in session_keys
+        ])
+        return len(session_visits)
+
+    def work(self) -> None:
+        atexit.register(self.flush)
+        while True:
+            self.wakeup.wait(settings.SESSION_VISIT_FLUSH_SECS)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write session visits')
+            finally:
+                close_old_connections()
+
+
+session_visit_buffer = SessionVisitBuffer()